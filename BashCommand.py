@@ -4,12 +4,41 @@
 import subprocess
 import threading
 import signal
+import select
+import shlex
+import fcntl
+import errno
+import time
+import re
 import os
 
+from IpsecManagerTracing import tracer
+
+# Returns the argv that executes the command. Commands are executed directly, rather than through a shell (which costs another fork and exec),
+# unless they use shell syntax: redirections, pipes, command lists, substitutions, globs, escapes or variable assignments
+# Quoted words are split as a shell would split them, as long as they hold no substitutions or escapes
+def getCommandArgv(command):
+    unquotedCommand = re.sub(r'\'[^\']*\'|"[^"$`\\]*"', '', command)
+    if re.search(r'[|&;<>()$`\\*?\[\]{}~#\'"\n]', unquotedCommand) or re.search(r'^\s*\w+=', command):
+        return ['/bin/sh', '-c', command]
+    return shlex.split(command)
+
+# Starts the command's process, or returns the error of a command that couldn't be executed, as a shell would report it (exit code 127)
+def startCommandProcess(command, **popenArguments):
+    argv = getCommandArgv(command)
+    try:
+        return subprocess.Popen(argv, **popenArguments), None
+    except OSError as e:
+        return None, argv[0] + ': ' + e.strerror
+
+def setCloseOnExec(fileDescriptor):
+    fcntl.fcntl(fileDescriptor, fcntl.F_SETFD, fcntl.fcntl(fileDescriptor, fcntl.F_GETFD) | fcntl.FD_CLOEXEC)
+
 class BashCommand(object):
-    def __init__(self, command, undoCommand = None, errorHandler = None):
+    def __init__(self, command, undoCommand = None, errorHandler = None, commandInput = None):
         self.command = command
         self.undoCommand = undoCommand
+        self.commandInput = commandInput
         self.errorOutput = None
         self.output = None
         self.errorHandler = errorHandler if errorHandler != None else self.defaultErrorHandler
@@ -17,18 +46,34 @@ class BashCommand(object):
     def defaultErrorHandler(self, errorOutput):
         raise RuntimeError(self.errorOutput)
 
+    # The commandInput, if given, is written to the command's stdin
     def executeCommand(self):
-        subproc = subprocess.Popen(self.command, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        self.output, self.errorOutput = tuple(output.strip() for output in subproc.communicate())
+        subproc, self.errorOutput = startCommandProcess(self.command, stdin=subprocess.PIPE if self.commandInput is not None else None, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        if subproc is None:
+            self.output = ''
+            return 127
+        self.output, self.errorOutput = tuple(output.strip() for output in subproc.communicate(self.commandInput))
         return subproc.returncode
 
     def execute(self):
-        if self.executeCommand() != 0:
+        returnCode = self.executeTracedCommand() if tracer.enabled else self.executeCommand()
+        if returnCode != 0:
             self.errorHandler(self.errorOutput)
 
+    def executeTracedCommand(self):
+        span = tracer.startCommandSpan(self.command)
+        try:
+            returnCode = self.executeCommand()
+        except BaseException as e:
+            tracer.finishCommandSpan(span, None, self.errorOutput, timedOut=isinstance(e, TimeoutException))
+            raise
+        tracer.finishCommandSpan(span, returnCode, self.errorOutput)
+        return returnCode
+
+    # Undoes the command synchronously, raising a RuntimeError if the undo command fails
     def undo(self):
         if self.undoCommand:
-            subprocess.Popen(self.undoCommand, shell=True)
+            BashCommand(self.undoCommand).execute()
 
 class TimeoutException(Exception):
     pass
@@ -38,17 +83,209 @@ class TimedBashCommand(BashCommand):
         super(TimedBashCommand, self).__init__(command, undoCommand, errorHandler)
         self.timeout = timeout
 
+    # The timeout is enforced by a ConcurrentCommandRunner's poll loop, in the calling thread rather than in a thread of its own
     #Override
     def executeCommand(self):
-        def target():
-            self.subproc = subprocess.Popen(self.command, shell=True, preexec_fn=os.setsid, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-            self.output, self.errorOutput = tuple(output.strip() for output in self.subproc.communicate())
-
-        thread = threading.Thread(target=target)
-        thread.start()
-        thread.join(self.timeout)
-        if thread.is_alive():
-            os.killpg(os.getpgid(self.subproc.pid), signal.SIGTERM)
-            thread.join()
+        ConcurrentCommandRunner(1, traceCommands=False).run([self])
+        if self.timedOut:
             raise TimeoutException()
-        return self.subproc.returncode
+        return self.returnCode
+
+# Wraps a python function, so it can take the place of a BashCommand (e.g. in a list of commands that is undone on failure)
+class CallableCommand(object):
+    def __init__(self, command, function, undoFunction = None):
+        self.command = command
+        self.function = function
+        self.undoFunction = undoFunction
+
+    def execute(self):
+        self.function()
+
+    def undo(self):
+        if self.undoFunction:
+            self.undoFunction()
+
+# Executes many TimedBashCommands concurrently from a single thread, with at most maxConcurrentCommands running at any time
+# Commands are executed directly rather than through a shell (see getCommandArgv), each one in its own process group, which is killed once its timeout expires
+# Once run returns, each command holds its output, errorOutput, returnCode and whether it timedOut
+# Each command is traced unless traceCommands is unset (e.g. when the caller traces the command itself)
+# A command whose output streams were closed is still running until it is reaped (e.g. a command that daemonizes, and hands its streams
+# to the daemon), so it is polled every reapInterval seconds, and is killed like any other command once its timeout expires
+class ConcurrentCommandRunner(object):
+    def __init__(self, maxConcurrentCommands = 16, killGracePeriod = 1, traceCommands = True, reapInterval = 0.001):
+        self.maxConcurrentCommands = maxConcurrentCommands
+        self.killGracePeriod = killGracePeriod
+        self.traceCommands = traceCommands
+        self.reapInterval = reapInterval
+
+    def run(self, commands):
+        pendingCommands = list(reversed(commands))
+        runningCommands = {}
+        streams = {}
+        poller = select.poll()
+
+        def startCommand(command):
+            command.timedOut = False
+            command.returnCode = None
+            command.outputChunks = {'stdout' : [], 'stderr' : []}
+            command.span = tracer.startCommandSpan(command.command) if tracer.enabled and self.traceCommands else None
+            command.subproc, startError = startCommandProcess(command.command, preexec_fn=os.setsid, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+            if command.subproc is None:
+                command.output, command.errorOutput, command.returnCode = '', startError, 127
+                if command.span:
+                    tracer.finishCommandSpan(command.span, command.returnCode, command.errorOutput)
+                return
+            command.deadline = time.time() + command.timeout
+            command.openStreams = 2
+            runningCommands[command.subproc.pid] = command
+            for streamName, stream in [('stdout', command.subproc.stdout), ('stderr', command.subproc.stderr)]:
+                streams[stream.fileno()] = (command, streamName, stream)
+                poller.register(stream.fileno(), select.POLLIN | select.POLLHUP | select.POLLERR)
+
+        def finishCommand(command):
+            del runningCommands[command.subproc.pid]
+            command.returnCode = command.subproc.returncode
+            command.output, command.errorOutput = tuple(b''.join(command.outputChunks[streamName]).strip() for streamName in ['stdout', 'stderr'])
+            if command.span:
+                tracer.finishCommandSpan(command.span, command.returnCode, command.errorOutput, command.timedOut)
+
+        while pendingCommands or runningCommands:
+            while pendingCommands and len(runningCommands) < self.maxConcurrentCommands:
+                startCommand(pendingCommands.pop())
+            if not runningCommands:
+                continue
+
+            now = time.time()
+            for command in list(runningCommands.values()):
+                if now >= command.deadline:
+                    # A command is killed once its timeout expires, and again, forcefully, if it hasn't exited after the grace period:
+                    try:
+                        os.killpg(command.subproc.pid, signal.SIGKILL if command.timedOut else signal.SIGTERM)
+                    except OSError:
+                        pass
+                    command.timedOut = True
+                    command.deadline = now + self.killGracePeriod
+            timeout = max(0, min(command.deadline for command in runningCommands.values()) - time.time())
+            if any(command.openStreams == 0 for command in runningCommands.values()):
+                timeout = min(timeout, self.reapInterval)
+
+            for fileDescriptor, _ in poller.poll(timeout * 1000):
+                command, streamName, stream = streams[fileDescriptor]
+                data = os.read(fileDescriptor, 1 << 16)
+                if data:
+                    command.outputChunks[streamName].append(data)
+                    continue
+                poller.unregister(fileDescriptor)
+                del streams[fileDescriptor]
+                stream.close()
+                command.openStreams -= 1
+
+            for command in list(runningCommands.values()):
+                if command.openStreams == 0 and command.subproc.poll() is not None:
+                    finishCommand(command)
+
+        return commands
+
+# A long-lived process that executes the lines streamed into its stdin one by one, such as 'ip -force -batch -', and reports each line that
+# failed on stderr, after the line's error messages, as 'Command failed <file>:<line number>'. Each batch of lines is followed by a sentinel
+# line that always fails, so the batch is complete once the sentinel's failure is reported. The process is shared by all the batches, and
+# is started again, on the next batch, if it has exited. A batch that makes no progress for timeout seconds is killed with its process
+class BatchCoprocess(object):
+    def __init__(self, command, sentinelLine, timeout = 10):
+        self.command      = command
+        self.sentinelLine = sentinelLine
+        self.timeout      = timeout
+        self.subproc      = None
+        self.lineNumber   = 0
+        self.errorBuffer  = b''
+        self.lock         = threading.Lock()
+
+    def start(self):
+        with open(os.devnull, 'w') as devnull:
+            self.subproc, startError = startCommandProcess(self.command, stdin=subprocess.PIPE, stdout=devnull, stderr=subprocess.PIPE)
+        if self.subproc is None:
+            raise RuntimeError(startError)
+        # The pipes are kept from the commands executed later on, which would otherwise hold the process' stdin open:
+        for stream in [self.subproc.stdin, self.subproc.stderr]:
+            setCloseOnExec(stream.fileno())
+        fcntl.fcntl(self.subproc.stdin.fileno(), fcntl.F_SETFL, fcntl.fcntl(self.subproc.stdin.fileno(), fcntl.F_GETFL) | os.O_NONBLOCK)
+        self.lineNumber  = 0
+        self.errorBuffer = b''
+
+    # Streams the lines into the process, and returns the error messages of the lines that failed, by the lines' indexes
+    def executeLines(self, lines):
+        with self.lock:
+            return self.executeTracedBatch(lines) if tracer.enabled else self.executeBatch(lines)
+
+    # A batch is traced as a single command, which fails when any of its lines failed, with the failed lines' error messages as its stderr
+    def executeTracedBatch(self, lines):
+        span = tracer.startCommandSpan(self.command)
+        try:
+            failedLines = self.executeBatch(lines)
+        except BaseException as e:
+            tracer.finishCommandSpan(span, None, str(e), timedOut=isinstance(e, TimeoutException))
+            raise
+        tracer.finishCommandSpan(span, 1 if failedLines else 0, os.linesep.join(errorLine for errorLines in failedLines.values() for errorLine in errorLines))
+        return failedLines
+
+    # Input is written while errors are read, so a batch that fails as a whole never fills the stderr pipe while its stdin is still being written
+    def executeBatch(self, lines):
+        if self.subproc is not None and self.subproc.poll() is not None:
+            self.close()
+        if self.subproc is None:
+            self.start()
+        firstLineNumber     = self.lineNumber + 1
+        self.lineNumber    += len(lines) + 1
+        sentinelLineNumber  = self.lineNumber
+        pendingInput        = ''.join(line + '\n' for line in lines + [self.sentinelLine]).encode()
+        stdinFileDescriptor, stderrFileDescriptor = self.subproc.stdin.fileno(), self.subproc.stderr.fileno()
+        poller = select.poll()
+        poller.register(stdinFileDescriptor, select.POLLOUT)
+        poller.register(stderrFileDescriptor, select.POLLIN | select.POLLHUP | select.POLLERR)
+        failedLines, errorLines = {}, []
+        deadline = time.time() + self.timeout
+        while True:
+            events = poller.poll(max(0, deadline - time.time()) * 1000)
+            if not events:
+                self.close()
+                raise TimeoutException()
+            deadline = time.time() + self.timeout
+            for fileDescriptor, event in events:
+                if fileDescriptor == stdinFileDescriptor:
+                    try:
+                        pendingInput = pendingInput[os.write(stdinFileDescriptor, pendingInput):]
+                    except OSError as e:
+                        if e.errno == errno.EAGAIN:
+                            continue
+                        # The process exited, and its remaining errors are still read from stderr:
+                        pendingInput = b''
+                    if not pendingInput:
+                        poller.unregister(stdinFileDescriptor)
+                    continue
+                data = os.read(stderrFileDescriptor, 1 << 16)
+                if not data:
+                    self.close()
+                    raise RuntimeError((os.linesep + '    ').join(['\'' + self.command + '\' exited in the middle of a batch:'] + errorLines))
+                self.errorBuffer += data
+                while b'\n' in self.errorBuffer:
+                    line, self.errorBuffer = self.errorBuffer.split(b'\n', 1)
+                    failedLineMatch = re.search(r'^Command failed \S+:(\d+)$', line.strip())
+                    if not failedLineMatch:
+                        errorLines.append(line.strip())
+                        continue
+                    failedLineNumber = int(failedLineMatch.group(1))
+                    if failedLineNumber == sentinelLineNumber:
+                        return failedLines
+                    if firstLineNumber <= failedLineNumber < sentinelLineNumber:
+                        failedLines[failedLineNumber - firstLineNumber] = errorLines + [line.strip()]
+                    errorLines = []
+
+    def close(self):
+        if self.subproc is None:
+            return
+        if self.subproc.poll() is None:
+            self.subproc.kill()
+            self.subproc.wait()
+        self.subproc.stdin.close()
+        self.subproc.stderr.close()
+        self.subproc = None
@@ -3,210 +3,671 @@
 
 import os
 import re
-from time import sleep
-
-from BashCommand import BashCommand, TimedBashCommand, TimeoutException
-from IpsecManagerUtilityMethods import writeToFileFromTemplate, removeLinesFromFile, interfaceExists, getMacAddr, convertIpToHex
-from IpsecManagerErrorHandlers import ipRouteAddStderrHandler
-
+import shutil
+import threading
+from collections import OrderedDict
+from time import time
+
+from BashCommand import BashCommand, CallableCommand
+from IpsecManagerUtilityMethods import writeToFileFromTemplate, removeFileIfExists, getFileStamp, convertIpToHex, getPrefix, getCanonicalSubnet, getFirstHostIp, getFlowCookie, getArpSpoofedDestIp, getArpSpoofedDestIps, ipForwardingFlowKind, arpSpoofingFlowKind
+from IpsecManagerTunnelStore import MonolithicTunnelStore, FragmentTunnelStore, migrateTunnelsToFragments, joinLinesWithIncludeLine
+from IpsecManagerPrefixTrie import TunnelOverlapIndex
+from IpsecManagerLinkBackends import createLinkBackend
+from IpsecManagerStrongswanBackends import createStrongswanBackend, CharonInstance, defaultCharonDaemonName
+from IpsecManagerVici import defaultViciSocketFilename
+from IpsecManagerReconciler import getGatewayFlows, computeReconcilePlan, auditFlowCookies, getDumpedFlowDeletion
+from IpsecManagerTunnelStatus import getTunnelStatuses
+from IpsecManagerTracing import tracedOperation
+from IpsecManagerJournal import OperationJournal
+
+# The seconds that a query of strongswan's tunnel statuses is shared for (see tunnelStatus)
+defaultTunnelStatusTtl = 2
+
+# Manages a single gateway: the default one, or the named gateway gatewayName (see useGatewayDirectory)
 class IpsecManager(object):
-    def __init__(self):
-        self.gatewayConfFilename  = '/etc/ipsecManager/gateway.conf'
-        self.ipsecConfFilename    = '/etc/strongswan/ipsec.conf'
-        self.ipsecSecretsFilename = '/etc/strongswan/ipsec.secrets'
-        self.gatewayOvsPort       = 'veth_ovs'
-        self.gatewayInterfaceName = 'veth_ipsec'
-        self.ipsecConfTitleLine   = '### IpsecManager Tunnels ###'
-        templateDirectory         = 'templates/'
-        self.gatewayTemplate      = templateDirectory + 'gateway.template'
-        self.ipsecConfTemplate    = templateDirectory + 'ipsec.conf.template'
-        self.ipsecSecretsTemplate = templateDirectory + 'ipsec.secrets.template'
+    def __init__(self, gatewayName = None, gatewaysDirectory = '/etc/ipsecManager/gateways', strongswanBackendName = None):
+        self.gatewayName            = gatewayName
+        self.strongswanBackendName  = strongswanBackendName
+        self.gatewayDirectory       = None
+        self.gatewayConfFilename    = '/etc/ipsecManager/gateway.conf'
+        self.ipsecConfFilename      = '/etc/strongswan/ipsec.conf'
+        self.ipsecSecretsFilename   = '/etc/strongswan/ipsec.secrets'
+        self.confFragmentDir        = '/etc/strongswan/ipsec.d/ipsecManager'
+        self.secretsFragmentDir     = '/etc/strongswan/secrets.d/ipsecManager'
+        self.registryFilename       = '/etc/ipsecManager/tunnels.registry'
+        self.journalDirectory       = '/etc/ipsecManager/journal'
+        self.strongswanConfFilename = None
+        self.viciSocketFilename     = defaultViciSocketFilename
+        self.strokeSocketFilename   = None
+        self.strongswanCommand      = 'strongswan'
+        self.charonDaemonName       = defaultCharonDaemonName
+        self.ipForwardingFilename   = '/proc/sys/net/ipv4/ip_forward'
+        self.gatewayOvsPort         = 'veth_ovs'
+        self.gatewayInterfaceName   = 'veth_ipsec'
+        self.ipsecConfTitleLine     = '### IpsecManager Tunnels ###'
+        self.flowCookiePrefix       = 0x15ec
+        templateDirectory           = 'templates/'
+        self.gatewayTemplate        = templateDirectory + 'gateway.template'
+        self.ipsecConfTemplate      = templateDirectory + 'ipsec.conf.template'
+        self.ipsecSecretsTemplate   = templateDirectory + 'ipsec.secrets.template'
+        self.strongswanConfTemplate = templateDirectory + 'strongswan.conf.template'
+        if gatewayName is not None:
+            self.useGatewayDirectory(os.path.join(gatewaysDirectory, gatewayName))
+        self.tunnelStore            = None
+        self.tunnelRegistry         = None
+        self.gatewayConf            = None
+        self.gatewayConfStamp       = None
+        self.linkBackend            = createLinkBackend()
+        self.charonInstance         = CharonInstance(self.strongswanCommand, self.charonDaemonName, self.strongswanConfFilename, self.ipsecConfFilename)
+        self.strongswanBackend      = createStrongswanBackend(self.strongswanBackendName, viciSocketFilename=self.viciSocketFilename, secretsTemplateFilename=self.ipsecSecretsTemplate,
+                                                          strongswanCommand=self.strongswanCommand, charonInstance=self.charonInstance)
+        self.tunnelUpTimeout        = 5
+        self.maxConcurrentUps       = 32
+        self.tunnelStatusTtl        = defaultTunnelStatusTtl
+        self.statusAllRecords       = None
+        self.statusAllTime          = None
+        self.statusAllLock          = threading.Lock()
+        self.selectTunnelStore()
+
+    # A named gateway keeps its gateway.conf, strongswan configuration and registry in a directory of its own, and has a veth pair of its own
+    # (ovs_<name> and ipsec_<name>). Its charon instance is controlled with the gateway's strongswan.conf, so it listens on its own stroke and VICI sockets,
+    # and runs under a daemon name of its own (charon-<name>), so its starter and pid files are its own (see CharonInstance)
+    def useGatewayDirectory(self, gatewayDirectory):
+        self.gatewayDirectory       = gatewayDirectory
+        self.gatewayConfFilename    = os.path.join(gatewayDirectory, 'gateway.conf')
+        self.ipsecConfFilename      = os.path.join(gatewayDirectory, 'ipsec.conf')
+        self.ipsecSecretsFilename   = os.path.join(gatewayDirectory, 'ipsec.secrets')
+        self.confFragmentDir        = os.path.join(gatewayDirectory, 'ipsec.d')
+        self.secretsFragmentDir     = os.path.join(gatewayDirectory, 'secrets.d')
+        self.registryFilename       = os.path.join(gatewayDirectory, 'tunnels.registry')
+        self.strongswanConfFilename = os.path.join(gatewayDirectory, 'strongswan.conf')
+        self.viciSocketFilename     = '/var/run/charon.' + self.gatewayName + '.vici'
+        self.strokeSocketFilename   = '/var/run/charon.' + self.gatewayName + '.ctl'
+        self.strongswanCommand      = 'env STRONGSWAN_CONF=' + self.strongswanConfFilename + ' strongswan'
+        self.charonDaemonName       = 'charon-' + self.gatewayName
+        self.gatewayOvsPort         = 'ovs_' + self.gatewayName
+        self.gatewayInterfaceName   = 'ipsec_' + self.gatewayName
+
+    # Tunnels are kept in per-tunnel fragments once they have been migrated to them (i.e. once the fragment directory exists),
+    # and in ipsec.conf's and ipsec.secrets' IpsecManager sections otherwise
+    # Must be called again after the files' locations are changed
+    def selectTunnelStore(self):
+        if os.path.isdir(self.confFragmentDir):
+            self.tunnelStore = FragmentTunnelStore(self.confFragmentDir, self.secretsFragmentDir, self.ipsecConfTemplate, self.ipsecSecretsTemplate, self.registryFilename)
+        else:
+            self.tunnelStore = MonolithicTunnelStore(self.ipsecConfFilename, self.ipsecSecretsFilename, self.ipsecConfTitleLine, self.ipsecConfTemplate, self.ipsecSecretsTemplate, self.registryFilename)
+        self.tunnelRegistry = self.tunnelStore.registry
 
     # Creates infrastructure for a new transparent IPSEC Gateway with the given ip address, which will be synchronized with the given OVS bridge.
+    # The creation is journaled (see IpsecManagerJournal), and is rolled back if any of its steps fails
+    @tracedOperation
     def createIpsecGateway(self, ovsBridge, gatewayIp):
-        if interfaceExists(self.gatewayInterfaceName):
+        if self.linkBackend.interfaceExists(self.gatewayInterfaceName):
             raise RuntimeError('A gateway already exists')
 
-        gatewayCreationCommands = [BashCommand('ip link add ' + self.gatewayOvsPort + ' type veth peer name ' + self.gatewayInterfaceName, 'ip link delete ' + self.gatewayOvsPort),
-                                   BashCommand('ovs-vsctl add-port ' + ovsBridge + ' ' + self.gatewayOvsPort, 'ovs-vsctl del-port ' + ovsBridge + ' ' + self.gatewayOvsPort),
-                                   BashCommand('ip link set ' + self.gatewayOvsPort + ' up'),
-                                   BashCommand('ip link set ' + self.gatewayInterfaceName + ' up'),
-                                   BashCommand('echo 1 > /proc/sys/net/ipv4/ip_forward'),
-                                   BashCommand('ip addr add ' + gatewayIp + ' dev ' + self.gatewayInterfaceName),
-                                   BashCommand('strongswan start', 'strongswan stop')]
-
-        for index, command in enumerate(gatewayCreationCommands):
-            try:
-#                 command.announce()
-                command.execute()
-            except BaseException as e:
-                for completedCommand in reversed(gatewayCreationCommands[:index]):
-                    completedCommand.undo()
-                sleep(1)
-                raise RuntimeError((os.linesep + '    ').join(['Failed to execute \'' + command.command + '\':'] + str(e).split(os.linesep)))
-
+        gatewayCreationSteps = [(CallableCommand('ip link add ' + self.gatewayOvsPort + ' type veth peer name ' + self.gatewayInterfaceName, lambda: self.linkBackend.addVethPair(self.gatewayOvsPort, self.gatewayInterfaceName)), ['deleteLink', self.gatewayOvsPort]),
+                                (BashCommand('ovs-vsctl add-port ' + ovsBridge + ' ' + self.gatewayOvsPort), ['deleteOvsPort', ovsBridge, self.gatewayOvsPort]),
+                                (CallableCommand('ip link set ' + self.gatewayOvsPort + ' up', lambda: self.linkBackend.setLinkUp(self.gatewayOvsPort)), None),
+                                (CallableCommand('ip link set ' + self.gatewayInterfaceName + ' up', lambda: self.linkBackend.setLinkUp(self.gatewayInterfaceName)), None),
+                                (BashCommand('echo 1 > ' + self.ipForwardingFilename), None),
+                                (CallableCommand('ip addr add ' + gatewayIp + ' dev ' + self.gatewayInterfaceName, lambda: self.linkBackend.addAddress(self.gatewayInterfaceName, gatewayIp)), None),
+                                (CallableCommand('start ' + self.charonDaemonName, self.charonInstance.start), ['stopStrongswan']),
+                                (CallableCommand('write ' + self.gatewayConfFilename, lambda: self.writeGatewayConf(ovsBridge, gatewayIp)), ['removeFile', self.gatewayConfFilename])]
+        if self.gatewayDirectory is not None:
+            gatewayCreationSteps.insert(0, (CallableCommand('create ' + self.gatewayDirectory, self.createGatewayDirectory), ['removeGatewayDirectory']))
+
+        operation = self.beginOperation('createIpsecGateway')
+        self.executeJournaledSteps(operation, gatewayCreationSteps)
+        operation.close()
+
+    # Writes gateway.conf, and adds the IpsecManager section's title line to ipsec.conf (which is left in place when the gateway is destroyed)
+    def writeGatewayConf(self, ovsBridge, gatewayIp):
         if not os.path.exists('/'.join(self.gatewayConfFilename.split('/')[:-1])):
             os.makedirs('/'.join(self.gatewayConfFilename.split('/')[:-1]))
 
         writeToFileFromTemplate(self.gatewayTemplate, open(self.gatewayConfFilename, 'w'), {'GATEWAY_IP'  : gatewayIp,
-                                                                                            'GATEWAY_MAC' : getMacAddr(self.gatewayInterfaceName),
+                                                                                            'GATEWAY_MAC' : self.linkBackend.getMacAddress(self.gatewayInterfaceName),
                                                                                             'OVS_BRIDGE'  : ovsBridge})
         if not re.search(r'^' + self.ipsecConfTitleLine + r'$', open(self.ipsecConfFilename, 'r').read(), re.MULTILINE):
             open(self.ipsecConfFilename, 'a').write(os.linesep + self.ipsecConfTitleLine + os.linesep)
 
     # Removes an existing transparent IPSEC Gateway, and removes any IPSEC tunnels associated with it
+    # The destruction is journaled, and is completed on recovery if it is interrupted
+    @tracedOperation
     def destroyIpsecGateway(self):
-        if not interfaceExists(self.gatewayInterfaceName):
+        if not self.linkBackend.interfaceExists(self.gatewayInterfaceName):
             raise RuntimeError('There is no local gateway')
 
-        for tunnelName in self.getIpsecTunnelNames():
-            self.removeIpsecTunnel(tunnelName)
-
-        BashCommand('ovs-vsctl del-port ' + self.getOvsBridgeFromGatewayConf() + ' ' + self.gatewayOvsPort).execute()
-        BashCommand('ip link delete ' + self.gatewayOvsPort).execute()
-        BashCommand('strongswan stop').execute()
-        os.remove(self.gatewayConfFilename)
-
-    # Adds a new transparent IPSEC tunnel, from the given source ip address to the given destination ip address, with the given ids
+        ovsBridge = self.getOvsBridgeFromGatewayConf()
+        self.executeRedoableOperation('destroyIpsecGateway', ['destroyGateway', ovsBridge], lambda: self.destroyGateway(ovsBridge))
+
+    # Removes the gateway's tunnels, its OVS port, its veth pair, its charon instance and its files. Each stage may be repeated,
+    # so an interrupted destruction is completed by applying it again (see recoverOperation)
+    def destroyGateway(self, ovsBridge, recovering=False):
+        tunnels = [tunnel[:3] for tunnel in self.tunnelRegistry.getTunnels()]
+        if tunnels:
+            self.applyTunnelRemoval(ovsBridge, tunnels, recovering)
+
+        self.deleteOvsPort(ovsBridge, self.gatewayOvsPort)
+        self.deleteLinkIfExists(self.gatewayOvsPort)
+        self.stopStrongswan()
+        if self.gatewayDirectory is not None:
+            self.removeGatewayDirectory()
+        else:
+            removeFileIfExists(self.gatewayConfFilename)
+
+    # Writes a named gateway's strongswan.conf, and an ipsec.conf and ipsec.secrets that include the gateway's tunnel fragments,
+    # so the tunnels of a named gateway are kept in fragments from the start
+    def createGatewayDirectory(self):
+        fragmentTunnelStore = FragmentTunnelStore(self.confFragmentDir, self.secretsFragmentDir, self.ipsecConfTemplate, self.ipsecSecretsTemplate, self.registryFilename)
+        fragmentTunnelStore.createFragmentDirectories()
+        writeToFileFromTemplate(self.strongswanConfTemplate, open(self.strongswanConfFilename, 'w'), {'GATEWAY_NAME'      : self.gatewayName,
+                                                                                                      'GATEWAY_INTERFACE' : self.gatewayInterfaceName,
+                                                                                                      'STROKE_SOCKET'     : self.strokeSocketFilename,
+                                                                                                      'VICI_SOCKET'       : self.viciSocketFilename})
+        for filename, includeLine in [(self.ipsecConfFilename, fragmentTunnelStore.getConfIncludeLine()), (self.ipsecSecretsFilename, fragmentTunnelStore.getSecretsIncludeLine())]:
+            lines = open(filename).readlines() if os.path.exists(filename) else []
+            open(filename, 'w').write(joinLinesWithIncludeLine(lines, includeLine))
+        self.selectTunnelStore()
+
+    # Adds a new transparent IPSEC tunnel, from the given source ip address (or subnet) to the given destination ip address (or subnet), with the given ids
+    # The addition is journaled (see IpsecManagerJournal), and is rolled back if any of its steps fails, or if the tunnel fails to come up
+    @tracedOperation
     def addIpsecTunnel(self, name, sourceIp, destIp, remoteGateway, localId, remoteId):
-        if not interfaceExists(self.gatewayInterfaceName):
+        if not self.linkBackend.interfaceExists(self.gatewayInterfaceName):
             raise RuntimeError('There is no local gateway')
 
-        for currentTunnelName, currentSourceIp, currentDestIp in self.listIpsecTunnels():
-            if name == currentTunnelName:
-                raise RuntimeError('A tunnel named ' + name + ' already exists')
-            if sourceIp == currentSourceIp and destIp == currentDestIp:
-                raise RuntimeError('A tunnel from ' + sourceIp + ' to ' + destIp + ' already exists')
+        if self.tunnelRegistry.getTunnel(name):
+            raise RuntimeError('A tunnel named ' + name + ' already exists')
+        overlappingTunnels = self.tunnelRegistry.getOverlappingTunnels(sourceIp, destIp)
+        if overlappingTunnels:
+            raise RuntimeError(self.getOverlapError(sourceIp, destIp, overlappingTunnels[0]))
+        nestedSourceTunnels = self.tunnelRegistry.getNestedSourceTunnels(sourceIp)
+        if nestedSourceTunnels:
+            raise RuntimeError(self.getNestedSourceError(sourceIp, destIp, nestedSourceTunnels[0]))
 
-        localGatewayIp = self.getLocalGatewayIpFromGatewayConf()
         ovsBridge = self.getOvsBridgeFromGatewayConf()
         localGatewayMacAddress = self.getLocalGatewayMacAddressFromGatewayConf()
+        localGatewayIp = self.getLocalGatewayIpFromGatewayConf()
+        tunnel = (name, sourceIp, destIp, remoteGateway, localId, remoteId)
+        # The ARP spoofing flow and the route of a source ip that other tunnels use are theirs as well, so undoing the tunnel restores its ARP spoofing flow, and keeps its route:
+        sharingTunnels = self.tunnelRegistry.getTunnelsBySourceIp(sourceIp)
+        sharingDestIps = [sharingTunnel[2] for sharingTunnel in sharingTunnels]
+        undoFlows = ['delete ' + self.getIpForwardingFlowDeletion(sourceIp, destIp), 'add ' + self.getArpIpSpoofingFlow(sourceIp, getArpSpoofedDestIp(sharingDestIps)) if sharingTunnels else 'delete ' + self.getArpIpSpoofingFlowDeletion(sourceIp)]
 
         # Update the strongswan configuration files:
-        writeToFileFromTemplate(self.ipsecConfTemplate, open(self.ipsecConfFilename, 'a'), {'LOCAL_GATEWAY_IP'  : localGatewayIp,
-                                                                                            'REMOTE_GATEWAY_IP' : remoteGateway,
-                                                                                            'SOURCE_IP'         : sourceIp,
-                                                                                            'DEST_IP'           : destIp,
-                                                                                            'LOCAL_ID'          : localId,
-                                                                                            'REMOTE_ID'         : remoteId,
-                                                                                            'TUNNEL_NAME'       : name})
-        writeToFileFromTemplate(self.ipsecSecretsTemplate, open(self.ipsecSecretsFilename, 'a'), {'LOCAL_ID'    : localId,
-                                                                                                  'REMOTE_ID'   : remoteId,
-                                                                                                  'TUNNEL_NAME' : name})
-
-        # Add an openFlow rule to forward packets coming from the sourceIp to the IPSEC module, via the gateway interface veth-pair:
-        BashCommand('ovs-ofctl add-flow ' + ovsBridge + ' table=0,ip,nw_src=' + sourceIp + ',nw_dst=' + destIp + ',action=mod_dl_dst:' + localGatewayMacAddress + ',' + self.gatewayOvsPort).execute()
-        # Add an openFlow rule to respond to spoof ARP requests coming from the gateway interface directed at the sourceIp to have appear as if they were generated from the destIp:
-        BashCommand(self.getArpIpSpoofingRule(ovsBridge, sourceIp, destIp)).execute()
+        tunnelAdditionSteps = [(CallableCommand('write the configuration of tunnel ' + name, lambda: self.writeTunnelsToIpsecFiles([tunnel])), ['removeTunnelsFromIpsecFiles', [name]])]
+        # Add, in a single bundle, an openFlow rule to forward packets coming from the sourceIp to the IPSEC module, via the gateway interface veth-pair,
+        # and an openFlow rule to respond to spoof ARP requests coming from the gateway interface directed at the sourceIp to have appear as if they were generated from the destIp
+        # (or from the destination of another tunnel that shares the sourceIp, see getArpSpoofedDestIp):
+        flows = ['add ' + self.getIpForwardingFlow(sourceIp, destIp, localGatewayMacAddress), 'add ' + self.getArpIpSpoofingFlow(sourceIp, getArpSpoofedDestIp(sharingDestIps + [destIp]))]
+        tunnelAdditionSteps.append((CallableCommand('ovs-ofctl --bundle add-flows ' + ovsBridge, lambda: self.applyFlowBundle(ovsBridge, flows)), ['applyFlows', ovsBridge, undoFlows]))
         # Add an entry to the routing table, allowing the IPSEC module to forward packets to the source IP via the gateway interface:
-        BashCommand('ip route add ' + sourceIp + '/32 via 0.0.0.0 dev ' + self.gatewayInterfaceName, errorHandler=ipRouteAddStderrHandler).execute()
-        # Update strongswan based on the newly written configuration files:
-        BashCommand('strongswan update').execute()
-        BashCommand('strongswan secrets').execute()
+        tunnelAdditionSteps.append((CallableCommand('ip route add ' + getPrefix(sourceIp) + ' via 0.0.0.0 dev ' + self.gatewayInterfaceName, lambda: self.linkBackend.addRoutes([getPrefix(sourceIp)], self.gatewayInterfaceName)),
+                                    None if sharingTunnels else ['deleteRoutes', [getPrefix(sourceIp)]]))
+        # Load the new tunnel into strongswan:
+        tunnelAdditionSteps.append((CallableCommand('load tunnel ' + name + ' into strongswan', lambda: self.strongswanBackend.updateTunnels([tunnel], [], localGatewayIp)), ['unloadTunnels', [name]]))
+
+        operation = self.beginOperation('addIpsecTunnel')
+        self.executeJournaledSteps(operation, tunnelAdditionSteps)
         # Raise the new tunnel:
-        upCommand = TimedBashCommand('strongswan up ' + name, timeout=5)
         try:
-            upCommand.execute()
-        except TimeoutException:
+            upResult, upOutput = self.strongswanBackend.upTunnel(name, self.tunnelUpTimeout)
+        except BaseException as e:
+            self.abortOperation(operation, (os.linesep + '    ').join(['Failed to raise tunnel \'' + name + '\':'] + str(e).split(os.linesep)), not isinstance(e, Exception))
+        if upResult not in ['established', 'unreachable', 'auth failed']:
+            self.abortOperation(operation, 'Failed to set up the tunnel' + os.linesep + (os.linesep + '    ').join(['strongswan up ' + name + '\'s output:'] + upOutput.split(os.linesep)))
+        operation.close()
+        if upResult == 'unreachable':
             raise RuntimeError('Tunnel \'' + name + '\' is set up locally, but the remote gateway couldn\'t be reached')
-        if 'connection \'' + name + '\' established successfully' not in upCommand.output:
-            if 'AUTHENTICATION_FAILED' in upCommand.output or 'NO_PROPOSAL_CHOSEN' in upCommand.output:
-                raise RuntimeError('Tunnel \'' + name + '\' is set up, but the connection couldn\'t be authenticated on the other side')
-            else:
-                self.removeIpsecTunnel(name)
-                raise RuntimeError('Failed to set up the tunnel' + os.linesep + (os.linesep + '    ').join(['strongswan up ' + name + '\'s output:'] + upCommand.output.split(os.linesep)))
+        elif upResult == 'auth failed':
+            raise RuntimeError('Tunnel \'' + name + '\' is set up, but the connection couldn\'t be authenticated on the other side')
 
     # Removes a transparent IPSEC tunnel with the given name
+    # The removal is journaled, and is completed on recovery if it is interrupted
+    @tracedOperation
     def removeIpsecTunnel(self, name):
-        def secretsLineMatchesTunnel(line):
-            return bool(re.search(r'# ' + name + r'$', line))
+        tunnel = self.tunnelRegistry.getTunnel(name)
+        if not tunnel:
+            raise RuntimeError('No tunnel named ' + name + ' exists')
 
-        def confLineStartsTunnel(line):
-            return bool(re.search(r'^conn ' + name + r'$', line))
+        ovsBridge = self.getOvsBridgeFromGatewayConf()
+        self.executeRedoableOperation('removeIpsecTunnel', ['removeTunnels', ovsBridge, [tunnel[:3]]], lambda: self.applySingleTunnelRemoval(ovsBridge, tunnel[:3]))
 
-        def confLineStartsNextTunnel(line):
-            return bool(re.search(r'^conn \S', line)) and not confLineStartsTunnel(line)
+    # Removes a single tunnel, given as a (name, sourceIp, destIp) tuple, with a command per stage
+    def applySingleTunnelRemoval(self, ovsBridge, tunnel):
+        name, sourceIp, destIp = tunnel
+        self.removeTunnelsFromIpsecFiles([name])
+        self.strongswanBackend.updateTunnels([], [name])
 
-        if name not in self.getIpsecTunnelNames():
-            raise RuntimeError('No tunnel named ' + name + ' exists')
+        if self.anotherTunnelSharesSourceIp(name, sourceIp):
+            # The source ip's ARP spoofing flow is shared with its other tunnels, so it is replaced with theirs rather than deleted:
+            alternateDestIp = getArpSpoofedDestIp([tunnel[2] for tunnel in self.tunnelRegistry.getTunnelsBySourceIp(sourceIp) if tunnel[0] != name])
+            self.applyFlowBundle(ovsBridge, ['delete ' + self.getIpForwardingFlowDeletion(sourceIp, destIp), 'add ' + self.getArpIpSpoofingFlow(sourceIp, alternateDestIp)])
+        else:
+            self.applyFlowBundle(ovsBridge, ['delete ' + self.getIpForwardingFlowDeletion(sourceIp, destIp), 'delete ' + self.getArpIpSpoofingFlowDeletion(sourceIp)])
+            self.linkBackend.deleteRoutes([getPrefix(sourceIp)])
+
+    # Raises many existing transparent IPSEC tunnels concurrently, by their names. Each tunnel is a tuple whose first field is the tunnel's name
+    # Returns a list with a (name, result) tuple per tunnel, the result being one of 'established', 'auth failed', 'unreachable' or 'failed'
+    @tracedOperation
+    def upIpsecTunnels(self, tunnels):
+        names = list(OrderedDict((tunnel[0], None) for tunnel in tunnels))
+        missingNames = [name for name in names if not self.tunnelRegistry.getTunnel(name)]
+        if missingNames:
+            raise RuntimeError((os.linesep + '    ').join(['No tunnels were raised:'] + ['No tunnel named ' + name + ' exists' for name in missingNames]))
+
+        return self.strongswanBackend.upTunnels(names, self.tunnelUpTimeout, self.maxConcurrentUps)
+
+    # Raises all the transparent IPSEC tunnels concurrently, as upIpsecTunnels does
+    @tracedOperation
+    def upAllIpsecTunnels(self):
+        return self.upIpsecTunnels(self.listIpsecTunnels())
+
+    # Adds many transparent IPSEC tunnels at once. Each tunnel is a tuple holding addIpsecTunnel's parameters
+    # All the tunnels are validated before anything is applied, and every stage is applied to all of them with a single command:
+    # one write per configuration file, one OpenFlow bundle, one batch of routes and a single strongswan update.
+    # The tunnels are loaded into strongswan, but are not raised (upIpsecTunnels raises them concurrently)
+    # The addition is journaled, and is rolled back if any of its stages fails
+    @tracedOperation
+    def addIpsecTunnels(self, tunnels):
+        if not self.linkBackend.interfaceExists(self.gatewayInterfaceName):
+            raise RuntimeError('There is no local gateway')
+
+        errors = self.getTunnelConflicts(tunnels, checkExistingTunnels=True)
+        if errors:
+            raise RuntimeError((os.linesep + '    ').join(['No tunnels were added:'] + errors))
+        # As with addIpsecTunnel, the ARP spoofing flows of the source ips that existing tunnels use are restored when the addition is undone, and their routes are kept:
+        sharingTunnels = [sharingTunnel for sourceIp in OrderedDict((tunnel[1], None) for tunnel in tunnels) for sharingTunnel in self.tunnelRegistry.getTunnelsBySourceIp(sourceIp)]
+        existingArpSpoofedDestIps = getArpSpoofedDestIps(sharingTunnels)
 
         ovsBridge = self.getOvsBridgeFromGatewayConf()
-        sourceIp  = self.getSourceIpFromIpsecConf(name)
-        destIp    = self.getDestIpFromIpsecConf(name)
+        localGatewayMacAddress = self.getLocalGatewayMacAddressFromGatewayConf()
+        localGatewayIp = self.getLocalGatewayIpFromGatewayConf()
+        names = [tunnel[0] for tunnel in tunnels]
+
+        # As with addIpsecTunnel, the ARP spoofing rule of a source ip is taken from all the tunnels that use it (see getArpSpoofedDestIp):
+        arpSpoofedDestIps = getArpSpoofedDestIps(sharingTunnels + list(tunnels))
+        flows = ['add ' + self.getIpForwardingFlow(sourceIp, destIp, localGatewayMacAddress) for _, sourceIp, destIp, _, _, _ in tunnels]
+        flows += ['add ' + self.getArpIpSpoofingFlow(sourceIp, destIp) for sourceIp, destIp in arpSpoofedDestIps.items()]
+        routes = [getPrefix(sourceIp) for sourceIp in arpSpoofedDestIps if sourceIp not in existingArpSpoofedDestIps]
+        undoFlows = ['delete ' + self.getIpForwardingFlowDeletion(sourceIp, destIp) for _, sourceIp, destIp, _, _, _ in tunnels]
+        undoFlows += ['add ' + self.getArpIpSpoofingFlow(sourceIp, existingArpSpoofedDestIps[sourceIp]) if sourceIp in existingArpSpoofedDestIps else 'delete ' + self.getArpIpSpoofingFlowDeletion(sourceIp) for sourceIp in arpSpoofedDestIps]
+
+        operation = self.beginOperation('addIpsecTunnels')
+        # Update the strongswan configuration files, apply the flows and the routes, and load the new tunnels into strongswan:
+        self.executeJournaledSteps(operation, [(CallableCommand('write the configuration of ' + str(len(tunnels)) + ' tunnels', lambda: self.writeTunnelsToIpsecFiles(tunnels)), ['removeTunnelsFromIpsecFiles', names]),
+                                               (CallableCommand('ovs-ofctl --bundle add-flows ' + ovsBridge, lambda: self.applyFlowBundle(ovsBridge, flows)), ['applyFlows', ovsBridge, undoFlows]),
+                                               (CallableCommand('add ' + str(len(routes)) + ' routes via ' + self.gatewayInterfaceName, lambda: self.linkBackend.addRoutes(routes, self.gatewayInterfaceName)), ['deleteRoutes', routes]),
+                                               (CallableCommand('load ' + str(len(tunnels)) + ' tunnels into strongswan', lambda: self.strongswanBackend.updateTunnels(tunnels, [], localGatewayIp)), ['unloadTunnels', names])])
+        operation.close()
+
+    # Removes many transparent IPSEC tunnels at once, by their names. Each tunnel is a tuple whose first field is the tunnel's name
+    # The removal is journaled, and is completed on recovery if it is interrupted
+    @tracedOperation
+    def removeIpsecTunnels(self, tunnels):
+        names = set(tunnel[0] for tunnel in tunnels)
+        missingNames = [name for name in names if not self.tunnelRegistry.getTunnel(name)]
+        if missingNames:
+            raise RuntimeError((os.linesep + '    ').join(['No tunnels were removed:'] + ['No tunnel named ' + name + ' exists' for name in sorted(missingNames)]))
 
-        removeLinesFromFile(self.ipsecSecretsFilename, secretsLineMatchesTunnel, lambda line: not secretsLineMatchesTunnel(line))
-        removeLinesFromFile(self.ipsecConfFilename, confLineStartsTunnel, confLineStartsNextTunnel)
+        ovsBridge = self.getOvsBridgeFromGatewayConf()
+        removedTunnels = [self.tunnelRegistry.getTunnel(tunnelName)[:3] for tunnelName in OrderedDict((tunnel[0], None) for tunnel in tunnels)]
+        self.executeRedoableOperation('removeIpsecTunnels', ['removeTunnels', ovsBridge, removedTunnels], lambda: self.applyTunnelRemoval(ovsBridge, removedTunnels))
+
+    # Removes the tunnels, given as (name, sourceIp, destIp) tuples, from the tunnel store, strongswan, the bridge's flows and the routing table
+    # Every stage may be repeated, so an interrupted removal is completed by applying it again, in which case only the routes that still exist are deleted
+    def applyTunnelRemoval(self, ovsBridge, removedTunnels, recovering=False):
+        # Source ips are grouped in their canonical form, so two forms of a shared source ip are never taken for two source ips:
+        removedTunnels = [(tunnelName, getCanonicalSubnet(sourceIp), getCanonicalSubnet(destIp)) for tunnelName, sourceIp, destIp in removedTunnels]
+        names = set(tunnelName for tunnelName, _, _ in removedTunnels)
+        remainingDestIps = getArpSpoofedDestIps([tunnel for sourceIp in OrderedDict((sourceIp, None) for _, sourceIp, _ in removedTunnels)
+                                                 for tunnel in self.tunnelRegistry.getTunnelsBySourceIp(sourceIp) if tunnel[0] not in names])
+
+        self.removeTunnelsFromIpsecFiles(names)
+        self.strongswanBackend.updateTunnels([], [tunnelName for tunnelName, _, _ in removedTunnels])
+
+        removedSourceIps = OrderedDict((sourceIp, None) for _, sourceIp, _ in removedTunnels)
+        flows = ['delete ' + self.getIpForwardingFlowDeletion(sourceIp, destIp) for _, sourceIp, destIp in removedTunnels]
+        flows += ['delete ' + self.getArpIpSpoofingFlowDeletion(sourceIp) for sourceIp in removedSourceIps if sourceIp not in remainingDestIps]
+        # Source ips that are still used by other tunnels keep spoofing ARP replies for them (see getArpSpoofedDestIp), and keep their route:
+        flows += ['add ' + self.getArpIpSpoofingFlow(sourceIp, remainingDestIps[sourceIp]) for sourceIp in removedSourceIps if sourceIp in remainingDestIps]
+        routes = [getPrefix(sourceIp) for sourceIp in removedSourceIps if sourceIp not in remainingDestIps]
+        if recovering:
+            existingRoutes = set(self.linkBackend.getRoutes(self.gatewayInterfaceName))
+            routes = [prefix for prefix in routes if prefix in existingRoutes]
+
+        self.applyFlowBundle(ovsBridge, flows)
+        self.linkBackend.deleteRoutes(routes)
+
+    # Converges the gateway into the desired tunnels, each being a tuple holding addIpsecTunnel's parameters
+    # The actual state is read from ipsec.conf, the gateway bridge's flows and the gateway interface's routes, and only the difference between
+    # the two is applied, in a single batched pass. Returns the plan of changes, which is only computed (and not applied) on a dry run
+    # Tunnels that are added or modified are loaded into strongswan, but are not raised (upIpsecTunnels raises them concurrently)
+    @tracedOperation
+    def reconcile(self, desiredTunnels, dryRun=False):
+        if not self.linkBackend.interfaceExists(self.gatewayInterfaceName):
+            raise RuntimeError('There is no local gateway')
 
-        BashCommand('strongswan update').execute()
-        BashCommand('strongswan secrets').execute()
-        BashCommand('strongswan down ' + name).execute()
+        errors = self.getTunnelConflicts(desiredTunnels, checkExistingTunnels=False)
+        if errors:
+            raise RuntimeError((os.linesep + '    ').join(['The desired state is inconsistent:'] + errors))
 
-        BashCommand('ovs-ofctl del-flows ' + ovsBridge + ' table=0,ip,nw_src=' + sourceIp + ',nw_dst=' + destIp).execute()
-        BashCommand('ovs-ofctl del-flows ' + ovsBridge + ' table=0,arp,nw_dst=' + sourceIp + ',in_port=' + self.gatewayOvsPort).execute()
+        ovsBridge = self.getOvsBridgeFromGatewayConf()
+        localGatewayMacAddress = self.getLocalGatewayMacAddressFromGatewayConf()
+        dumpFlowsCommand = BashCommand('ovs-ofctl --names --no-stats dump-flows ' + ovsBridge + ' table=0')
+        dumpFlowsCommand.execute()
+        ipFlows, arpFlows = getGatewayFlows(dumpFlowsCommand.output, self.gatewayOvsPort, self.flowCookiePrefix)
+        plan = computeReconcilePlan(desiredTunnels, self.tunnelRegistry.getTunnels(), ipFlows, arpFlows, self.linkBackend.getRoutes(self.gatewayInterfaceName), localGatewayMacAddress)
+        if dryRun or not any(plan.values()):
+            return plan
+
+        replacedTunnelNames = plan['tunnelsToRemove'] + [tunnel[0] for tunnel in plan['tunnelsToModify']]
+        if replacedTunnelNames:
+            self.removeTunnelsFromIpsecFiles(set(replacedTunnelNames))
+        if plan['tunnelsToModify'] or plan['tunnelsToAdd']:
+            self.writeTunnelsToIpsecFiles(plan['tunnelsToModify'] + plan['tunnelsToAdd'])
+        self.strongswanBackend.updateTunnels(plan['tunnelsToModify'] + plan['tunnelsToAdd'], replacedTunnelNames, self.getLocalGatewayIpFromGatewayConf())
+
+        flows = ['delete_strict table=0,ip,nw_src=' + sourceIp + ',nw_dst=' + destIp for sourceIp, destIp in plan['ipFlowsToDelete']]
+        flows += ['add ' + self.getIpForwardingFlow(sourceIp, destIp, localGatewayMacAddress) for sourceIp, destIp in plan['ipFlowsToAdd']]
+        flows += ['delete_strict table=0,arp,nw_dst=' + sourceIp + ',in_port=' + self.gatewayOvsPort for sourceIp in plan['arpFlowsToDelete']]
+        flows += ['add ' + self.getArpIpSpoofingFlow(sourceIp, destIp) for sourceIp, destIp in plan['arpFlowsToSet']]
+        self.applyFlowBundle(ovsBridge, flows)
+        self.linkBackend.deleteRoutes(plan['routesToDelete'])
+        self.linkBackend.addRoutes(plan['routesToAdd'], self.gatewayInterfaceName)
+        return plan
+
+    # Returns the errors of tunnels that share a name or overlapping endpoints with each other, or (optionally) with the existing tunnels
+    def getTunnelConflicts(self, tunnels, checkExistingTunnels):
+        tunnelNames = set()
+        tunnelOverlapIndex = TunnelOverlapIndex()
+        errors = []
+        for tunnel in tunnels:
+            name, sourceIp, destIp = tunnel[:3]
+            if name in tunnelNames or (checkExistingTunnels and self.tunnelRegistry.getTunnel(name)):
+                errors.append('A tunnel named ' + name + ' already exists')
+            overlappingTunnels = list(tunnelOverlapIndex.getOverlappingTunnels(sourceIp, destIp))
+            if checkExistingTunnels and not overlappingTunnels:
+                overlappingTunnels = self.tunnelRegistry.getOverlappingTunnels(sourceIp, destIp)
+            if overlappingTunnels:
+                errors.append(self.getOverlapError(sourceIp, destIp, overlappingTunnels[0]))
+            nestedSourceTunnels = list(tunnelOverlapIndex.getNestedSourceTunnels(sourceIp))
+            if checkExistingTunnels and not nestedSourceTunnels:
+                nestedSourceTunnels = self.tunnelRegistry.getNestedSourceTunnels(sourceIp)
+            if nestedSourceTunnels:
+                errors.append(self.getNestedSourceError(sourceIp, destIp, nestedSourceTunnels[0]))
+            tunnelNames.add(name)
+            tunnelOverlapIndex.add(tunnel)
+        return errors
+
+    # Tunnels may not overlap, since the packets that match both tunnels' flows would be forwarded by either one of them
+    def getOverlapError(self, sourceIp, destIp, overlappingTunnel):
+        overlappingTunnelName, overlappingSourceIp, overlappingDestIp = overlappingTunnel[:3]
+        if getPrefix(sourceIp) == getPrefix(overlappingSourceIp) and getPrefix(destIp) == getPrefix(overlappingDestIp):
+            return 'A tunnel from ' + sourceIp + ' to ' + destIp + ' already exists'
+        return 'A tunnel from ' + sourceIp + ' to ' + destIp + ' overlaps tunnel ' + overlappingTunnelName + ' (from ' + overlappingSourceIp + ' to ' + overlappingDestIp + ')'
+
+    # Source subnets are either the same or disjoint: the ARP spoofing flows of nested source subnets (e.g. 10.0.0.0/24 and 10.0.0.5) would overlap
+    # at the same priority, so OVS would spoof the ARP replies to the addresses they share from either tunnel's destination
+    def getNestedSourceError(self, sourceIp, destIp, nestedSourceTunnel):
+        nestedSourceTunnelName, nestedSourceIp, nestedDestIp = nestedSourceTunnel[:3]
+        return 'The source of a tunnel from ' + sourceIp + ' to ' + destIp + ' overlaps the source of tunnel ' + nestedSourceTunnelName + ' (from ' + nestedSourceIp + ' to ' + nestedDestIp + ')'
+
+    # Writes the entries of the given tunnels to the tunnel store (ipsec.conf and ipsec.secrets, or the tunnels' fragments)
+    def writeTunnelsToIpsecFiles(self, tunnels):
+        self.tunnelStore.writeTunnels(tunnels, self.getLocalGatewayIpFromGatewayConf())
+
+    # Removes the entries of the tunnels with the given names from the tunnel store
+    def removeTunnelsFromIpsecFiles(self, names):
+        self.tunnelStore.removeTunnels(names)
+
+    # Moves the existing tunnels from ipsec.conf and ipsec.secrets into per-tunnel fragments, which are added and removed without
+    # rewriting the other tunnels' configuration. strongswan's configuration is left unchanged, so it needn't be reloaded
+    # Returns the names of the migrated tunnels
+    @tracedOperation
+    def migrateTunnelsToFragments(self):
+        fragmentTunnelStore = FragmentTunnelStore(self.confFragmentDir, self.secretsFragmentDir, self.ipsecConfTemplate, self.ipsecSecretsTemplate, self.registryFilename)
+        migratedTunnelNames = migrateTunnelsToFragments(self.ipsecConfFilename, self.ipsecSecretsFilename, self.ipsecConfTitleLine, fragmentTunnelStore)
+        self.selectTunnelStore()
+        return migratedTunnelNames
+
+    # Compares the gateway bridge's flows with the tunnels' flows by their cookies, with a single dump-flows pass. Returns the orphaned flows (tagged with
+    # flowCookiePrefix, but belonging to no tunnel) and the missing ones, which are deleted and added (respectively) when garbageCollect is set
+    # Flows installed before flows were tagged are reported as missing, and garbage collecting replaces them with tagged ones
+    @tracedOperation
+    def auditFlows(self, garbageCollect=False):
+        if not self.linkBackend.interfaceExists(self.gatewayInterfaceName):
+            raise RuntimeError('There is no local gateway')
 
-        if self.anotherTunnelSharesSourceIp(name, sourceIp):
-            _, _, alternateDestIp = self.getTunnelThatSharesSourceIp(name, sourceIp)
-            BashCommand(self.getArpIpSpoofingRule(ovsBridge, sourceIp, alternateDestIp)).execute()
+        ovsBridge = self.getOvsBridgeFromGatewayConf()
+        localGatewayMacAddress = self.getLocalGatewayMacAddressFromGatewayConf()
+        tunnels = [tunnel[:3] for tunnel in self.tunnelRegistry.getTunnels()]
+        expectedFlows = OrderedDict((getFlowCookie(self.flowCookiePrefix, ipForwardingFlowKind, [sourceIp, destIp]), self.getIpForwardingFlow(sourceIp, destIp, localGatewayMacAddress)) for _, sourceIp, destIp in tunnels)
+        # As with addIpsecTunnels, the ARP spoofing flow of a source ip is taken from all the tunnels that use it:
+        arpSpoofedDestIps = getArpSpoofedDestIps(tunnels)
+        expectedFlows.update((getFlowCookie(self.flowCookiePrefix, arpSpoofingFlowKind, [sourceIp]), self.getArpIpSpoofingFlow(sourceIp, destIp)) for sourceIp, destIp in arpSpoofedDestIps.items())
+
+        dumpFlowsCommand = BashCommand('ovs-ofctl --names --no-stats dump-flows ' + ovsBridge + ' table=0')
+        dumpFlowsCommand.execute()
+        audit = auditFlowCookies(dumpFlowsCommand.output, expectedFlows, self.flowCookiePrefix, self.gatewayOvsPort)
+        if garbageCollect:
+            self.applyFlowBundle(ovsBridge, ['delete ' + getDumpedFlowDeletion(cookie, flow) for cookie, flow in audit['orphanedFlows']] +
+                                            ['add ' + flow for _, flow in audit['missingFlows']])
+        return audit
+
+    # Applies the given flow modifications ('add <flow>' / 'delete <match>') to the OVS bridge as a single atomic bundle, streamed into ovs-ofctl's stdin
+    def applyFlowBundle(self, ovsBridge, flows):
+        if not flows:
+            return
+        BashCommand('ovs-ofctl --bundle add-flows ' + ovsBridge + ' -', commandInput=''.join(flow + '\n' for flow in flows)).execute()
+
+    # Starts journaling an operation of this gateway (see IpsecManagerJournal)
+    def beginOperation(self, operationName, redo = None):
+        return OperationJournal(self.journalDirectory).begin(operationName, self.gatewayName, redo)
+
+    # Executes the steps of a journaled operation in order, each being a (command, undo) tuple: a BashCommand or a CallableCommand, and the undo action
+    # that reverts it (see applyUndoAction), or None. Each step is journaled before its command is executed, and once a command fails, the operation is
+    # rolled back, the failed step included (since it may have been partially applied), before the error is raised
+    def executeJournaledSteps(self, operation, steps):
+        for command, undo in steps:
+            operation.recordStep(command.command, undo)
+            try:
+                command.execute()
+            except BaseException as e:
+                self.abortOperation(operation, (os.linesep + '    ').join(['Failed to execute \'' + command.command + '\':'] + str(e).split(os.linesep)), not isinstance(e, Exception))
+
+    # Executes an operation whose every stage may be repeated, given as its redo action (see applyRedoAction) and the function that applies it
+    # The operation is kept in the journal if the function fails, and is completed on recovery
+    def executeRedoableOperation(self, operationName, redo, function):
+        operation = self.beginOperation(operationName, redo)
+        try:
+            function()
+        except BaseException:
+            operation.release()
+            raise
+        operation.close()
+
+    # Rolls the operation back and raises the error that stopped it, along with the steps that couldn't be undone
+    # An interruption (e.g. KeyboardInterrupt or SystemExit, which aren't Exceptions) is re-raised as it is once the operation is rolled back,
+    # which is why it's only called while the error is being handled. The steps that couldn't be undone are then left to recovery
+    def abortOperation(self, operation, errorMessage, interrupted = False):
+        undoErrors = self.rollBack(operation)
+        if interrupted:
+            raise
+        if undoErrors:
+            errorMessage += os.linesep + (os.linesep + '    ').join(['The rollback is incomplete, and is retried on recovery:'] + undoErrors)
+        raise RuntimeError(errorMessage)
+
+    # Applies the undo actions of the operation's steps that weren't undone yet, in reverse order, journaling each one once it is applied
+    # Steps that fail to be undone don't stop the rollback. The operation is removed from the journal once all of its steps are undone, and is kept
+    # (to be rolled back on recovery) otherwise. Returns the errors of the steps that couldn't be undone
+    def rollBack(self, operation):
+        undoErrors = []
+        for stepIndex in reversed(range(len(operation.steps))):
+            description, undo = operation.steps[stepIndex]
+            if undo is None or stepIndex in operation.undoneSteps:
+                continue
+            try:
+                self.applyUndoAction(undo)
+            except (RuntimeError, EnvironmentError) as e:
+                undoErrors.append('Failed to undo \'' + description + '\': ' + ' '.join(str(e).split(os.linesep)))
+                continue
+            operation.recordUndone(stepIndex)
+
+        if undoErrors:
+            operation.release()
         else:
-            BashCommand('ip route del ' + sourceIp + '/32').execute()
+            operation.close()
+        return undoErrors
+
+    # Completes an interrupted operation of this gateway by repeating its redo action, or rolls it back. Returns 'completed' or 'rolled back'
+    # An operation that can't be recovered is kept in the journal, and is recovered again the next time
+    def recoverOperation(self, operation):
+        if operation.redo is not None:
+            try:
+                self.applyRedoAction(operation.redo)
+            except (RuntimeError, EnvironmentError) as e:
+                operation.release()
+                raise RuntimeError((os.linesep + '    ').join(['Failed to complete the interrupted ' + operation.operationName + ' (journaled in ' + operation.filename + '):'] + str(e).split(os.linesep)))
+            operation.close()
+            return 'completed'
+
+        undoErrors = self.rollBack(operation)
+        if undoErrors:
+            raise RuntimeError((os.linesep + '    ').join(['Failed to roll back the interrupted ' + operation.operationName + ' (journaled in ' + operation.filename + '):'] + undoErrors))
+        return 'rolled back'
+
+    # Applies a journaled undo action, given as its name followed by its arguments
+    # Every undo action runs synchronously, may be applied again (when a rollback is retried on recovery), and raises an error unless its step is undone
+    def applyUndoAction(self, undo):
+        undoActions = {'removeGatewayDirectory'      : self.removeGatewayDirectory,
+                       'deleteLink'                  : self.deleteLinkIfExists,
+                       'deleteOvsPort'               : self.deleteOvsPort,
+                       'stopStrongswan'              : self.stopStrongswan,
+                       'removeFile'                  : removeFileIfExists,
+                       'removeTunnelsFromIpsecFiles' : self.removeTunnelConfigurations,
+                       'unloadTunnels'               : lambda names: self.strongswanBackend.updateTunnels([], names),
+                       'applyFlows'                  : self.applyFlowBundle,
+                       'deleteRoutes'                : self.deleteExistingRoutes}
+        if undo[0] not in undoActions:
+            raise RuntimeError('Unknown undo action \'' + undo[0] + '\'')
+        undoActions[undo[0]](*undo[1:])
+
+    # Applies a journaled redo action, given as its name followed by its arguments, as it is applied on recovery
+    def applyRedoAction(self, redo):
+        redoActions = {'removeTunnels'  : lambda ovsBridge, tunnels: self.applyTunnelRemoval(ovsBridge, [tuple(tunnel) for tunnel in tunnels], recovering=True),
+                       'destroyGateway' : lambda ovsBridge: self.destroyGateway(ovsBridge, recovering=True)}
+        if redo[0] not in redoActions:
+            raise RuntimeError('Unknown redo action \'' + redo[0] + '\'')
+        redoActions[redo[0]](*redo[1:])
+
+    def removeGatewayDirectory(self):
+        if os.path.isdir(self.gatewayDirectory):
+            shutil.rmtree(self.gatewayDirectory)
+
+    def deleteLinkIfExists(self, interfaceName):
+        if self.linkBackend.interfaceExists(interfaceName):
+            self.linkBackend.deleteLink(interfaceName)
+        if self.linkBackend.interfaceExists(interfaceName):
+            raise RuntimeError('Interface ' + interfaceName + ' still exists')
+
+    def deleteOvsPort(self, ovsBridge, ovsPort):
+        BashCommand('ovs-vsctl --if-exists del-port ' + ovsBridge + ' ' + ovsPort).execute()
+
+    def stopStrongswan(self):
+        self.charonInstance.stop()
+
+    def removeTunnelConfigurations(self, names):
+        self.removeTunnelsFromIpsecFiles(names)
+        remainingNames = [name for name in names if self.tunnelRegistry.getTunnel(name)]
+        if remainingNames:
+            raise RuntimeError('The configuration of ' + ', '.join(remainingNames) + ' is still in place')
+
+    # Deletes the routes of the given prefixes that exist on the gateway interface
+    def deleteExistingRoutes(self, prefixes):
+        if not prefixes:
+            return
+        existingRoutes = set(self.linkBackend.getRoutes(self.gatewayInterfaceName))
+        self.linkBackend.deleteRoutes([prefix for prefix in prefixes if prefix in existingRoutes])
+        remainingPrefixes = set(prefixes) & set(self.linkBackend.getRoutes(self.gatewayInterfaceName))
+        if remainingPrefixes:
+            raise RuntimeError('The routes to ' + ', '.join(sorted(remainingPrefixes)) + ' are still in place')
 
     # Returns a list of the transparent IPSEC tunnels in existence
     # Each tunnel is represented by a tuple with the tunnel's name, source ip adresss and destination ip address
+    @tracedOperation
     def listIpsecTunnels(self):
-        tunnelEntryLen = len(open(self.ipsecConfTemplate).readlines())
-        ipsecTunnels = []
-        tunnelTitleLineRegex = r'^conn (?P<tunnelName>\S+)$'
-        ipsecConfFileLines = open(self.ipsecConfFilename).readlines()
-        ipsecConfTitleLineFound = False
-        for lineIndex, line in enumerate(ipsecConfFileLines):
-            if not ipsecConfTitleLineFound:
-                ipsecConfTitleLineFound = bool(re.search(r'^' + self.ipsecConfTitleLine + r'$', line.strip()))
-                continue
-            dataMatches = re.search(tunnelTitleLineRegex, line)
-            if dataMatches:
-                sourceIp, destIp = tuple(self.getIpFromTunnelLines(ipsecConfFileLines[lineIndex:lineIndex + tunnelEntryLen], keyword) for keyword in ['leftsubnet', 'rightsubnet'])
-                ipsecTunnels.append((dataMatches.group('tunnelName'), sourceIp, destIp))
-
-        return ipsecTunnels
+        return [tunnel[:3] for tunnel in self.tunnelRegistry.getTunnels()]
+
+    # Returns the live status of every tunnel (see IpsecManagerTunnelStatus), joined from a single query of strongswan rather than a query per tunnel
+    # ('strongswan statusall', or VICI's list-conns and list-sas). strongswan is queried at most once per tunnelStatusTtl seconds, so frequent callers (e.g. --watch, or several clients of the daemon) share its output
+    @tracedOperation
+    def tunnelStatus(self):
+        with self.statusAllLock:
+            if self.statusAllRecords is None or time() - self.statusAllTime >= self.tunnelStatusTtl:
+                self.statusAllRecords = self.strongswanBackend.getStatusRecords()
+                self.statusAllTime = time()
+            statusAllRecords = self.statusAllRecords
+        return getTunnelStatuses(self.tunnelRegistry.getTunnels(), statusAllRecords)
 
     def getIpsecTunnelNames(self):
         return [tunnelName for tunnelName, _, _ in self.listIpsecTunnels()]
 
+    # Returns the fields of gateway.conf, which is read only when it has changed since the previous call
+    def getGatewayConf(self):
+        stamp = getFileStamp(self.gatewayConfFilename)
+        if self.gatewayConf is None or stamp != self.gatewayConfStamp:
+            gatewayConfContent = open(self.gatewayConfFilename).read()
+            self.gatewayConf = {'localGatewayIp'         : re.search(r'gatewayIp\s+:\s+(?P<localGatewayIp>(\d+\.){3}\d+)', gatewayConfContent).group('localGatewayIp'),
+                                'ovsBridge'              : re.search(r'ovsBridge\s+:\s+(?P<ovsBridge>\S+)', gatewayConfContent).group('ovsBridge'),
+                                'localGatewayMacAddress' : re.search(r'gatewayMac\s+:\s+(?P<localGatewayMacAddress>([0-9A-Fa-f]{2}:){5}[0-9A-Fa-f]{2})', gatewayConfContent).group('localGatewayMacAddress')}
+            self.gatewayConfStamp = stamp
+        return self.gatewayConf
+
     def getLocalGatewayIpFromGatewayConf(self):
-        return re.search(r'gatewayIp\s+:\s+(?P<localGatewayIp>(\d+\.){3}\d+)', open(self.gatewayConfFilename).read()).group('localGatewayIp')
+        return self.getGatewayConf()['localGatewayIp']
 
     def getOvsBridgeFromGatewayConf(self):
-        return re.search(r'ovsBridge\s+:\s+(?P<ovsBridge>\S+)', open(self.gatewayConfFilename).read()).group('ovsBridge')
+        return self.getGatewayConf()['ovsBridge']
 
     def getLocalGatewayMacAddressFromGatewayConf(self):
-        return re.search(r'gatewayMac\s+:\s+(?P<localGatewayMacAddress>([0-9A-Fa-f]{2}:){5}[0-9A-Fa-f]{2})', open(self.gatewayConfFilename).read()).group('localGatewayMacAddress')
+        return self.getGatewayConf()['localGatewayMacAddress']
+
+    # Every flow is tagged with a cookie (see getFlowCookie): a tunnel's ip forwarding flow with its own, and the ARP spoofing flow of a source ip with the source ip's
+    def getIpForwardingFlowCookie(self, sourceIp, destIp):
+        return '0x%x' % getFlowCookie(self.flowCookiePrefix, ipForwardingFlowKind, [sourceIp, destIp])
+
+    def getArpIpSpoofingFlowCookie(self, sourceIp):
+        return '0x%x' % getFlowCookie(self.flowCookiePrefix, arpSpoofingFlowKind, [sourceIp])
+
+    def getIpForwardingFlow(self, sourceIp, destIp, localGatewayMacAddress):
+        return 'table=0,cookie=' + self.getIpForwardingFlowCookie(sourceIp, destIp) + ',ip,nw_src=' + sourceIp + ',nw_dst=' + destIp + ',action=mod_dl_dst:' + localGatewayMacAddress + ',' + self.gatewayOvsPort
 
-    def getArpIpSpoofingRule(self, ovsBridge, sourceIp, destIp):
-        return 'ovs-ofctl add-flow ' + ovsBridge + ' "table=0, arp, nw_dst=' + sourceIp + ', in_port=' + self.gatewayOvsPort + ', actions=load:0x' + convertIpToHex(destIp) + '->NXM_OF_ARP_SPA[], normal"'
+    # ARP replies to the source ip (or to any address in the source subnet) are spoofed from the destination ip (or from the destination subnet's first host)
+    def getArpIpSpoofingFlow(self, sourceIp, destIp):
+        return 'table=0, cookie=' + self.getArpIpSpoofingFlowCookie(sourceIp) + ', arp, nw_dst=' + sourceIp + ', in_port=' + self.gatewayOvsPort + ', actions=load:0x' + convertIpToHex(getFirstHostIp(destIp)) + '->NXM_OF_ARP_SPA[], normal'
 
-    def getIpFromTunnelLines(self, tunnelLines, keyword):
-        for line in tunnelLines:
-            dataMatches = re.search(keyword + r'=(?P<Ip>(\d+\.){3}\d+)', line.strip())
-            if dataMatches:
-                return dataMatches.group('Ip')
+    # Flows are deleted by their exact cookie, which OVS looks up in its cookie index rather than by matching every flow of the table
+    # The match fields are kept as well, so a hash collision between two cookies can't delete another tunnel's flow
+    def getIpForwardingFlowDeletion(self, sourceIp, destIp):
+        return 'cookie=' + self.getIpForwardingFlowCookie(sourceIp, destIp) + '/-1,table=0,ip,nw_src=' + sourceIp + ',nw_dst=' + destIp
 
-    def getIpFromIpsecConf(self, tunnelName, keyword):
-        tunnelEntryLen = len(open(self.ipsecConfTemplate).readlines())
-        ipsecConfFileLines = open(self.ipsecConfFilename).readlines()
-        for lineIndex, line in enumerate(ipsecConfFileLines):
-            if re.search(r'^conn ' + tunnelName + r'$', line):
-                return self.getIpFromTunnelLines(ipsecConfFileLines[lineIndex:lineIndex + tunnelEntryLen], keyword)
+    def getArpIpSpoofingFlowDeletion(self, sourceIp):
+        return 'cookie=' + self.getArpIpSpoofingFlowCookie(sourceIp) + '/-1,table=0,arp,nw_dst=' + sourceIp + ',in_port=' + self.gatewayOvsPort
 
     def getSourceIpFromIpsecConf(self, tunnelName):
-        return self.getIpFromIpsecConf(tunnelName, 'leftsubnet')
+        tunnel = self.tunnelRegistry.getTunnel(tunnelName)
+        return tunnel[1] if tunnel else None
 
     def getDestIpFromIpsecConf(self, tunnelName):
-        return self.getIpFromIpsecConf(tunnelName, 'rightsubnet')
+        tunnel = self.tunnelRegistry.getTunnel(tunnelName)
+        return tunnel[2] if tunnel else None
 
     def getTunnelThatSharesSourceIp(self, tunnelName, sourceIp):
-        for currentTunnelName, currentSourceIp, currentDestIp in self.listIpsecTunnels():
-            if tunnelName != currentTunnelName and sourceIp == currentSourceIp:
-                return currentTunnelName, currentSourceIp, currentDestIp
+        for tunnel in self.tunnelRegistry.getTunnelsBySourceIp(sourceIp):
+            if tunnelName != tunnel[0]:
+                return tunnel[:3]
         return None
 
     def anotherTunnelSharesSourceIp(self, tunnelName, sourceIp):
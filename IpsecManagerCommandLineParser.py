@@ -2,8 +2,14 @@
 #written by Gavi - gavi@mellanox.com
 
 import re
+import csv
+import json
 from collections import OrderedDict
 from os import linesep
+from os.path import isfile
+
+from IpsecManagerUtilityMethods import parseSubnet, getCanonicalSubnet, gatewayNameIsValid, tunnelNameIsValid
+from IpsecManagerStrongswanBackends import strongswanBackendNames
 
 class HelpRequestedException(Exception):
     pass
@@ -11,6 +17,31 @@ class HelpRequestedException(Exception):
 class InsufficientInputException(Exception):
     pass
 
+def getOptionName(userInput):
+    return userInput.partition('=')[0] + '=' if userInput.startswith('--') and '=' in userInput else userInput
+
+# Returns the value of the last occurrence of an option that takes a value, or whether a flag was given
+def getOptionValue(userInputs, option):
+    if not option.endswith('='):
+        return option in userInputs
+    optionValues = [userInput.partition('=')[2] for userInput in userInputs if getOptionName(userInput) == option]
+    return optionValues[-1] if optionValues else None
+
+# JSON manifests hold unicode strings (and may hold numbers), while the parameters are ASCII strings, as they are on the command line
+def manifestFieldIsValid(field):
+    if isinstance(field, type(u'')):
+        try:
+            field.encode('ascii')
+        except UnicodeError:
+            return False
+        return True
+    return field is None or isinstance(field, (str, int, float)) and not isinstance(field, bool)
+
+def getManifestField(field):
+    if field is None:
+        return ''
+    return field.encode('ascii') if isinstance(field, type(u'')) else str(field)
+
 class IpsecManagerCommandLineParser(object):
     def __init__(self):
         def ipAddressIsValid(ipAddress):
@@ -29,17 +60,64 @@ class IpsecManagerCommandLineParser(object):
             ip, netmask = tuple(ipAddress.split('/'))
             return ipAddressIsValid(ip) and int(netmask) <= 32
 
+        # An ip address, or a subnet in CIDR notation whose host bits are all zero
+        def ipAddressOrSubnetIsValid(ipAddress):
+            if '/' not in ipAddress:
+                return ipAddressIsValid(ipAddress)
+            if not ipAddressWithNetmaskIsValid(ipAddress):
+                return False
+            network, prefixLen = parseSubnet(ipAddress)
+            return network & ((1 << (32 - prefixLen)) - 1) == 0
+
         self.commandsAndParams = OrderedDict([('createIpsecGateway',  OrderedDict([('ovsBridge',        lambda _: True),
                                                                                    ('gatewayIp',        ipAddressWithNetmaskIsValid)])),
                                               ('destroyIpsecGateway', {}),
-                                              ('addIpsecTunnel',      OrderedDict([('name',             lambda _: True),
-                                                                                   ('sourceIp',         ipAddressIsValid),
-                                                                                   ('destIp',           ipAddressIsValid),
+                                              ('addIpsecTunnel',      OrderedDict([('name',             tunnelNameIsValid),
+                                                                                   ('sourceIp',         ipAddressOrSubnetIsValid),
+                                                                                   ('destIp',           ipAddressOrSubnetIsValid),
                                                                                    ('remoteGatewayIp',  ipAddressIsValid),
                                                                                    ('localId',          lambda _: True),
                                                                                    ('remoteId',         lambda _: True)])),
                                               ('removeIpsecTunnel',   OrderedDict([('name',             lambda _: True)])),
-                                              ('listIpsecTunnels',    {})])
+                                              ('addIpsecTunnels',     OrderedDict([('manifestFile',     isfile)])),
+                                              ('removeIpsecTunnels',  OrderedDict([('manifestFile',     isfile)])),
+                                              ('upIpsecTunnels',      OrderedDict([('manifestFile',     isfile)])),
+                                              ('upAllIpsecTunnels',   {}),
+                                              ('reconcile',           OrderedDict([('stateFile',        isfile)])),
+                                              ('listIpsecTunnels',    {}),
+                                              ('listIpsecGateways',   {}),
+                                              ('tunnelStatus',        {}),
+                                              ('auditFlows',          {}),
+                                              ('migrateTunnelsToFragments', {}),
+                                              ('serve',               {})])
+        # Tunnels are removed by any name, as tunnels that were added before names were validated may still be in ipsec.conf
+        # Parameters that are converted to a single form once they are validated, so the same subnet is never stored (and compared) in two forms,
+        # e.g. a host address with and without its /32:
+        self.paramNormalizers = {'sourceIp' : getCanonicalSubnet,
+                                 'destIp'   : getCanonicalSubnet}
+        # Commands that receive a manifest file, mapped to the command whose parameters each of the manifest's entries holds:
+        self.manifestCommands = {'addIpsecTunnels'    : 'addIpsecTunnel',
+                                 'removeIpsecTunnels' : 'removeIpsecTunnel',
+                                 'upIpsecTunnels'     : 'removeIpsecTunnel',
+                                 'reconcile'          : 'addIpsecTunnel'}
+        # Manifests that may be empty (an empty desired state means no tunnels at all):
+        self.commandsAcceptingEmptyManifests = set(['reconcile'])
+        # Optional flags of each command, which are passed to it as booleans after its parameters, in the listed order
+        # Options that end with '=' take a value (e.g. --gateway=gw1), which is passed instead of the boolean, or None when the option isn't given:
+        self.commandsAndOptions = {'createIpsecGateway'  : ['--gateway='],
+                                   'destroyIpsecGateway' : ['--gateway='],
+                                   'addIpsecTunnel'      : ['--gateway='],
+                                   'addIpsecTunnels'     : ['--gateway='],
+                                   'reconcile'           : ['--dry-run'],
+                                   'auditFlows'          : ['--gc']}
+        self.optionValueValidators = {'--gateway='            : gatewayNameIsValid,
+                                      '--strongswan-backend=' : lambda backendName: backendName in strongswanBackendNames}
+        # Options that every command accepts, which configure the gateways that ipsecManager.py (or the daemon, for serve) creates, so they are not passed to the command:
+        self.globalOptions = ['--strongswan-backend=']
+        # Optional flags that only change how ipsecManager.py prints a command's result, so they are not passed to the command:
+        self.commandsAndOutputOptions = {'listIpsecTunnels'  : ['--json'],
+                                         'listIpsecGateways' : ['--json'],
+                                         'tunnelStatus'      : ['--json', '--watch']}
 
     def parseCommandLine(self, args):
         if len(args) < 2:
@@ -53,7 +131,16 @@ class IpsecManagerCommandLineParser(object):
         if command not in self.commandsAndParams:
             raise ValueError('Unrecognized command: ' + command + linesep + self.getGlobalHelpMessage())
 
-        commandParams = args[2:]
+        commandOptions = self.commandsAndOptions.get(command, [])
+        outputOptions = self.commandsAndOutputOptions.get(command, [])
+        for userInput in args[2:]:
+            if userInput.startswith('--') and getOptionName(userInput) not in commandOptions + outputOptions + self.globalOptions:
+                raise ValueError('Unrecognized option for ' + command + ': ' + userInput + linesep + 'Usage: ' + self.getCommandHelpMessage(command))
+            if getOptionName(userInput) in self.optionValueValidators and not self.optionValueValidators[getOptionName(userInput)](userInput.partition('=')[2]):
+                raise ValueError(getOptionName(userInput).rstrip('=') + ' has an illegal input' + linesep + 'Usage: ' + self.getCommandHelpMessage(command))
+        commandParams = [userInput for userInput in args[2:] if getOptionName(userInput) not in commandOptions + outputOptions + self.globalOptions]
+        optionValues = tuple(getOptionValue(args[2:], option) for option in commandOptions)
+
         if len(self.commandsAndParams[command]) != len(commandParams):
             raise ValueError(command + ' has an incorrect amount of parameters, received ' + str(len(commandParams)) + ' instead of ' + str(len(self.commandsAndParams[command])) + linesep + 'Usage: ' + self.getCommandHelpMessage(command))
 
@@ -62,11 +149,62 @@ class IpsecManagerCommandLineParser(object):
             if not validationMethod(commandParams[paramIndex]):
                 raise ValueError(paramName + ' has an illegal input' + linesep + 'Usage: ' + self.getCommandHelpMessage(command))
 
-        return command, tuple(commandParams)
-
-    def getCommandHelpMessage(self, command, padding=0):
-        return ' '.join([command + ' '*padding] + ['<' + param + '>' for param in self.commandsAndParams[command]])
+        if command in self.manifestCommands:
+            return command, (self.parseTunnelManifest(commandParams[0], self.manifestCommands[command], command in self.commandsAcceptingEmptyManifests),) + optionValues
+
+        return command, self.normalizeParams(self.commandsAndParams[command], commandParams) + optionValues
+
+    def normalizeParams(self, paramNames, params):
+        return tuple(self.paramNormalizers[paramName](param) if paramName in self.paramNormalizers else param for paramName, param in zip(paramNames, params))
+
+    # Reads a JSON or CSV manifest file, and validates all of its entries as parameters of the given command
+    # Returns a list of parameter tuples, one per entry. Entries may hold more fields than the command uses (e.g. an addIpsecTunnels manifest can be handed to removeIpsecTunnels)
+    def parseTunnelManifest(self, manifestFilename, command, allowEmpty = False):
+        paramNames = list(self.commandsAndParams[command])
+        manifestContent = open(manifestFilename).read()
+
+        if manifestFilename.endswith('.json') or manifestContent.lstrip()[:1] in ['[', '{']:
+            try:
+                entries = json.loads(manifestContent)
+            except ValueError as e:
+                raise ValueError(manifestFilename + ' is not a valid JSON manifest: ' + str(e))
+            if isinstance(entries, dict):
+                entries = entries.get('tunnels', [])
+            entries = [[entry.get(paramName) for paramName in paramNames] if isinstance(entry, dict) else entry for entry in entries]
+            entries = [[entry] if not isinstance(entry, list) else entry for entry in entries]
+        else:
+            entries = [[field.strip() for field in row] for row in csv.reader(manifestContent.splitlines()) if row and not row[0].strip().startswith('#')]
+            if entries and entries[0][0] == paramNames[0]:
+                entries = entries[1:]
+
+        errors = []
+        tunnels = []
+        for entryIndex, entry in enumerate(entries):
+            entryTitle = 'Entry #' + str(entryIndex + 1)
+            if len(entry) < len(paramNames):
+                errors.append(entryTitle + ' has ' + str(len(entry)) + ' fields instead of ' + str(len(paramNames)))
+                continue
+            illegalFields = [field for field in entry[:len(paramNames)] if not manifestFieldIsValid(field)]
+            if illegalFields:
+                errors.append(entryTitle + ' has an illegal field: ' + repr(illegalFields[0]) + ' (fields are ASCII strings or numbers)')
+                continue
+            entry = tuple(getManifestField(field) for field in entry[:len(paramNames)])
+            for paramName, param in zip(paramNames, entry):
+                if not param or not self.commandsAndParams[command][paramName](param):
+                    errors.append(entryTitle + '\'s ' + paramName + ' has an illegal input: \'' + param + '\'')
+            tunnels.append(self.normalizeParams(paramNames, entry))
+
+        if not tunnels and not errors and not allowEmpty:
+            errors.append(manifestFilename + ' contains no entries')
+        if errors:
+            raise ValueError((linesep + '    ').join([manifestFilename + ' has illegal entries:'] + errors) + linesep + 'Each entry holds: ' + self.getCommandHelpMessage(command, showOptions=False))
+
+        return tunnels
+
+    def getCommandHelpMessage(self, command, padding=0, showOptions=True):
+        options = self.commandsAndOptions.get(command, []) + self.commandsAndOutputOptions.get(command, []) if showOptions else []
+        return ' '.join([command + ' '*padding] + ['<' + param + '>' for param in self.commandsAndParams[command]] + ['[' + option + ('<' + option[2:-1] + '>' if option.endswith('=') else '') + ']' for option in options])
 
     def getGlobalHelpMessage(self):
         maxCommandLen = max([len(command) for command in self.commandsAndParams])
-        return 'Usage: ipsecManager.py <command> [parameters]' + linesep + (linesep + '    ').join(['Commands:'] + [self.getCommandHelpMessage(command, maxCommandLen - len(command)) for command in self.commandsAndParams])
+        return 'Usage: ipsecManager.py <command> [parameters] [--strongswan-backend=<' + '|'.join(strongswanBackendNames) + '>]' + linesep + (linesep + '    ').join(['Commands:'] + [self.getCommandHelpMessage(command, maxCommandLen - len(command)) for command in self.commandsAndParams])
@@ -0,0 +1,180 @@
+#!/usr/bin/python
+
+import os
+import json
+import socket
+import signal
+import threading
+try:
+    import SocketServer as socketserver
+except ImportError:
+    import socketserver
+
+from IpsecManagerGatewayPool import IpsecGatewayPool
+from IpsecManagerCommandLineParser import IpsecManagerCommandLineParser, HelpRequestedException, InsufficientInputException
+
+defaultDaemonSocketFilename = '/var/run/ipsecManager.sock'
+
+# Commands that don't modify the gateway or its tunnels, and may run alongside each other
+readOnlyCommands = set(['listIpsecTunnels', 'listIpsecGateways', 'tunnelStatus'])
+
+# Commands that are never forwarded to the daemon
+localCommands = set(['serve'])
+
+class ReadWriteLock(object):
+    def __init__(self):
+        self.condition = threading.Condition(threading.Lock())
+        self.readers = 0
+        self.writing = False
+
+    def acquireRead(self):
+        with self.condition:
+            while self.writing:
+                self.condition.wait()
+            self.readers += 1
+
+    def releaseRead(self):
+        with self.condition:
+            self.readers -= 1
+            if self.readers == 0:
+                self.condition.notify_all()
+
+    def acquireWrite(self):
+        with self.condition:
+            while self.writing or self.readers > 0:
+                self.condition.wait()
+            self.writing = True
+
+    def releaseWrite(self):
+        with self.condition:
+            self.writing = False
+            self.condition.notify_all()
+
+# Keeps the host's gateways (an IpsecGatewayPool), along with their gateway configuration and tunnel registries, in memory, and executes the commands of
+# ipsecManager.py that are sent to it over a unix socket
+# Each request is a single JSON line: {"args": [<command>, <parameters>...]}, parsed exactly like ipsecManager.py's command line
+# Each response is a single JSON line: {"result": <return value>} or {"error": <error message>}
+# Clients are served concurrently, read-only commands run alongside each other, and commands that modify the gateway are serialized
+class IpsecManagerDaemon(object):
+    def __init__(self, socketFilename = defaultDaemonSocketFilename, ipsecManager = None):
+        self.socketFilename = socketFilename
+        self.ipsecManager = ipsecManager if ipsecManager != None else IpsecGatewayPool()
+        self.commandLineParser = IpsecManagerCommandLineParser()
+        self.lock = ReadWriteLock()
+        self.server = None
+
+    def executeCommand(self, args):
+        try:
+            command, params = self.commandLineParser.parseCommandLine(['ipsecManager.py'] + args)
+        except HelpRequestedException:
+            raise ValueError(self.commandLineParser.getGlobalHelpMessage())
+        except InsufficientInputException:
+            raise ValueError('Insufficient input' + os.linesep + self.commandLineParser.getGlobalHelpMessage())
+        if command in localCommands:
+            raise ValueError(command + ' can\'t be sent to the daemon')
+
+        if command in readOnlyCommands:
+            self.lock.acquireRead()
+            try:
+                return getattr(self.ipsecManager, command)(*params)
+            finally:
+                self.lock.releaseRead()
+
+        self.lock.acquireWrite()
+        try:
+            return getattr(self.ipsecManager, command)(*params)
+        finally:
+            self.lock.releaseWrite()
+
+    def handleRequest(self, requestLine):
+        try:
+            request = json.loads(requestLine)
+            return {'result' : self.executeCommand([str(arg) for arg in request['args']])}
+        except (RuntimeError, ValueError) as e:
+            return {'error' : str(e)}
+        except Exception as e:
+            return {'error' : type(e).__name__ + ': ' + str(e)}
+
+    # Recovers the operations that were interrupted before the daemon started (see IpsecGatewayPool.recoverIncompleteOperations), then serves the clients
+    def serve(self):
+        if IpsecManagerClient(self.socketFilename).daemonIsRunning():
+            raise RuntimeError('An ipsecManager daemon is already listening on ' + self.socketFilename)
+        self.ipsecManager.recoverIncompleteOperations()
+        if os.path.exists(self.socketFilename):
+            os.remove(self.socketFilename)
+
+        daemon = self
+        class RequestHandler(socketserver.StreamRequestHandler):
+            def handle(self):
+                for requestLine in iter(self.rfile.readline, b''):
+                    if not requestLine.strip():
+                        continue
+                    self.wfile.write((json.dumps(daemon.handleRequest(requestLine.decode())) + '\n').encode())
+                    self.wfile.flush()
+
+        class Server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+            daemon_threads = True
+
+        oldUmask = os.umask(0o077)
+        try:
+            self.server = Server(self.socketFilename, RequestHandler)
+        finally:
+            os.umask(oldUmask)
+
+        def stop(signalNumber, frame):
+            raise KeyboardInterrupt()
+        signal.signal(signal.SIGTERM, stop)
+
+        try:
+            self.server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.server.server_close()
+            os.remove(self.socketFilename)
+
+# Forwards ipsecManager.py's commands to a running IpsecManagerDaemon
+class IpsecManagerClient(object):
+    def __init__(self, socketFilename = defaultDaemonSocketFilename):
+        self.socketFilename = socketFilename
+        self.socket = None
+
+    def connect(self):
+        if self.socket is None:
+            clientSocket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                clientSocket.connect(self.socketFilename)
+            except socket.error:
+                clientSocket.close()
+                raise
+            self.socket = clientSocket
+            self.socketFile = clientSocket.makefile('rb')
+
+    def daemonIsRunning(self):
+        if not os.path.exists(self.socketFilename):
+            return False
+        try:
+            self.connect()
+            return True
+        except socket.error:
+            return False
+
+    def close(self):
+        if self.socket is not None:
+            self.socketFile.close()
+            self.socket.close()
+            self.socket = None
+
+    # Sends the command line arguments (without the script's name) to the daemon, and returns the command's return value
+    # Errors in the daemon are raised as RuntimeErrors, and invalid input as ValueErrors
+    def executeCommand(self, args):
+        self.connect()
+        self.socket.sendall((json.dumps({'args' : list(args)}) + '\n').encode())
+        responseLine = self.socketFile.readline()
+        if not responseLine:
+            self.close()
+            raise RuntimeError('The ipsecManager daemon closed the connection')
+        response = json.loads(responseLine.decode())
+        if 'error' in response:
+            raise RuntimeError(str(response['error']))
+        return response['result']
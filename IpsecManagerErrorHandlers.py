@@ -3,6 +3,12 @@
 
 import re
 
-def ipRouteAddStderrHandler(stderrOutput):
-    if not re.search(r'^RTNETLINK answers: File exists$', stderrOutput.strip()):
+def ipBatchRouteAddStderrHandler(stderrOutput):
+    for line in stderrOutput.strip().splitlines():
+        if not re.search(r'^(RTNETLINK answers: File exists|Command failed \S+:\d+)$', line.strip()):
             raise RuntimeError(stderrOutput)
+
+# Stopping a charon instance that isn't running isn't an error
+def strongswanStopStderrHandler(stderrOutput):
+    if not re.search(r'starter is not running', stderrOutput):
+        raise RuntimeError(stderrOutput)
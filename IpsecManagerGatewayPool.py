@@ -0,0 +1,260 @@
+#!/usr/bin/python
+
+import os
+import hashlib
+import threading
+from collections import OrderedDict
+
+from IpsecManager import IpsecManager
+from IpsecManagerUtilityMethods import getCanonicalSubnet, gatewayNameIsValid
+from IpsecManagerReconciler import reconcilePlanKeys
+from IpsecManagerJournal import OperationJournal
+from IpsecManagerPrefixTrie import TunnelOverlapIndex
+
+defaultGatewayName = 'default'
+
+# Returns the rendezvous hashing weight of a source ip on a gateway
+def getPlacementWeight(gatewayName, sourceIp):
+    return hashlib.md5((gatewayName + '>' + getCanonicalSubnet(sourceIp)).encode()).hexdigest()
+
+# Spreads the tunnels of a host over several gateways, each being an IpsecManager with its own veth pair, OVS port, ip address and charon
+# instance, so IKE and ESP processing is spread over several interfaces (and their queues) and several charon processes
+# The default gateway keeps the original files and interface names, and named gateways are kept under gatewaysDirectory (see IpsecManager.useGatewayDirectory)
+# Tunnel names are unique across the gateways, and tunnels may not overlap even when they are on different gateways, since the gateways may share a bridge
+# Each command is applied by the gateways that hold its tunnels, or, for new tunnels, by the gateways they are placed on (see placeTunnels)
+class IpsecGatewayPool(object):
+    def __init__(self, gatewaysDirectory = '/etc/ipsecManager/gateways', strongswanBackendName = None):
+        self.gatewaysDirectory     = gatewaysDirectory
+        self.strongswanBackendName = strongswanBackendName
+        self.placementPolicy       = 'least-loaded'
+        self.defaultGateway        = IpsecManager(strongswanBackendName=strongswanBackendName)
+        self.namedGateways         = {}
+        self.lock                  = threading.Lock()
+
+    @property
+    def tunnelStatusTtl(self):
+        return self.defaultGateway.tunnelStatusTtl
+
+    def getGateway(self, gatewayName):
+        if gatewayName in [None, defaultGatewayName]:
+            return self.defaultGateway
+        if not gatewayNameIsValid(gatewayName):
+            raise RuntimeError('\'' + gatewayName + '\' can\'t be used as a gateway name (up to 9 letters and digits)')
+        with self.lock:
+            if gatewayName not in self.namedGateways:
+                self.namedGateways[gatewayName] = IpsecManager(gatewayName, self.gatewaysDirectory, self.strongswanBackendName)
+            return self.namedGateways[gatewayName]
+
+    # Returns the gateways that were created (i.e. that have a gateway.conf), by name, the default gateway first
+    def getGateways(self):
+        gatewayNames = [defaultGatewayName] if os.path.exists(self.defaultGateway.gatewayConfFilename) else []
+        if os.path.isdir(self.gatewaysDirectory):
+            gatewayNames += sorted(gatewayName for gatewayName in os.listdir(self.gatewaysDirectory) if gatewayNameIsValid(gatewayName))
+        gateways = OrderedDict((gatewayName, self.getGateway(gatewayName)) for gatewayName in gatewayNames)
+        return OrderedDict((gatewayName, gateway) for gatewayName, gateway in gateways.items() if os.path.exists(gateway.gatewayConfFilename))
+
+    # Returns the gateways that the commands of new tunnels are applied by. With no gateways at all, that's the default gateway, which reports that it doesn't exist
+    def getPlacementGateways(self):
+        return self.getGateways() or OrderedDict([(defaultGatewayName, self.defaultGateway)])
+
+    # Maps the name of each of the gateways' tunnels to the name of its gateway
+    def getTunnelGatewayNames(self, gateways):
+        return dict((tunnel[0], gatewayName) for gatewayName, gateway in gateways.items() for tunnel in gateway.tunnelRegistry.getTunnels())
+
+    def getTunnelConflicts(self, tunnels, gateways):
+        return list(OrderedDict((error, None) for gateway in gateways.values() for error in gateway.getTunnelConflicts(tunnels, checkExistingTunnels=True)))
+
+    # Assigns each of the new tunnels to a gateway, and returns the new tunnels of each gateway
+    # A source ip's route and ARP spoofing flow belong to a single gateway interface, so tunnels whose source ip is used by a gateway's tunnels (or by a tunnel
+    # placed before them) are placed on that gateway. Source subnets that overlap without being the same are rejected (see getTunnelConflicts) before they are placed,
+    # and are rejected here as well, since a gateway would otherwise route addresses whose tunnels are on another gateway. The rest are placed by the placementPolicy: 'least-loaded' places them on the gateway that holds the fewest
+    # tunnels, and 'hash' by rendezvous hashing of their source ip, which is stable, and only moves a new gateway's share of the source ips once a gateway is added
+    # The gateways are assumed to hold their existingTunnels (by default, the tunnels they currently hold), and the tunnels of a requested gatewayName are all placed on it
+    def placeTunnels(self, tunnels, gateways, gatewayName = None, existingTunnels = None):
+        if existingTunnels is None:
+            existingTunnels = OrderedDict((existingGatewayName, gateway.tunnelRegistry.getTunnels()) for existingGatewayName, gateway in gateways.items())
+        if gatewayName is not None and gatewayName not in gateways:
+            raise RuntimeError('There is no gateway named ' + gatewayName)
+        tunnelCounts = dict((existingGatewayName, len(existingTunnels.get(existingGatewayName, []))) for existingGatewayName in gateways)
+        sourceIpGatewayNames = dict((getCanonicalSubnet(tunnel[1]), existingGatewayName) for existingGatewayName, gatewayTunnels in existingTunnels.items() for tunnel in gatewayTunnels)
+
+        sourceOverlapIndex = TunnelOverlapIndex([tunnel for gatewayTunnels in existingTunnels.values() for tunnel in gatewayTunnels])
+
+        placedTunnels = OrderedDict((existingGatewayName, []) for existingGatewayName in gateways)
+        errors = []
+        for tunnel in tunnels:
+            sourceIp = getCanonicalSubnet(tunnel[1])
+            nestedSourceTunnels = list(sourceOverlapIndex.getNestedSourceTunnels(tunnel[1]))
+            if nestedSourceTunnels:
+                errors.append('Tunnel ' + tunnel[0] + '\'s source ip ' + tunnel[1] + ' overlaps tunnel ' + nestedSourceTunnels[0][0] + '\'s source ip ' + nestedSourceTunnels[0][1])
+                continue
+            sourceOverlapIndex.add(tunnel)
+            placedGatewayName = sourceIpGatewayNames.get(sourceIp, gatewayName)
+            if gatewayName is not None and placedGatewayName != gatewayName:
+                errors.append('Tunnel ' + tunnel[0] + '\'s source ip ' + tunnel[1] + ' is routed by gateway ' + placedGatewayName)
+                continue
+            if placedGatewayName is None and self.placementPolicy == 'hash':
+                placedGatewayName = max(gateways, key=lambda candidateGatewayName: getPlacementWeight(candidateGatewayName, sourceIp))
+            elif placedGatewayName is None:
+                placedGatewayName = min(gateways, key=lambda candidateGatewayName: tunnelCounts[candidateGatewayName])
+            sourceIpGatewayNames[sourceIp] = placedGatewayName
+            tunnelCounts[placedGatewayName] += 1
+            placedTunnels[placedGatewayName].append(tunnel)
+        if errors:
+            raise RuntimeError((os.linesep + '    ').join(['No tunnels were placed:'] + errors))
+        return placedTunnels
+
+    # Groups the named tunnels (each a tuple whose first field is the tunnel's name) by the gateways that hold them
+    def groupTunnelsByGateway(self, tunnels, gateways, errorTitle):
+        tunnelGatewayNames = self.getTunnelGatewayNames(gateways)
+        names = list(OrderedDict((tunnel[0], None) for tunnel in tunnels))
+        missingNames = [name for name in names if name not in tunnelGatewayNames]
+        if missingNames:
+            raise RuntimeError((os.linesep + '    ').join([errorTitle] + ['No tunnel named ' + name + ' exists' for name in missingNames]))
+        groupedTunnels = OrderedDict()
+        for name in names:
+            groupedTunnels.setdefault(tunnelGatewayNames[name], []).append((name,))
+        return groupedTunnels
+
+    # Creates the default gateway, or the named gateway gatewayName
+    def createIpsecGateway(self, ovsBridge, gatewayIp, gatewayName = None):
+        self.getGateway(gatewayName).createIpsecGateway(ovsBridge, gatewayIp)
+
+    # Destroys the default gateway, or the named gateway gatewayName, along with its tunnels
+    def destroyIpsecGateway(self, gatewayName = None):
+        self.getGateway(gatewayName).destroyIpsecGateway()
+        with self.lock:
+            self.namedGateways.pop(gatewayName, None)
+
+    # Adds a tunnel on the requested gateway, or on the gateway it is placed on
+    def addIpsecTunnel(self, name, sourceIp, destIp, remoteGateway, localId, remoteId, gatewayName = None):
+        tunnel = (name, sourceIp, destIp, remoteGateway, localId, remoteId)
+        gateways = self.getPlacementGateways()
+        errors = self.getTunnelConflicts([tunnel], gateways)
+        if errors:
+            raise RuntimeError(errors[0])
+        for placedGatewayName, placedTunnels in self.placeTunnels([tunnel], gateways, gatewayName).items():
+            if placedTunnels:
+                gateways[placedGatewayName].addIpsecTunnel(*tunnel)
+
+    def removeIpsecTunnel(self, name):
+        gatewayName = self.getTunnelGatewayNames(self.getGateways()).get(name)
+        if gatewayName is None:
+            raise RuntimeError('No tunnel named ' + name + ' exists')
+        self.getGateway(gatewayName).removeIpsecTunnel(name)
+
+    # Adds the tunnels on the requested gateway, or on the gateways they are placed on, with a single addIpsecTunnels per gateway
+    def addIpsecTunnels(self, tunnels, gatewayName = None):
+        gateways = self.getPlacementGateways()
+        errors = self.getTunnelConflicts(tunnels, gateways)
+        if errors:
+            raise RuntimeError((os.linesep + '    ').join(['No tunnels were added:'] + errors))
+        for placedGatewayName, placedTunnels in self.placeTunnels(tunnels, gateways, gatewayName).items():
+            if placedTunnels:
+                gateways[placedGatewayName].addIpsecTunnels(placedTunnels)
+
+    def removeIpsecTunnels(self, tunnels):
+        for gatewayName, gatewayTunnels in self.groupTunnelsByGateway(tunnels, self.getGateways(), 'No tunnels were removed:').items():
+            self.getGateway(gatewayName).removeIpsecTunnels(gatewayTunnels)
+
+    # Raises the tunnels of each gateway concurrently with the other gateways' tunnels, since each gateway has a charon instance of its own
+    def upIpsecTunnels(self, tunnels):
+        gateways = self.getGateways()
+        groupedTunnels = self.groupTunnelsByGateway(tunnels, gateways, 'No tunnels were raised:')
+        upResults = {}
+        exceptions = []
+        def upGatewayTunnels(gateway, gatewayTunnels):
+            try:
+                upResults.update(gateway.upIpsecTunnels(gatewayTunnels))
+            except BaseException as e:
+                exceptions.append(e)
+
+        threads = [threading.Thread(target=upGatewayTunnels, args=(gateways[gatewayName], gatewayTunnels)) for gatewayName, gatewayTunnels in groupedTunnels.items()]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        if exceptions:
+            raise exceptions[0]
+        return [(name, upResults[name]) for name in OrderedDict((tunnel[0], None) for tunnel in tunnels)]
+
+    def upAllIpsecTunnels(self):
+        return self.upIpsecTunnels(self.listIpsecTunnels())
+
+    # Converges the gateways into the desired tunnels. Tunnels stay on the gateways that hold them, and new tunnels are placed as addIpsecTunnels places them,
+    # except that all the tunnels of a source ip are placed on the gateway of the first of them that already exists
+    # Tunnels that move to another gateway (since their source ip changed) are removed from their gateway before any gateway adds tunnels, so their flows and
+    # routes are released before they are added again. Returns the gateways' plans, merged into a single plan
+    def reconcile(self, desiredTunnels, dryRun=False):
+        gateways = self.getPlacementGateways()
+        errors = self.defaultGateway.getTunnelConflicts(desiredTunnels, checkExistingTunnels=False)
+        if errors:
+            raise RuntimeError((os.linesep + '    ').join(['The desired state is inconsistent:'] + errors))
+
+        tunnelGatewayNames = self.getTunnelGatewayNames(gateways)
+        sourceIpGatewayNames = {}
+        for tunnel in desiredTunnels:
+            if tunnel[0] in tunnelGatewayNames:
+                sourceIpGatewayNames.setdefault(getCanonicalSubnet(tunnel[1]), tunnelGatewayNames[tunnel[0]])
+        keptTunnels = OrderedDict((gatewayName, []) for gatewayName in gateways)
+        newTunnels = []
+        for tunnel in desiredTunnels:
+            gatewayName = sourceIpGatewayNames.get(getCanonicalSubnet(tunnel[1]))
+            if gatewayName is None:
+                newTunnels.append(tunnel)
+            else:
+                keptTunnels[gatewayName].append(tunnel)
+        placedTunnels = self.placeTunnels(newTunnels, gateways, existingTunnels=keptTunnels)
+        gatewayTunnels = OrderedDict((gatewayName, keptTunnels[gatewayName] + placedTunnels[gatewayName]) for gatewayName in gateways)
+
+        plan = OrderedDict((key, []) for key in reconcilePlanKeys)
+        movedTunnels = [tunnel for gatewayName, tunnels in gatewayTunnels.items() for tunnel in tunnels if tunnelGatewayNames.get(tunnel[0], gatewayName) != gatewayName]
+        reconcilePasses = [gatewayTunnels]
+        if movedTunnels and not dryRun:
+            movedNames = set(tunnel[0] for tunnel in movedTunnels)
+            reconcilePasses.insert(0, OrderedDict((gatewayName, [tunnel for tunnel in tunnels if tunnel[0] not in movedNames]) for gatewayName, tunnels in gatewayTunnels.items()))
+        for reconcilePass in reconcilePasses:
+            for gatewayName, tunnels in reconcilePass.items():
+                gatewayPlan = gateways[gatewayName].reconcile(tunnels, dryRun)
+                for key in reconcilePlanKeys:
+                    plan[key] += gatewayPlan[key]
+        return plan
+
+    # Returns a (name, sourceIp, destIp, gatewayName) tuple per tunnel
+    def listIpsecTunnels(self):
+        return [tunnel + (gatewayName,) for gatewayName, gateway in self.getGateways().items() for tunnel in gateway.listIpsecTunnels()]
+
+    # Returns a (gatewayName, ovsBridge, gatewayIp, tunnelCount) tuple per gateway
+    def listIpsecGateways(self):
+        return [(gatewayName, gateway.getOvsBridgeFromGatewayConf(), gateway.getLocalGatewayIpFromGatewayConf(), len(gateway.tunnelRegistry.getTunnels())) for gatewayName, gateway in self.getGateways().items()]
+
+    def tunnelStatus(self):
+        return [tunnelStatus for gateway in self.getGateways().values() for tunnelStatus in gateway.tunnelStatus()]
+
+    # Audits the flows of every gateway, and returns their audits merged into a single audit
+    def auditFlows(self, garbageCollect=False):
+        audit = OrderedDict([('orphanedFlows', []), ('missingFlows', [])])
+        for gateway in self.getPlacementGateways().values():
+            gatewayAudit = gateway.auditFlows(garbageCollect)
+            for key in audit:
+                audit[key] += gatewayAudit[key]
+        return audit
+
+    # Only the default gateway may keep its tunnels in ipsec.conf, since named gateways keep theirs in fragments from the start
+    def migrateTunnelsToFragments(self):
+        return self.defaultGateway.migrateTunnelsToFragments()
+
+    # Completes or rolls back the operations that were interrupted (e.g. by a crash or a restart), as recorded in the gateways' journal, the latest first
+    # Only the interrupted operations are recovered, rather than the state of the whole host. Returns a (gatewayName, operationName, outcome) tuple per operation
+    def recoverIncompleteOperations(self):
+        recoveredOperations = []
+        errors = []
+        for operation in reversed(OperationJournal(self.defaultGateway.journalDirectory).getIncompleteOperations()):
+            try:
+                recoveredOperations.append((operation.gatewayName or defaultGatewayName, operation.operationName, self.getGateway(operation.gatewayName).recoverOperation(operation)))
+            except RuntimeError as e:
+                operation.release()
+                errors.append(str(e))
+        if errors:
+            raise RuntimeError(os.linesep.join(errors))
+        return recoveredOperations
@@ -0,0 +1,150 @@
+#!/usr/bin/python
+
+import os
+import json
+import time
+import fcntl
+import binascii
+
+from IpsecManagerUtilityMethods import fsyncDirectory
+
+# json loads strings as unicode in python 2, while IpsecManager works with str
+def decodeJournalValue(value):
+    if isinstance(value, list):
+        return [decodeJournalValue(item) for item in value]
+    if isinstance(value, dict):
+        return dict((decodeJournalValue(key), decodeJournalValue(item)) for key, item in value.items())
+    if isinstance(value, type(u'')):
+        return str(value)
+    return value
+
+# Operations are journaled under this suffix until their first record is written (see OperationJournal.begin)
+newJournalSuffix = '.new'
+
+# Journal files are closed on exec, as the commands that operations execute (e.g. a charon started by 'strongswan start') would otherwise inherit their locks
+def openJournalFile(filename):
+    journalFile = open(filename, 'a+')
+    fcntl.fcntl(journalFile.fileno(), fcntl.F_SETFD, fcntl.fcntl(journalFile.fileno(), fcntl.F_GETFD) | fcntl.FD_CLOEXEC)
+    return journalFile
+
+# A write-ahead journal of the operations that modify the gateways. Each operation is journaled in a file of its own, which is removed once the
+# operation completes, so the journal directory only ever holds the operations that were interrupted, and recovering from a crash reads only them
+# An operation's file holds a JSON line per record, and each record is fsync'd before the step it describes is executed:
+#   {"operation": <name>, "gateway": <gateway name>, "redo": <action>}  - the operation's first record
+#   {"step": <description>, "undo": <action>}                           - a step that is about to be executed
+#   {"undone": <step index>}                                            - a step whose undo action was applied
+# Actions are lists holding an action's name and its arguments (see IpsecManager.applyUndoAction and applyRedoAction)
+# Operations that have a redo action (e.g. removals) are completed by repeating it, and the steps of the other operations are undone in reverse order
+# The operation's file is locked for as long as it is being executed (or recovered), so operations of processes that are still running are never recovered
+class OperationJournal(object):
+    def __init__(self, journalDirectory):
+        self.journalDirectory = journalDirectory
+
+    def begin(self, operationName, gatewayName, redo = None):
+        if not os.path.isdir(self.journalDirectory):
+            os.makedirs(self.journalDirectory)
+        # Filenames start with the operation's start time, so the operations are recovered in the order they were started:
+        filename = os.path.join(self.journalDirectory, '%017.6f-%d-%s.journal' % (time.time(), os.getpid(), binascii.hexlify(os.urandom(4)).decode()))
+        # The file only gets its .journal name once it's locked and holds its first record, so recovery never finds it empty (or unlocked):
+        journalFile = openJournalFile(filename + newJournalSuffix)
+        fcntl.flock(journalFile.fileno(), fcntl.LOCK_EX)
+        operation = JournaledOperation(filename, journalFile, operationName, gatewayName, redo)
+        operation.appendRecord({'operation' : operationName, 'gateway' : gatewayName, 'redo' : redo})
+        os.rename(filename + newJournalSuffix, filename)
+        fsyncDirectory(self.journalDirectory)
+        return operation
+
+    # Returns the operations that were interrupted, in the order they were started, each one locked until it is closed or released
+    # Operations that are still being executed by other processes are skipped
+    def getIncompleteOperations(self):
+        if not os.path.isdir(self.journalDirectory):
+            return []
+        operations = []
+        for filename in sorted(os.listdir(self.journalDirectory)):
+            if filename.endswith('.journal' + newJournalSuffix):
+                self.removeAbandonedJournalFile(os.path.join(self.journalDirectory, filename))
+            if not filename.endswith('.journal'):
+                continue
+            journalFile = openJournalFile(os.path.join(self.journalDirectory, filename))
+            try:
+                fcntl.flock(journalFile.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except IOError:
+                journalFile.close()
+                continue
+            operation = JournaledOperation.load(os.path.join(self.journalDirectory, filename), journalFile)
+            if operation is None:
+                # The operation was interrupted before its first record was written, so none of its steps was executed:
+                os.remove(os.path.join(self.journalDirectory, filename))
+                journalFile.close()
+                continue
+            operations.append(operation)
+        return operations
+
+    # Removes the file of an operation that was interrupted before its first record was journaled (so none of its steps was executed),
+    # unless the operation is still being started by another process
+    def removeAbandonedJournalFile(self, filename):
+        try:
+            journalFile = openJournalFile(filename)
+        except IOError:
+            return
+        try:
+            fcntl.flock(journalFile.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+            if os.path.exists(filename):
+                os.remove(filename)
+        except (IOError, OSError):
+            pass
+        journalFile.close()
+
+class JournaledOperation(object):
+    def __init__(self, filename, journalFile, operationName, gatewayName, redo):
+        self.filename      = filename
+        self.journalFile   = journalFile
+        self.operationName = operationName
+        self.gatewayName   = gatewayName
+        self.redo          = redo
+        self.steps         = []
+        self.undoneSteps   = set()
+
+    # Loads an operation from its journal file. The last record may have been partially written by a crash, in which case
+    # its step was never executed, and the record is ignored. Returns None if the operation's first record is missing
+    @staticmethod
+    def load(filename, journalFile):
+        journalFile.seek(0)
+        records = []
+        for line in journalFile.read().splitlines():
+            try:
+                records.append(decodeJournalValue(json.loads(line)))
+            except ValueError:
+                break
+        if not records or 'operation' not in records[0]:
+            return None
+        operation = JournaledOperation(filename, journalFile, records[0]['operation'], records[0].get('gateway'), records[0].get('redo'))
+        for record in records[1:]:
+            if 'step' in record:
+                operation.steps.append((record['step'], record.get('undo')))
+            elif 'undone' in record:
+                operation.undoneSteps.add(record['undone'])
+        return operation
+
+    def appendRecord(self, record):
+        self.journalFile.write(json.dumps(record, separators=(',', ':')) + '\n')
+        self.journalFile.flush()
+        os.fsync(self.journalFile.fileno())
+
+    def recordStep(self, description, undo):
+        self.appendRecord({'step' : description, 'undo' : undo})
+        self.steps.append((description, undo))
+
+    def recordUndone(self, stepIndex):
+        self.appendRecord({'undone' : stepIndex})
+        self.undoneSteps.add(stepIndex)
+
+    # Removes the operation from the journal, once it has completed or has been undone
+    def close(self):
+        os.remove(self.filename)
+        fsyncDirectory(os.path.dirname(self.filename))
+        self.journalFile.close()
+
+    # Keeps the operation in the journal, to be recovered later, and unlocks it
+    def release(self):
+        self.journalFile.close()
@@ -0,0 +1,120 @@
+#!/usr/bin/python
+
+import os
+import errno
+import socket
+
+from BashCommand import BashCommand, BatchCoprocess
+from IpsecManagerNetlink import RtnetlinkSocket, IFLA_ADDRESS
+from IpsecManagerUtilityMethods import interfaceExists, getMacAddr
+from IpsecManagerErrorHandlers import ipBatchRouteAddStderrHandler
+
+# Both backends expose the same methods. Routes are given as prefixes ('<ip>/<prefixLen>'),
+# and adding a route that already exists is not considered an error
+
+# Manages links, addresses and routes by executing 'ip' commands
+# Routes are streamed into a single 'ip -force -batch -' process, which is kept running across operations. Each batch ends with
+# a 'link show' of an interface that doesn't exist, whose failure acknowledges the batch (see BatchCoprocess)
+class IpCommandLinkBackend(object):
+    def __init__(self):
+        self.ipBatch = BatchCoprocess('ip -force -batch -', 'link show dev ipsecMgrNone0')
+
+    def interfaceExists(self, interfaceName):
+        return interfaceExists(interfaceName)
+
+    def getMacAddress(self, interfaceName):
+        return getMacAddr(interfaceName)
+
+    def addVethPair(self, interfaceName, peerInterfaceName):
+        BashCommand('ip link add ' + interfaceName + ' type veth peer name ' + peerInterfaceName).execute()
+
+    def deleteLink(self, interfaceName):
+        BashCommand('ip link delete ' + interfaceName).execute()
+
+    def setLinkUp(self, interfaceName):
+        BashCommand('ip link set ' + interfaceName + ' up').execute()
+
+    def addAddress(self, interfaceName, prefix):
+        BashCommand('ip addr add ' + prefix + ' dev ' + interfaceName).execute()
+
+    def addRoutes(self, prefixes, interfaceName):
+        self.executeIpBatch(['route add ' + prefix + ' via 0.0.0.0 dev ' + interfaceName for prefix in prefixes], errorHandler=ipBatchRouteAddStderrHandler)
+
+    def getRoutes(self, interfaceName):
+        routesCommand = BashCommand('ip -o route show dev ' + interfaceName + ' proto boot')
+        routesCommand.execute()
+        return [prefix if '/' in prefix else prefix + '/32' for prefix in [line.split()[0] for line in routesCommand.output.splitlines() if line.strip()]]
+
+    def deleteRoutes(self, prefixes):
+        self.executeIpBatch(['route del ' + prefix for prefix in prefixes])
+
+    # Streams the given 'ip' commands into the 'ip -batch' process. Failing commands don't stop the batch, and their errors are reported to the errorHandler
+    def executeIpBatch(self, ipCommands, errorHandler=None):
+        if not ipCommands:
+            return
+        failedCommands = self.ipBatch.executeLines(ipCommands)
+        if failedCommands:
+            errorOutput = os.linesep.join([line for index in sorted(failedCommands) for line in failedCommands[index]])
+            if errorHandler is None:
+                raise RuntimeError(errorOutput)
+            errorHandler(errorOutput)
+
+    def close(self):
+        self.ipBatch.close()
+
+# Manages links, addresses and routes over a single rtnetlink socket, without forking any process
+# Routes are sent to the kernel together, and their acknowledgements are awaited once
+class NetlinkLinkBackend(object):
+    def __init__(self):
+        self.rtnetlinkSocket = RtnetlinkSocket()
+
+    def interfaceExists(self, interfaceName):
+        return self.rtnetlinkSocket.getLink(interfaceName) is not None
+
+    def getMacAddress(self, interfaceName):
+        link = self.rtnetlinkSocket.getLink(interfaceName)
+        if link is None:
+            raise RuntimeError('Device "' + interfaceName + '" does not exist.')
+        return ':'.join(['%02x' % byte for byte in bytearray(link[1][IFLA_ADDRESS])])
+
+    def addVethPair(self, interfaceName, peerInterfaceName):
+        self.rtnetlinkSocket.addVethPair(interfaceName, peerInterfaceName)
+
+    def deleteLink(self, interfaceName):
+        self.rtnetlinkSocket.deleteLink(interfaceName)
+
+    def setLinkUp(self, interfaceName):
+        self.rtnetlinkSocket.setLinkUp(interfaceName)
+
+    def addAddress(self, interfaceName, prefix):
+        self.rtnetlinkSocket.addAddress(interfaceName, prefix)
+
+    def addRoutes(self, prefixes, interfaceName):
+        if prefixes:
+            self.raiseRouteErrors('add', prefixes, self.rtnetlinkSocket.addRoutes(prefixes, interfaceName), ignoredErrorNumbers=[errno.EEXIST])
+
+    def getRoutes(self, interfaceName):
+        return self.rtnetlinkSocket.getRoutes(interfaceName)
+
+    def deleteRoutes(self, prefixes):
+        if prefixes:
+            self.raiseRouteErrors('del', prefixes, self.rtnetlinkSocket.deleteRoutes(prefixes))
+
+    def raiseRouteErrors(self, action, prefixes, errorNumbers, ignoredErrorNumbers=[]):
+        errors = ['route ' + action + ' ' + prefix + ': RTNETLINK answers: ' + os.strerror(errorNumber) for prefix, errorNumber in zip(prefixes, errorNumbers) if errorNumber and errorNumber not in ignoredErrorNumbers]
+        if errors:
+            raise RuntimeError(os.linesep.join(errors))
+
+    def close(self):
+        self.rtnetlinkSocket.close()
+
+# Returns the netlink backend, or the 'ip' command backend if netlink isn't available (or if it was requested explicitly)
+def createLinkBackend(backendName = None):
+    if backendName == 'ip':
+        return IpCommandLinkBackend()
+    try:
+        return NetlinkLinkBackend()
+    except socket.error:
+        if backendName == 'netlink':
+            raise
+        return IpCommandLinkBackend()
@@ -0,0 +1,217 @@
+#!/usr/bin/python
+
+import os
+import errno
+import socket
+import struct
+
+NETLINK_ROUTE     = 0
+
+NLMSG_ERROR       = 2
+NLMSG_DONE        = 3
+RTM_NEWLINK       = 16
+RTM_DELLINK       = 17
+RTM_GETLINK       = 18
+RTM_NEWADDR       = 20
+RTM_NEWROUTE      = 24
+RTM_DELROUTE      = 25
+RTM_GETROUTE      = 26
+
+NLM_F_REQUEST     = 0x1
+NLM_F_MULTI       = 0x2
+NLM_F_ACK         = 0x4
+NLM_F_DUMP        = 0x300
+NLM_F_EXCL        = 0x200
+NLM_F_CREATE      = 0x400
+
+IFLA_ADDRESS      = 1
+IFLA_IFNAME       = 3
+IFLA_LINKINFO     = 18
+IFLA_INFO_KIND    = 1
+IFLA_INFO_DATA    = 2
+VETH_INFO_PEER    = 1
+IFF_UP            = 0x1
+
+IFA_ADDRESS       = 1
+IFA_LOCAL         = 2
+
+RTA_DST           = 1
+RTA_OIF           = 4
+RTA_TABLE         = 15
+RT_TABLE_MAIN     = 254
+RTPROT_BOOT       = 3
+RT_SCOPE_UNIVERSE = 0
+RT_SCOPE_LINK     = 253
+RT_SCOPE_NOWHERE  = 255
+RTN_UNICAST       = 1
+
+nlmsghdrFormat    = '=IHHII'
+ifinfomsgFormat   = '=BxHiII'
+ifaddrmsgFormat   = '=BBBBI'
+rtmsgFormat       = '=BBBBBBBBI'
+rtattrFormat      = '=HH'
+
+# The amount of requests sent before waiting for their acknowledgements, which keeps the kernel's acknowledgements within the socket's receive buffer
+maxRequestsPerBatch = 256
+
+class NetlinkException(RuntimeError):
+    def __init__(self, errorNumber):
+        super(NetlinkException, self).__init__('RTNETLINK answers: ' + os.strerror(errorNumber))
+        self.errno = errorNumber
+
+def packAttribute(attributeType, payload):
+    attributeLen = struct.calcsize(rtattrFormat) + len(payload)
+    return struct.pack(rtattrFormat, attributeLen, attributeType) + payload + b'\0' * ((4 - attributeLen % 4) % 4)
+
+def unpackAttributes(data, offset = 0):
+    attributes = {}
+    while offset + struct.calcsize(rtattrFormat) <= len(data):
+        attributeLen, attributeType = struct.unpack_from(rtattrFormat, data, offset)
+        if attributeLen < struct.calcsize(rtattrFormat):
+            break
+        attributes[attributeType] = data[offset + struct.calcsize(rtattrFormat):offset + attributeLen]
+        offset += (attributeLen + 3) & ~3
+    return attributes
+
+def packInterfaceName(interfaceName):
+    return packAttribute(IFLA_IFNAME, interfaceName.encode() + b'\0')
+
+def parsePrefix(prefix):
+    ip, prefixLen = (prefix.split('/') + ['32'])[:2]
+    return socket.inet_aton(ip), int(prefixLen)
+
+# A single rtnetlink socket, which is kept open for the lifetime of its owner
+# Requests are acknowledged by the kernel, and many requests can be sent at once and acknowledged together
+class RtnetlinkSocket(object):
+    def __init__(self):
+        self.socket = socket.socket(socket.AF_NETLINK, socket.SOCK_RAW, NETLINK_ROUTE)
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 1 << 20)
+        self.socket.bind((0, 0))
+        self.sequenceNumber = 0
+
+    def close(self):
+        self.socket.close()
+
+    def packMessage(self, messageType, flags, payload):
+        self.sequenceNumber += 1
+        return self.sequenceNumber, struct.pack(nlmsghdrFormat, struct.calcsize(nlmsghdrFormat) + len(payload), messageType, flags, self.sequenceNumber, 0) + payload
+
+    # Yields the (type, flags, sequenceNumber, payload) of every message within a single received datagram
+    def receiveMessages(self):
+        data = self.socket.recv(1 << 16)
+        offset = 0
+        while offset + struct.calcsize(nlmsghdrFormat) <= len(data):
+            messageLen, messageType, flags, sequenceNumber, _ = struct.unpack_from(nlmsghdrFormat, data, offset)
+            yield messageType, flags, sequenceNumber, data[offset + struct.calcsize(nlmsghdrFormat):offset + messageLen]
+            offset += (messageLen + 3) & ~3
+
+    # Sends all the requests, given as (messageType, flags, payload) tuples, and waits once for all of their acknowledgements
+    # Returns the error number of each request, 0 meaning success
+    def executeRequests(self, requests):
+        errorNumbers = []
+        for batchStart in range(0, len(requests), maxRequestsPerBatch):
+            pendingRequests = {}
+            messages = []
+            for messageType, flags, payload in requests[batchStart:batchStart + maxRequestsPerBatch]:
+                sequenceNumber, message = self.packMessage(messageType, flags | NLM_F_REQUEST | NLM_F_ACK, payload)
+                pendingRequests[sequenceNumber] = len(errorNumbers) + len(messages)
+                messages.append(message)
+            errorNumbers += [0] * len(messages)
+            self.socket.sendall(b''.join(messages))
+            while pendingRequests:
+                for messageType, _, sequenceNumber, payload in self.receiveMessages():
+                    if messageType == NLMSG_ERROR and sequenceNumber in pendingRequests:
+                        errorNumbers[pendingRequests.pop(sequenceNumber)] = -struct.unpack_from('=i', payload)[0]
+        return errorNumbers
+
+    def executeRequest(self, messageType, flags, payload):
+        errorNumber = self.executeRequests([(messageType, flags, payload)])[0]
+        if errorNumber:
+            raise NetlinkException(errorNumber)
+
+    # Sends a request that the kernel answers with one or more messages (rather than an acknowledgement), and returns their payloads
+    def query(self, messageType, flags, payload):
+        sequenceNumber, message = self.packMessage(messageType, flags | NLM_F_REQUEST, payload)
+        self.socket.sendall(message)
+        replies = []
+        while True:
+            for replyType, replyFlags, replySequenceNumber, replyPayload in self.receiveMessages():
+                if replySequenceNumber != sequenceNumber:
+                    continue
+                if replyType == NLMSG_ERROR:
+                    errorNumber = -struct.unpack_from('=i', replyPayload)[0]
+                    if errorNumber:
+                        raise NetlinkException(errorNumber)
+                    return replies
+                if replyType == NLMSG_DONE:
+                    return replies
+                replies.append(replyPayload)
+                if not replyFlags & NLM_F_MULTI:
+                    return replies
+
+    # Returns the index and attributes of the given interface, or None if it doesn't exist
+    def getLink(self, interfaceName):
+        try:
+            replies = self.query(RTM_GETLINK, 0, struct.pack(ifinfomsgFormat, socket.AF_UNSPEC, 0, 0, 0, 0) + packInterfaceName(interfaceName))
+        except NetlinkException as e:
+            if e.errno == errno.ENODEV:
+                return None
+            raise
+        _, _, interfaceIndex, _, _ = struct.unpack_from(ifinfomsgFormat, replies[0])
+        return interfaceIndex, unpackAttributes(replies[0], struct.calcsize(ifinfomsgFormat))
+
+    def getLinkIndex(self, interfaceName):
+        link = self.getLink(interfaceName)
+        if link is None:
+            raise NetlinkException(errno.ENODEV)
+        return link[0]
+
+    def addVethPair(self, interfaceName, peerInterfaceName):
+        peerInfo = packAttribute(VETH_INFO_PEER, struct.pack(ifinfomsgFormat, socket.AF_UNSPEC, 0, 0, 0, 0) + packInterfaceName(peerInterfaceName))
+        linkInfo = packAttribute(IFLA_INFO_KIND, b'veth') + packAttribute(IFLA_INFO_DATA, peerInfo)
+        self.executeRequest(RTM_NEWLINK, NLM_F_CREATE | NLM_F_EXCL, struct.pack(ifinfomsgFormat, socket.AF_UNSPEC, 0, 0, 0, 0) + packInterfaceName(interfaceName) + packAttribute(IFLA_LINKINFO, linkInfo))
+
+    def deleteLink(self, interfaceName):
+        self.executeRequest(RTM_DELLINK, 0, struct.pack(ifinfomsgFormat, socket.AF_UNSPEC, 0, 0, 0, 0) + packInterfaceName(interfaceName))
+
+    def setLinkUp(self, interfaceName):
+        self.executeRequest(RTM_NEWLINK, 0, struct.pack(ifinfomsgFormat, socket.AF_UNSPEC, 0, self.getLinkIndex(interfaceName), IFF_UP, IFF_UP))
+
+    def addAddress(self, interfaceName, prefix):
+        address, prefixLen = parsePrefix(prefix)
+        self.executeRequest(RTM_NEWADDR, NLM_F_CREATE | NLM_F_EXCL, struct.pack(ifaddrmsgFormat, socket.AF_INET, prefixLen, 0, RT_SCOPE_UNIVERSE, self.getLinkIndex(interfaceName)) +
+                                                                   packAttribute(IFA_LOCAL, address) + packAttribute(IFA_ADDRESS, address))
+
+    # Adds a directly connected route through the given interface for each of the prefixes, and returns each route's error number
+    def addRoutes(self, prefixes, interfaceName):
+        interfaceIndex = self.getLinkIndex(interfaceName)
+        requests = []
+        for prefix in prefixes:
+            destination, prefixLen = parsePrefix(prefix)
+            requests.append((RTM_NEWROUTE, NLM_F_CREATE | NLM_F_EXCL, struct.pack(rtmsgFormat, socket.AF_INET, prefixLen, 0, 0, RT_TABLE_MAIN, RTPROT_BOOT, RT_SCOPE_LINK, RTN_UNICAST, 0) +
+                                                                      packAttribute(RTA_DST, destination) + packAttribute(RTA_OIF, struct.pack('=I', interfaceIndex))))
+        return self.executeRequests(requests)
+
+    # Returns the prefixes of the main table's routes through the given interface that were added with addRoutes (or by 'ip route add')
+    def getRoutes(self, interfaceName):
+        interfaceIndex = self.getLinkIndex(interfaceName)
+        prefixes = []
+        for reply in self.query(RTM_GETROUTE, NLM_F_DUMP, struct.pack(rtmsgFormat, socket.AF_INET, 0, 0, 0, 0, 0, 0, 0, 0)):
+            family, prefixLen, _, _, table, protocol, _, routeType, _ = struct.unpack_from(rtmsgFormat, reply)
+            attributes = unpackAttributes(reply, struct.calcsize(rtmsgFormat))
+            if RTA_TABLE in attributes:
+                table = struct.unpack('=I', attributes[RTA_TABLE])[0]
+            if family != socket.AF_INET or table != RT_TABLE_MAIN or protocol != RTPROT_BOOT or routeType != RTN_UNICAST:
+                continue
+            if RTA_OIF not in attributes or struct.unpack('=I', attributes[RTA_OIF])[0] != interfaceIndex:
+                continue
+            prefixes.append(socket.inet_ntoa(attributes.get(RTA_DST, b'\0' * 4)) + '/' + str(prefixLen))
+        return prefixes
+
+    # Deletes the main table's route of each of the prefixes, and returns each route's error number
+    def deleteRoutes(self, prefixes):
+        requests = []
+        for prefix in prefixes:
+            destination, prefixLen = parsePrefix(prefix)
+            requests.append((RTM_DELROUTE, 0, struct.pack(rtmsgFormat, socket.AF_INET, prefixLen, 0, 0, RT_TABLE_MAIN, 0, RT_SCOPE_NOWHERE, 0, 0) + packAttribute(RTA_DST, destination)))
+        return self.executeRequests(requests)
@@ -0,0 +1,143 @@
+#!/usr/bin/python
+
+from IpsecManagerUtilityMethods import parseSubnet
+
+prefixMasks = [(0xffffffff << (32 - prefixLen)) & 0xffffffff for prefixLen in range(33)]
+
+def getCommonPrefixLen(network, otherNetwork, maxPrefixLen):
+    differentBits = network ^ otherNetwork
+    return min(maxPrefixLen, 32 - differentBits.bit_length())
+
+class PrefixTrieNode(object):
+    __slots__ = ['network', 'prefixLen', 'children', 'values']
+
+    def __init__(self, network, prefixLen, values = None):
+        self.network   = network
+        self.prefixLen = prefixLen
+        self.children  = [None, None]
+        self.values    = values if values != None else []
+
+    def contains(self, network, prefixLen):
+        return self.prefixLen <= prefixLen and (network & prefixMasks[self.prefixLen]) == self.network
+
+    def getChildIndex(self, network):
+        return (network >> (31 - self.prefixLen)) & 1
+
+# A path-compressed binary (radix) trie of IPv4 prefixes, each holding a list of values
+# Adding and removing a value takes O(prefix length). Finding the values of the prefixes that overlap a given prefix (those that contain it,
+# and those it contains) walks O(prefix length) nodes, plus the nodes of the prefixes it contains
+class PrefixTrie(object):
+    def __init__(self):
+        self.root = PrefixTrieNode(0, 0)
+
+    def add(self, subnet, value):
+        network, prefixLen = parseSubnet(subnet)
+        node = self.root
+        while not (node.network == network and node.prefixLen == prefixLen):
+            childIndex = node.getChildIndex(network)
+            child = node.children[childIndex]
+            if child is None:
+                node.children[childIndex] = PrefixTrieNode(network, prefixLen, [value])
+                return
+            if child.contains(network, prefixLen):
+                node = child
+                continue
+            # The child diverges from the prefix, so both are placed under a node holding their common prefix (which may be the prefix itself)
+            commonPrefixLen = getCommonPrefixLen(child.network, network, min(child.prefixLen, prefixLen))
+            branch = PrefixTrieNode(network & prefixMasks[commonPrefixLen], commonPrefixLen)
+            branch.children[branch.getChildIndex(child.network)] = child
+            if commonPrefixLen == prefixLen:
+                branch.values.append(value)
+            else:
+                branch.children[branch.getChildIndex(network)] = PrefixTrieNode(network, prefixLen, [value])
+            node.children[childIndex] = branch
+            return
+        node.values.append(value)
+
+    def remove(self, subnet, value):
+        network, prefixLen = parseSubnet(subnet)
+        path = [self.root]
+        while not (path[-1].network == network and path[-1].prefixLen == prefixLen):
+            child = path[-1].children[path[-1].getChildIndex(network)]
+            if child is None or not child.contains(network, prefixLen):
+                return
+            path.append(child)
+        if value in path[-1].values:
+            path[-1].values.remove(value)
+        # Nodes that no longer hold values nor split the trie are spliced out:
+        for node, parent in reversed(list(zip(path[1:], path[:-1]))):
+            if node.values or (node.children[0] and node.children[1]):
+                break
+            parent.children[parent.getChildIndex(node.network)] = node.children[0] or node.children[1]
+
+    def getOverlappingValues(self, subnet):
+        network, prefixLen = parseSubnet(subnet)
+        node = self.root
+        while node is not None:
+            if not node.contains(network, prefixLen):
+                # The node diverges from the prefix, or is contained by it (along with its whole subtree)
+                if node.prefixLen > prefixLen and (node.network & prefixMasks[prefixLen]) == network & prefixMasks[prefixLen]:
+                    for value in self.getSubtreeValues(node):
+                        yield value
+                return
+            for value in node.values:
+                yield value
+            if node.prefixLen == prefixLen:
+                for child in node.children:
+                    for value in self.getSubtreeValues(child):
+                        yield value
+                return
+            node = node.children[node.getChildIndex(network)]
+
+    def getSubtreeValues(self, node):
+        nodes = [node]
+        while nodes:
+            node = nodes.pop()
+            if node is None:
+                continue
+            for value in node.values:
+                yield value
+            nodes += node.children
+
+# Indexes tunnels by their (sourceIp, destIp) subnets, with a trie of source subnets whose values are tries of destination subnets
+# Two tunnels overlap when both their source subnets and their destination subnets overlap, since some packets would then match both tunnels' flows
+class TunnelOverlapIndex(object):
+    def __init__(self, tunnels = []):
+        self.sourceTrie   = PrefixTrie()
+        self.destTries    = {}
+        self.tunnelCounts = {}
+        for tunnel in tunnels:
+            self.add(tunnel)
+
+    def add(self, tunnel):
+        sourceIp, destIp = tunnel[1:3]
+        if sourceIp not in self.destTries:
+            self.destTries[sourceIp] = PrefixTrie()
+            self.tunnelCounts[sourceIp] = 0
+            self.sourceTrie.add(sourceIp, sourceIp)
+        self.destTries[sourceIp].add(destIp, tuple(tunnel))
+        self.tunnelCounts[sourceIp] += 1
+
+    def remove(self, tunnel):
+        sourceIp, destIp = tunnel[1:3]
+        if sourceIp not in self.destTries:
+            return
+        self.destTries[sourceIp].remove(destIp, tuple(tunnel))
+        self.tunnelCounts[sourceIp] -= 1
+        if self.tunnelCounts[sourceIp] == 0:
+            del self.destTries[sourceIp]
+            del self.tunnelCounts[sourceIp]
+            self.sourceTrie.remove(sourceIp, sourceIp)
+
+    # Yields the tunnels whose endpoints overlap the given source and destination subnets
+    def getOverlappingTunnels(self, sourceIp, destIp):
+        for overlappingSourceIp in self.sourceTrie.getOverlappingValues(sourceIp):
+            for tunnel in self.destTries[overlappingSourceIp].getOverlappingValues(destIp):
+                yield tunnel
+
+    # Yields a tunnel per source subnet that contains the given source subnet, or that it contains, without being the same subnet
+    def getNestedSourceTunnels(self, sourceIp):
+        for overlappingSourceIp in self.sourceTrie.getOverlappingValues(sourceIp):
+            if parseSubnet(overlappingSourceIp) != parseSubnet(sourceIp):
+                destTrie = self.destTries[overlappingSourceIp]
+                yield next(destTrie.getSubtreeValues(destTrie.root))
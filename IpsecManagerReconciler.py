@@ -0,0 +1,114 @@
+#!/usr/bin/python
+
+import re
+import socket
+import struct
+from collections import OrderedDict
+
+from IpsecManagerUtilityMethods import getPrefix, getCanonicalSubnet, getFirstHostIp, getFlowCookie, getArpSpoofedDestIps, ipForwardingFlowKind, arpSpoofingFlowKind
+
+# The kinds of changes in a reconcile plan, in the order they are applied
+reconcilePlanKeys = ['tunnelsToRemove', 'tunnelsToModify', 'tunnelsToAdd', 'ipFlowsToDelete', 'ipFlowsToAdd', 'arpFlowsToDelete', 'arpFlowsToSet', 'routesToDelete', 'routesToAdd']
+
+# Parses the output of 'ovs-ofctl dump-flows' into a (matchFields, actions) tuple per flow
+# matchFields maps each match field to its value, and protocol names (e.g. 'ip', 'arp') to None
+def parseDumpedFlows(dumpFlowsOutput):
+    flows = []
+    for line in dumpFlowsOutput.splitlines():
+        dataMatches = re.search(r'^\s*(?P<match>.*?)\s*actions=(?P<actions>\S+)\s*$', line)
+        if not dataMatches:
+            continue
+        matchFields = OrderedDict()
+        for field in re.split(r'[,\s]+', dataMatches.group('match')):
+            if field:
+                key, _, value = field.partition('=')
+                matchFields[key] = value if value else None
+        flows.append((matchFields, dataMatches.group('actions')))
+    return flows
+
+# Returns the gateway's flows, as installed by addIpsecTunnel:
+# ipFlows maps each (sourceIp, destIp) to the mac address it is forwarded to, and arpFlows maps each source ip to the ip its ARP replies are spoofed from
+# Subnets are keyed as OVS displays them (see getCanonicalSubnet)
+# Given the flowCookiePrefix, flows that aren't tagged with their cookie (e.g. flows installed before flows were tagged) are mapped to None, so they are replaced
+def getGatewayFlows(dumpFlowsOutput, gatewayOvsPort, flowCookiePrefix = None):
+    def cookieIsValid(matchFields, kind, subnets):
+        return flowCookiePrefix is None or int(matchFields.get('cookie') or '0', 16) == getFlowCookie(flowCookiePrefix, kind, subnets)
+
+    ipFlows = OrderedDict()
+    arpFlows = OrderedDict()
+    for matchFields, actions in parseDumpedFlows(dumpFlowsOutput):
+        if 'ip' in matchFields and 'nw_src' in matchFields and 'nw_dst' in matchFields and re.search(r'(^|,)(output:)?' + gatewayOvsPort + r'(,|$)', actions):
+            dataMatches = re.search(r'(mod_dl_dst:|set_field:)(?P<mac>([0-9A-Fa-f]{2}:){5}[0-9A-Fa-f]{2})', actions)
+            endpoints = (matchFields['nw_src'], matchFields['nw_dst'])
+            ipFlows[endpoints] = dataMatches.group('mac').lower() if dataMatches and cookieIsValid(matchFields, ipForwardingFlowKind, endpoints) else None
+        elif 'arp' in matchFields and matchFields.get('in_port') == gatewayOvsPort:
+            sourceIp = matchFields.get('arp_tpa', matchFields.get('nw_dst'))
+            dataMatches = re.search(r'load:0x(?P<hexIp>[0-9A-Fa-f]+)->NXM_OF_ARP_SPA\[\]', actions)
+            if dataMatches:
+                arpFlows[sourceIp] = socket.inet_ntoa(struct.pack('!I', int(dataMatches.group('hexIp'), 16)))
+            else:
+                dataMatches = re.search(r'set_field:(?P<ip>(\d+\.){3}\d+)->arp_spa', actions)
+                arpFlows[sourceIp] = dataMatches.group('ip') if dataMatches else None
+            if not cookieIsValid(matchFields, arpSpoofingFlowKind, [sourceIp]):
+                arpFlows[sourceIp] = None
+    return ipFlows, arpFlows
+
+# Returns whether a dumped flow belongs to the given gateway port: flows that forward packets to it, or that match the packets coming from it
+def flowUsesGatewayPort(matchFields, actions, gatewayOvsPort):
+    return matchFields.get('in_port') == gatewayOvsPort or bool(re.search(r'(^|,)(output:)?' + gatewayOvsPort + r'(,|$)', actions))
+
+# Indexes the gateway port's dumped flows by their cookies, and compares them with the expected flows, given as an OrderedDict of a flow per cookie
+# Returns an OrderedDict holding the orphanedFlows (dumped flows tagged with the cookiePrefix, whose cookie isn't expected) and the missingFlows (expected
+# flows whose cookie no dumped flow carries), each as a list of [cookie, flow] pairs
+# Flows of other ports (e.g. of other gateways on the same bridge) are ignored
+def auditFlowCookies(dumpFlowsOutput, expectedFlows, cookiePrefix, gatewayOvsPort):
+    dumpedFlowsByCookie = OrderedDict()
+    for line in dumpFlowsOutput.splitlines():
+        dataMatches = re.search(r'cookie=0x(?P<cookie>[0-9A-Fa-f]+)', line)
+        if dataMatches and any(flowUsesGatewayPort(matchFields, actions, gatewayOvsPort) for matchFields, actions in parseDumpedFlows(line)):
+            dumpedFlowsByCookie.setdefault(int(dataMatches.group('cookie'), 16), []).append(line.strip())
+
+    audit = OrderedDict([('orphanedFlows', []), ('missingFlows', [])])
+    for cookie, flows in dumpedFlowsByCookie.items():
+        if cookie >> 48 == cookiePrefix and cookie not in expectedFlows:
+            audit['orphanedFlows'] += [['0x%x' % cookie, flow] for flow in flows]
+    audit['missingFlows'] = [['0x%x' % cookie, flow] for cookie, flow in expectedFlows.items() if cookie not in dumpedFlowsByCookie]
+    return audit
+
+# Fields of a dumped flow that describe it rather than the packets it matches, and so are left out of its deletion
+dumpedFlowDescriptionFields = ['cookie', 'duration', 'n_packets', 'n_bytes', 'idle_age', 'hard_age', 'priority', 'idle_timeout', 'hard_timeout']
+
+# Returns the deletion of a dumped flow (as auditFlowCookies reports it): its exact cookie along with its match fields, as the removal paths delete flows,
+# so that a flow of another port that happens to carry the same cookie isn't deleted with it
+def getDumpedFlowDeletion(cookie, dumpedFlow):
+    matchFields, _ = parseDumpedFlows(dumpedFlow)[0]
+    return 'cookie=' + cookie + '/-1,' + ','.join(key if value is None else key + '=' + value for key, value in matchFields.items() if key not in dumpedFlowDescriptionFields)
+
+# Computes the minimal set of changes that converges the actual state (the tunnels in ipsec.conf, the gateway's flows and its routes) into the desired tunnels
+# Tunnels are tuples holding addIpsecTunnel's parameters. Returns an OrderedDict holding a list per reconcilePlanKeys entry
+def computeReconcilePlan(desiredTunnels, actualTunnels, ipFlows, arpFlows, routes, gatewayMacAddress):
+    plan = OrderedDict((key, []) for key in reconcilePlanKeys)
+    desiredTunnelsByName = OrderedDict((tunnel[0], tuple(tunnel)) for tunnel in desiredTunnels)
+    actualTunnelsByName = OrderedDict((tunnel[0], tuple(tunnel)) for tunnel in actualTunnels)
+
+    for name, tunnel in actualTunnelsByName.items():
+        if name not in desiredTunnelsByName:
+            plan['tunnelsToRemove'].append(name)
+        elif desiredTunnelsByName[name] != tunnel:
+            plan['tunnelsToModify'].append(desiredTunnelsByName[name])
+    plan['tunnelsToAdd'] = [tunnel for name, tunnel in desiredTunnelsByName.items() if name not in actualTunnelsByName]
+
+    desiredIpFlows = OrderedDict(((getCanonicalSubnet(tunnel[1]), getCanonicalSubnet(tunnel[2])), None) for tunnel in desiredTunnelsByName.values())
+    plan['ipFlowsToDelete'] = [list(endpoints) for endpoints in ipFlows if endpoints not in desiredIpFlows]
+    plan['ipFlowsToAdd'] = [list(endpoints) for endpoints in desiredIpFlows if ipFlows.get(endpoints) != gatewayMacAddress.lower()]
+
+    # Each source ip spoofs ARP replies from the destination that adding its tunnels would have picked (see getArpSpoofedDestIp)
+    desiredArpSpoofedDestIps = getArpSpoofedDestIps(desiredTunnelsByName.values())
+    plan['arpFlowsToDelete'] = [sourceIp for sourceIp in arpFlows if sourceIp not in desiredArpSpoofedDestIps]
+    plan['arpFlowsToSet'] = [[sourceIp, destIp] for sourceIp, destIp in desiredArpSpoofedDestIps.items() if arpFlows.get(sourceIp) != getFirstHostIp(destIp)]
+
+    desiredRoutes = OrderedDict((getPrefix(sourceIp), None) for sourceIp in desiredArpSpoofedDestIps)
+    plan['routesToDelete'] = [prefix for prefix in routes if prefix not in desiredRoutes]
+    plan['routesToAdd'] = [prefix for prefix in desiredRoutes if prefix not in routes]
+
+    return plan
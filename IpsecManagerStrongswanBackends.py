@@ -0,0 +1,390 @@
+#!/usr/bin/python
+
+import os
+import re
+import time
+import signal
+import socket
+import base64
+import binascii
+import threading
+from collections import OrderedDict
+
+from BashCommand import BashCommand, TimedBashCommand, TimeoutException, ConcurrentCommandRunner
+from IpsecManagerVici import ViciSession, ViciException, ViciCommandException, checkResponse, defaultViciSocketFilename
+from IpsecManagerTunnelStatus import parseStatusAll, createStatusRecord
+from IpsecManagerErrorHandlers import strongswanStopStderrHandler
+
+# Both backends expose the same methods. Tunnels are tuples holding addIpsecTunnel's parameters, and the tunnel store has already written
+# (or removed) their configuration files by the time a backend is asked to load (or unload) them
+# Raising a tunnel results in 'established', 'auth failed', 'unreachable' or 'failed'
+
+defaultUpdownScript = '/usr/libexec/strongswan/_updown iptables'
+
+# The settings that templates/ipsec.conf.template leaves to ipsec.conf's defaults, in VICI's terms, wherever VICI's defaults differ
+# keyexchange=ike initiates IKEv2 and accepts IKEv1 too (version 0), keyingtries=3, and reauth=yes, ikelifetime=3h, lifetime=1h, margintime=9m and
+# rekeyfuzz=100% reauthenticate the IKE SA, and rekey the CHILD SA, 9 to 18 minutes before they expire
+ipsecConfIkeDefaults   = [('version', '0'), ('keyingtries', '3'), ('reauth_time', '10260s'), ('rekey_time', '0s'), ('over_time', '540s'), ('rand_time', '540s')]
+ipsecConfChildDefaults = [('mode', 'tunnel'), ('rekey_time', '3060s'), ('life_time', '3600s'), ('rand_time', '540s')]
+
+# Classifies the output of 'strongswan up' as 'established', 'auth failed' or 'failed'
+def getTunnelUpResult(name, upOutput):
+    if 'connection \'' + name + '\' established successfully' in upOutput:
+        return 'established'
+    if 'AUTHENTICATION_FAILED' in upOutput or 'NO_PROPOSAL_CHOSEN' in upOutput:
+        return 'auth failed'
+    return 'failed'
+
+# Returns the pre-shared key of the ipsec.secrets template, decoded as strongswan decodes it ('0s' is base64, '0x' is hex, otherwise it's taken as is)
+def getPresharedKey(secretsTemplateFilename):
+    secretMatches = re.search(r':\s*PSK\s+(?P<secret>"[^"]*"|\S+)', open(secretsTemplateFilename).read())
+    if not secretMatches:
+        raise RuntimeError(secretsTemplateFilename + ' holds no pre-shared key')
+    secret = secretMatches.group('secret')
+    if secret.startswith('0s'):
+        return base64.b64decode(secret[2:])
+    if secret.startswith('0x'):
+        return binascii.unhexlify(secret[2:])
+    return secret.strip('"')
+
+def formatSeconds(seconds):
+    return seconds + ' seconds' if seconds is not None else None
+
+defaultCharonDaemonName = 'charon'
+
+# A charon instance along with the starter that runs it. The default instance is started, reloaded and stopped with the strongswan script,
+# which only knows the pid files of the default daemon name (starter.charon.pid and charon.pid), whichever strongswan.conf it is given
+# Any other instance (a named gateway's) is run by a starter of its own under a daemon name of its own, so its pid files (starter.<daemonName>.pid
+# and <daemonName>.pid) are its own, and it's reloaded and stopped by signalling that starter, once its pid file is confirmed to belong to it
+# The starter executes the daemon by its name from the strongswan libexec directory, where a link to charon is kept under the instance's name
+class CharonInstance(object):
+    def __init__(self, strongswanCommand = 'strongswan', daemonName = defaultCharonDaemonName, strongswanConfFilename = None, ipsecConfFilename = None):
+        self.strongswanCommand      = strongswanCommand
+        self.daemonName             = daemonName
+        self.strongswanConfFilename = strongswanConfFilename
+        self.ipsecConfFilename      = ipsecConfFilename
+        self.libexecDirectory       = '/usr/libexec/strongswan'
+        self.pidDirectory           = '/var/run'
+        self.stopTimeout            = 10
+
+    def isDefault(self):
+        return self.daemonName == defaultCharonDaemonName
+
+    # Returns the pid of the starter that runs this instance, or None when it isn't running. A stale pid file may name a process that
+    # reused the pid, so the pid only counts when that process is a starter that was given this instance's daemon name
+    def getStarterPid(self):
+        try:
+            starterPid = int(open(os.path.join(self.pidDirectory, 'starter.' + self.daemonName + '.pid')).read().strip())
+            starterArgv = open('/proc/' + str(starterPid) + '/cmdline').read().split('\0')
+        except (IOError, ValueError):
+            return None
+        daemonName = starterArgv[starterArgv.index('--daemon') + 1] if '--daemon' in starterArgv[:-1] else defaultCharonDaemonName
+        return starterPid if os.path.basename(starterArgv[0]) == 'starter' and daemonName == self.daemonName else None
+
+    def start(self):
+        if self.isDefault():
+            BashCommand(self.strongswanCommand + ' start').execute()
+            return
+        if self.getStarterPid() is not None:
+            raise RuntimeError(self.daemonName + ' is already running')
+        daemonLink = os.path.join(self.libexecDirectory, self.daemonName)
+        if not os.path.lexists(daemonLink):
+            os.symlink(defaultCharonDaemonName, daemonLink)
+        BashCommand('env STRONGSWAN_CONF=' + self.strongswanConfFilename + ' ' + os.path.join(self.libexecDirectory, 'starter') + ' --daemon ' + self.daemonName + ' --conf ' + self.ipsecConfFilename).execute()
+
+    # Has the instance re-read its ipsec.conf
+    def update(self):
+        if self.isDefault():
+            BashCommand(self.strongswanCommand + ' update').execute()
+            return
+        starterPid = self.getStarterPid()
+        if starterPid is None:
+            raise RuntimeError(self.daemonName + ' is not running')
+        os.kill(starterPid, signal.SIGHUP)
+
+    # Stopping an instance that isn't running isn't an error
+    def stop(self):
+        if self.isDefault():
+            BashCommand(self.strongswanCommand + ' stop', errorHandler=strongswanStopStderrHandler).execute()
+            return
+        starterPid = self.getStarterPid()
+        if starterPid is not None:
+            os.kill(starterPid, signal.SIGTERM)
+            deadline = time.time() + self.stopTimeout
+            while self.getStarterPid() == starterPid and time.time() < deadline:
+                time.sleep(0.1)
+            if self.getStarterPid() == starterPid:
+                raise RuntimeError(self.daemonName + ' is still running ' + str(self.stopTimeout) + ' seconds after it was stopped')
+        daemonLink = os.path.join(self.libexecDirectory, self.daemonName)
+        if os.path.islink(daemonLink):
+            os.remove(daemonLink)
+
+# Controls strongswan by executing 'strongswan' commands, which make charon re-read all of ipsec.conf and ipsec.secrets on every change
+# The strongswanCommand may select a charon instance of its own (e.g. a named gateway's, through its strongswan.conf), which charonInstance reloads
+# 'strongswan down' takes a single connection, so tearing tunnels down still executes a command per tunnel (concurrently, from a single poll loop)
+class StrongswanCommandBackend(object):
+    def __init__(self, strongswanCommand = 'strongswan', charonInstance = None):
+        self.strongswanCommand  = strongswanCommand
+        self.charonInstance     = charonInstance if charonInstance is not None else CharonInstance(strongswanCommand)
+        self.downTimeout        = 10
+        self.maxConcurrentDowns = 32
+
+    # Loads the tunnels whose configuration was written and drops the ones whose configuration was removed, then brings the dropped tunnels' SAs down
+    def updateTunnels(self, loadedTunnels, unloadedNames, localGatewayIp = None):
+        if loadedTunnels or unloadedNames:
+            self.charonInstance.update()
+            BashCommand(self.strongswanCommand + ' secrets').execute()
+        downCommands = [TimedBashCommand(self.strongswanCommand + ' down ' + name, timeout=self.downTimeout) for name in unloadedNames]
+        ConcurrentCommandRunner(self.maxConcurrentDowns).run(downCommands)
+        failedDownCommands = [downCommand for downCommand in downCommands if downCommand.timedOut or downCommand.returnCode != 0]
+        if failedDownCommands:
+            raise RuntimeError((os.linesep + '    ').join(['Failed to bring down ' + str(len(failedDownCommands)) + ' tunnels:'] +
+                                                          ['\'' + downCommand.command + '\' ' + ('timed out' if downCommand.timedOut else 'failed: ' + ' '.join(downCommand.errorOutput.split(os.linesep))) for downCommand in failedDownCommands]))
+
+    # Raises a single tunnel, and returns its result along with strongswan's output
+    def upTunnel(self, name, timeout):
+        upCommand = TimedBashCommand(self.strongswanCommand + ' up ' + name, timeout=timeout)
+        try:
+            upCommand.execute()
+        except TimeoutException:
+            return 'unreachable', ''
+        return getTunnelUpResult(name, upCommand.output), upCommand.output
+
+    # Raises the tunnels concurrently, and returns a (name, result) tuple per tunnel
+    def upTunnels(self, names, timeout, maxConcurrentUps):
+        upCommands = [TimedBashCommand(self.strongswanCommand + ' up ' + name, timeout=timeout) for name in names]
+        ConcurrentCommandRunner(maxConcurrentUps).run(upCommands)
+        return [(name, 'unreachable' if upCommand.timedOut else getTunnelUpResult(name, upCommand.output)) for name, upCommand in zip(names, upCommands)]
+
+    # Returns a status record per connection, as parsed by parseStatusAll
+    def getStatusRecords(self):
+        statusAllCommand = BashCommand(self.strongswanCommand + ' statusall')
+        statusAllCommand.execute()
+        return parseStatusAll(statusAllCommand.output.splitlines())
+
+    def close(self):
+        pass
+
+# Controls charon over its VICI socket, loading and unloading only the connections and pre-shared keys of the tunnels that changed
+# The configuration files are still written, so charon loads the tunnels from ipsec.conf when it is restarted. Tunnels loaded that way
+# (rather than over VICI) can't be unloaded over VICI, so removing them falls back to having charon re-read the configuration files
+# The session is shared by the daemon's threads and is reopened after charon restarts, while each concurrent initiate has a session of its own
+class ViciStrongswanBackend(object):
+    def __init__(self, socketFilename = defaultViciSocketFilename, secretsTemplateFilename = 'templates/ipsec.secrets.template', updownScript = defaultUpdownScript, strongswanCommand = 'strongswan', charonInstance = None):
+        self.socketFilename          = socketFilename
+        self.secretsTemplateFilename = secretsTemplateFilename
+        self.updownScript            = updownScript
+        self.strongswanCommand       = strongswanCommand
+        self.charonInstance          = charonInstance if charonInstance is not None else CharonInstance(strongswanCommand)
+        self.presharedKey            = None
+        self.lock                    = threading.Lock()
+        self.session                 = ViciSession(socketFilename)
+
+    # Sends the requests, given as (command, message) tuples, over the shared session, and returns their responses without checking them
+    def requestAll(self, requests):
+        with self.lock:
+            if self.session is None:
+                self.session = ViciSession(self.socketFilename)
+            try:
+                return self.session.requestAll(requests)
+            except (ViciException, socket.error):
+                # The session may be out of step with charon (or charon may have restarted), so the next request opens a new one
+                self.session.close()
+                self.session = None
+                raise
+
+    def streamedRequest(self, command, eventName, eventHandler):
+        with self.lock:
+            if self.session is None:
+                self.session = ViciSession(self.socketFilename)
+            try:
+                return checkResponse(command, self.session.streamedRequest(command, eventName, {}, eventHandler))
+            except ViciCommandException:
+                raise
+            except (ViciException, socket.error):
+                self.session.close()
+                self.session = None
+                raise
+
+    # The connection that templates/ipsec.conf.template describes: left/right are the addresses, leftsubnet/rightsubnet the traffic selectors,
+    # leftid/rightid the identities (authenticated by the pre-shared key of ipsec.secrets), leftfirewall=yes the updown script, and auto=add no start action
+    def getConnection(self, tunnel, localGatewayIp):
+        name, sourceIp, destIp, remoteGatewayIp, localId, remoteId = tunnel
+        child = OrderedDict([('local_ts', [sourceIp]), ('remote_ts', [destIp])] + ipsecConfChildDefaults +
+                            ([('updown', self.updownScript)] if self.updownScript else []) + [('start_action', 'none')])
+        return {name : OrderedDict([('local_addrs', [localGatewayIp]),
+                                    ('remote_addrs', [remoteGatewayIp])] + ipsecConfIkeDefaults +
+                                   [('local', OrderedDict([('auth', 'psk'), ('id', localId)])),
+                                    ('remote', OrderedDict([('auth', 'psk'), ('id', remoteId)])),
+                                    ('children', {name : child})])}
+
+    def getSharedKey(self, tunnel):
+        name, _, _, _, localId, remoteId = tunnel
+        if self.presharedKey is None:
+            self.presharedKey = getPresharedKey(self.secretsTemplateFilename)
+        return OrderedDict([('id', name), ('type', 'IKE'), ('data', self.presharedKey), ('owners', [localId, remoteId])])
+
+    def updateTunnels(self, loadedTunnels, unloadedNames, localGatewayIp = None):
+        requests = []
+        for name in unloadedNames:
+            requests += [('terminate', OrderedDict([('ike', name), ('force', 'yes'), ('timeout', '-1')])), ('unload-conn', {'name' : name}), ('unload-shared', {'id' : name})]
+        for tunnel in loadedTunnels:
+            requests += [('load-conn', self.getConnection(tunnel, localGatewayIp)), ('load-shared', self.getSharedKey(tunnel))]
+
+        namesLoadedFromFiles = []
+        for (command, message), response in zip(requests, self.requestAll(requests)):
+            # As with 'strongswan down', a tunnel whose SAs are already down isn't an error:
+            if command == 'terminate' and 'no matching SAs' in response.get('errmsg', ''):
+                continue
+            if command == 'unload-conn' and response.get('success') == 'no':
+                namesLoadedFromFiles.append(message['name'])
+                continue
+            if command == 'unload-shared':
+                continue
+            checkResponse(command, response)
+        if namesLoadedFromFiles:
+            self.charonInstance.update()
+            BashCommand(self.strongswanCommand + ' secrets').execute()
+
+    # Initiates the tunnel over the given session, collecting charon's log of the attempt, and returns its result along with the log
+    def initiateTunnel(self, session, name, timeout):
+        logLines = []
+        response = session.streamedRequest('initiate', 'control-log', OrderedDict([('child', name), ('ike', name), ('timeout', str(int(timeout * 1000)))]),
+                                           lambda event: logLines.append(event.get('msg', '')))
+        errorMessage = response.get('errmsg', '')
+        upOutput = os.linesep.join(logLines + ([errorMessage] if errorMessage else []))
+        if response.get('success') == 'yes':
+            return 'established', upOutput
+        if 'AUTHENTICATION_FAILED' in upOutput or 'NO_PROPOSAL_CHOSEN' in upOutput:
+            return 'auth failed', upOutput
+        if 'not established after' in errorMessage:
+            return 'unreachable', upOutput
+        return 'failed', upOutput
+
+    def upTunnel(self, name, timeout):
+        return self.upTunnelsWithOutput([name], timeout, 1)[0][1:]
+
+    def upTunnels(self, names, timeout, maxConcurrentUps):
+        return [(name, upResult) for name, upResult, _ in self.upTunnelsWithOutput(names, timeout, maxConcurrentUps)]
+
+    # Initiates the tunnels from up to maxConcurrentUps threads, each initiating one tunnel at a time over a session of its own
+    # charon gives up waiting for a tunnel once its timeout expires, and the session's own timeout only guards against charon not answering at all
+    def upTunnelsWithOutput(self, names, timeout, maxConcurrentUps):
+        pendingNames = list(reversed(names))
+        upResults = {}
+        pendingNamesLock = threading.Lock()
+
+        def initiatePendingTunnels():
+            session = None
+            while True:
+                with pendingNamesLock:
+                    if not pendingNames:
+                        break
+                    name = pendingNames.pop()
+                try:
+                    session = session or ViciSession(self.socketFilename, timeout + 5)
+                    upResults[name] = self.initiateTunnel(session, name, timeout)
+                except socket.timeout:
+                    upResults[name] = ('unreachable', '')
+                    session.close()
+                    session = None
+                except (ViciException, socket.error) as e:
+                    upResults[name] = ('failed', str(e))
+                    if session:
+                        session.close()
+                    session = None
+            if session:
+                session.close()
+
+        threads = [threading.Thread(target=initiatePendingTunnels) for _ in range(min(maxConcurrentUps, len(names)))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return [(name,) + upResults[name] for name in names]
+
+    # Returns a status record per connection, in the format of parseStatusAll, from charon's list-conns and list-sas
+    def getStatusRecords(self):
+        records = OrderedDict()
+
+        def addConnections(event):
+            for name in event:
+                records.setdefault(name, createStatusRecord())['loaded'] = True
+
+        def addSas(event):
+            for name, ikeSa in event.items():
+                record = records.setdefault(name, createStatusRecord())
+                record['ikeState'] = ikeSa.get('state')
+                record['lastRekey'] = formatSeconds(ikeSa.get('established'))
+                for childSa in ikeSa.get('child-sas', {}).values():
+                    # An installed CHILD_SA takes precedence over the rekeyed (or deleted) one it replaces
+                    if record['childState'] == 'INSTALLED' and childSa.get('state') != 'INSTALLED':
+                        continue
+                    record['childState'] = childSa.get('state')
+                    record['spiIn'] = childSa.get('spi-in')
+                    record['spiOut'] = childSa.get('spi-out')
+                    for field, key in [('bytesIn', 'bytes-in'), ('bytesOut', 'bytes-out'), ('packetsIn', 'packets-in'), ('packetsOut', 'packets-out')]:
+                        record[field] = int(childSa.get(key, 0))
+                    record['nextRekey'] = formatSeconds(childSa.get('rekey-time'))
+
+        self.streamedRequest('list-conns', 'list-conn', addConnections)
+        self.streamedRequest('list-sas', 'list-sa', addSas)
+        return records
+
+    def close(self):
+        with self.lock:
+            if self.session:
+                self.session.close()
+                self.session = None
+
+# The backends that can be requested explicitly, by the name that createStrongswanBackend receives
+strongswanBackendNames = ['cli', 'vici']
+
+# Uses the VICI backend once charon's VICI socket is available, and the 'strongswan' command backend until then. The socket is probed again
+# by every call until it's found, so a daemon that was started before charon, or a named gateway whose charon instance is only started by
+# createIpsecGateway, moves to VICI once charon is up. When VICI was requested explicitly, calls fail until the socket is available instead
+class SelectingStrongswanBackend(object):
+    def __init__(self, viciSocketFilename, secretsTemplateFilename, strongswanCommand, charonInstance, viciRequired = False):
+        self.viciSocketFilename      = viciSocketFilename
+        self.secretsTemplateFilename = secretsTemplateFilename
+        self.strongswanCommand       = strongswanCommand
+        self.charonInstance          = charonInstance
+        self.viciRequired            = viciRequired
+        self.commandBackend          = StrongswanCommandBackend(strongswanCommand, charonInstance)
+        self.viciBackend             = None
+        self.lock                    = threading.Lock()
+
+    def getBackend(self):
+        with self.lock:
+            if self.viciBackend is None:
+                try:
+                    self.viciBackend = ViciStrongswanBackend(self.viciSocketFilename, self.secretsTemplateFilename, strongswanCommand=self.strongswanCommand, charonInstance=self.charonInstance)
+                except socket.error as e:
+                    if self.viciRequired:
+                        raise RuntimeError('Charon\'s VICI socket (' + self.viciSocketFilename + ') isn\'t available: ' + str(e))
+                    return self.commandBackend
+            return self.viciBackend
+
+    def updateTunnels(self, loadedTunnels, unloadedNames, localGatewayIp = None):
+        return self.getBackend().updateTunnels(loadedTunnels, unloadedNames, localGatewayIp)
+
+    def upTunnel(self, name, timeout):
+        return self.getBackend().upTunnel(name, timeout)
+
+    def upTunnels(self, names, timeout, maxConcurrentUps):
+        return self.getBackend().upTunnels(names, timeout, maxConcurrentUps)
+
+    def getStatusRecords(self):
+        return self.getBackend().getStatusRecords()
+
+    def close(self):
+        with self.lock:
+            if self.viciBackend is not None:
+                self.viciBackend.close()
+        self.commandBackend.close()
+
+# Returns the 'strongswan' command backend when it's requested explicitly, and otherwise a backend that uses VICI once charon's VICI socket is available
+def createStrongswanBackend(backendName = None, viciSocketFilename = defaultViciSocketFilename, secretsTemplateFilename = 'templates/ipsec.secrets.template', strongswanCommand = 'strongswan', charonInstance = None):
+    if backendName == 'cli':
+        return StrongswanCommandBackend(strongswanCommand, charonInstance)
+    return SelectingStrongswanBackend(viciSocketFilename, secretsTemplateFilename, strongswanCommand, charonInstance, viciRequired=backendName == 'vici')
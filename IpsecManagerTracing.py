@@ -0,0 +1,231 @@
+#!/usr/bin/python
+
+import os
+import re
+import json
+import time
+import shlex
+import fcntl
+import binascii
+import tempfile
+import threading
+import functools
+
+# Tracing is enabled by setting either (or both) of these environment variables:
+#   IPSEC_MANAGER_TRACE_FILE   - each finished span is appended to this file as a single JSON line
+#   IPSEC_MANAGER_METRICS_FILE - a Prometheus textfile-collector snapshot (e.g. /var/lib/node_exporter/textfile/ipsecManager.prom),
+#                                rewritten whenever an operation finishes. The snapshot's counts accumulate across runs, and across processes
+traceFilenameVariable   = 'IPSEC_MANAGER_TRACE_FILE'
+metricsFilenameVariable = 'IPSEC_MANAGER_METRICS_FILE'
+
+durationBuckets = [0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10]
+
+# The exported metrics, with their type, labels and help
+metricDefinitions = [('ipsecmanager_command_duration_seconds',   'histogram', ['binary', 'operation'], 'Duration of the external commands executed by IpsecManager'),
+                     ('ipsecmanager_command_failures_total',     'counter',   ['binary', 'operation'], 'External commands that exited with a non-zero exit code'),
+                     ('ipsecmanager_command_timeouts_total',     'counter',   ['binary', 'operation'], 'External commands that were killed once their timeout expired'),
+                     ('ipsecmanager_operation_duration_seconds', 'histogram', ['operation'],           'Duration of IpsecManager\'s operations'),
+                     ('ipsecmanager_operation_errors_total',     'counter',   ['operation'],           'IpsecManager operations that raised an error')]
+
+def getSpanId():
+    return binascii.hexlify(os.urandom(8)).decode()
+
+def getArgv(command):
+    try:
+        return shlex.split(command)
+    except ValueError:
+        return command.split()
+
+# The binary that a command executes, past the 'env' and the variable assignments that precede it (e.g. 'env STRONGSWAN_CONF=<file> strongswan up')
+def getCommandBinary(argv):
+    for word in argv:
+        if os.path.basename(word) != 'env' and not re.search(r'^\w+=', word):
+            return os.path.basename(word)
+    return ''
+
+def formatLabels(labelNames, labelValues, extraLabels = ''):
+    labels = ','.join([name + '="' + value.replace('\\', '\\\\').replace('"', '\\"') + '"' for name, value in zip(labelNames, labelValues)] + ([extraLabels] if extraLabels else []))
+    return '{' + labels + '}'
+
+# Keeps a Prometheus histogram or counter per label values
+class Metrics(object):
+    def __init__(self):
+        self.values = dict((name, {}) for name, _, _, _ in metricDefinitions)
+        self.types = dict((name, metricType) for name, metricType, _, _ in metricDefinitions)
+
+    def observe(self, name, labelValues, value):
+        histogram = self.values[name].setdefault(tuple(labelValues), {'buckets' : [0] * len(durationBuckets), 'sum' : 0.0, 'count' : 0})
+        for index, bucket in enumerate(durationBuckets):
+            if value <= bucket:
+                histogram['buckets'][index] += 1
+        histogram['sum'] += value
+        histogram['count'] += 1
+
+    def increment(self, name, labelValues):
+        self.values[name][tuple(labelValues)] = self.values[name].get(tuple(labelValues), 0) + 1
+
+    # Adds the counts of other metrics to these
+    def add(self, metrics):
+        for name in self.values:
+            for labelValues, value in metrics.values[name].items():
+                if self.types[name] == 'counter':
+                    self.values[name][labelValues] = self.values[name].get(labelValues, 0) + value
+                    continue
+                histogram = self.values[name].setdefault(labelValues, {'buckets' : [0] * len(durationBuckets), 'sum' : 0.0, 'count' : 0})
+                histogram['buckets'] = [count + otherCount for count, otherCount in zip(histogram['buckets'], value['buckets'])]
+                histogram['sum'] += value['sum']
+                histogram['count'] += value['count']
+
+    def format(self):
+        lines = []
+        for name, metricType, labelNames, helpMessage in metricDefinitions:
+            lines += ['# HELP ' + name + ' ' + helpMessage, '# TYPE ' + name + ' ' + metricType]
+            for labelValues, value in sorted(self.values[name].items()):
+                if metricType == 'counter':
+                    lines.append(name + formatLabels(labelNames, labelValues) + ' ' + str(value))
+                    continue
+                for bucket, bucketCount in zip(durationBuckets, value['buckets']):
+                    lines.append(name + '_bucket' + formatLabels(labelNames, labelValues, 'le="' + repr(float(bucket)) + '"') + ' ' + str(bucketCount))
+                lines.append(name + '_bucket' + formatLabels(labelNames, labelValues, 'le="+Inf"') + ' ' + str(value['count']))
+                lines.append(name + '_sum' + formatLabels(labelNames, labelValues) + ' ' + repr(value['sum']))
+                lines.append(name + '_count' + formatLabels(labelNames, labelValues) + ' ' + str(value['count']))
+        return os.linesep.join(lines) + os.linesep
+
+    # Loads the values of a snapshot written by format, so that separate runs of ipsecManager.py accumulate into the same snapshot
+    def parse(self, content):
+        labelNamesByMetric = dict((name, labelNames) for name, _, labelNames, _ in metricDefinitions)
+        for line in content.splitlines():
+            dataMatches = re.search(r'^(?P<name>ipsecmanager_\w+?)(?P<suffix>_bucket|_sum|_count)?\{(?P<labels>.*)\} (?P<value>\S+)$', line)
+            if not dataMatches or dataMatches.group('name') not in self.values:
+                continue
+            name, suffix = dataMatches.group('name'), dataMatches.group('suffix')
+            labels = dict(re.findall(r'(\w+)="((?:[^"\\]|\\.)*)"', dataMatches.group('labels')))
+            labelValues = tuple(labels.get(labelName, '').replace('\\"', '"').replace('\\\\', '\\') for labelName in labelNamesByMetric[name])
+            if self.types[name] == 'counter':
+                self.values[name][labelValues] = int(float(dataMatches.group('value')))
+                continue
+            histogram = self.values[name].setdefault(labelValues, {'buckets' : [0] * len(durationBuckets), 'sum' : 0.0, 'count' : 0})
+            if suffix == '_sum':
+                histogram['sum'] = float(dataMatches.group('value'))
+            elif suffix == '_count':
+                histogram['count'] = int(float(dataMatches.group('value')))
+            elif suffix == '_bucket' and labels.get('le') != '+Inf':
+                bucket = float(labels.get('le'))
+                if bucket in durationBuckets:
+                    histogram['buckets'][durationBuckets.index(bucket)] = int(float(dataMatches.group('value')))
+
+# Records a span per IpsecManager operation, and a span per external command, nested under the operation that executed it
+# Spans are dictionaries, which are exported once they finish. Operations are tracked per thread, so the daemon's concurrent requests don't mix
+# The metrics only hold what was recorded since they were last added to the snapshot (see flushMetrics)
+# When neither file is set the tracer is disabled, and BashCommand and tracedOperation skip it after checking its enabled flag
+class Tracer(object):
+    def __init__(self, traceFilename = None, metricsFilename = None):
+        self.traceFilename   = traceFilename
+        self.metricsFilename = metricsFilename
+        self.enabled         = bool(traceFilename or metricsFilename)
+        self.lock            = threading.Lock()
+        self.context         = threading.local()
+        self.traceFile       = None
+        self.metrics         = None
+
+    def getOperationSpans(self):
+        if not hasattr(self.context, 'operationSpans'):
+            self.context.operationSpans = []
+        return self.context.operationSpans
+
+    def startSpan(self, kind, name):
+        operationSpans = self.getOperationSpans()
+        parentSpan = operationSpans[-1] if operationSpans else None
+        return {'kind'      : kind,
+                'name'      : name,
+                'traceId'   : parentSpan['traceId'] if parentSpan else getSpanId(),
+                'spanId'    : getSpanId(),
+                'parentId'  : parentSpan['spanId'] if parentSpan else None,
+                'operation' : operationSpans[0]['name'] if operationSpans else name if kind == 'operation' else '',
+                'start'     : time.time()}
+
+    def startCommandSpan(self, command):
+        span = self.startSpan('command', command)
+        span['argv'] = getArgv(command)
+        span['binary'] = getCommandBinary(span['argv'])
+        return span
+
+    def finishCommandSpan(self, span, exitCode, errorOutput, timedOut = False):
+        span['duration'] = time.time() - span['start']
+        span['exitCode'] = exitCode
+        span['stderrBytes'] = len(errorOutput) if errorOutput else 0
+        span['timedOut'] = timedOut
+        with self.lock:
+            metrics = self.getMetrics()
+            labelValues = [span['binary'], span['operation']]
+            metrics.observe('ipsecmanager_command_duration_seconds', labelValues, span['duration'])
+            if timedOut:
+                metrics.increment('ipsecmanager_command_timeouts_total', labelValues)
+            elif exitCode != 0:
+                metrics.increment('ipsecmanager_command_failures_total', labelValues)
+            self.exportSpan(span)
+
+    # Executes the function as an operation named after it: its commands (and nested operations) become its children
+    def traceOperation(self, name, function, args, kwargs):
+        span = self.startSpan('operation', name)
+        self.getOperationSpans().append(span)
+        error = None
+        try:
+            return function(*args, **kwargs)
+        except BaseException as e:
+            error = str(e).splitlines()[0] if str(e) else type(e).__name__
+            raise
+        finally:
+            self.getOperationSpans().pop()
+            span['duration'] = time.time() - span['start']
+            span['error'] = error
+            with self.lock:
+                metrics = self.getMetrics()
+                metrics.observe('ipsecmanager_operation_duration_seconds', [name], span['duration'])
+                if error is not None:
+                    metrics.increment('ipsecmanager_operation_errors_total', [name])
+                self.exportSpan(span)
+
+    def getMetrics(self):
+        if self.metrics is None:
+            self.metrics = Metrics()
+        return self.metrics
+
+    # Appends the span to the trace file, and rewrites the metrics snapshot once a top-level span finishes. Called with the lock held
+    def exportSpan(self, span):
+        if self.traceFilename:
+            if self.traceFile is None:
+                self.traceFile = open(self.traceFilename, 'a')
+            self.traceFile.write(json.dumps(span, sort_keys=True) + '\n')
+            self.traceFile.flush()
+        if self.metricsFilename and span['parentId'] is None:
+            self.flushMetrics()
+
+    # Adds the metrics to the snapshot. Other processes update the same snapshot, so it is read and replaced while holding a lock on
+    # its lock file, and is written to a temporary file of this process' own. The textfile collector may read the snapshot at any time,
+    # so it is replaced rather than rewritten
+    def flushMetrics(self):
+        metricsDirectory = os.path.dirname(os.path.abspath(self.metricsFilename))
+        with open(self.metricsFilename + '.lock', 'a') as lockFile:
+            fcntl.flock(lockFile.fileno(), fcntl.LOCK_EX)
+            snapshot = Metrics()
+            if os.path.exists(self.metricsFilename):
+                snapshot.parse(open(self.metricsFilename).read())
+            snapshot.add(self.getMetrics())
+            fileDescriptor, temporaryFilename = tempfile.mkstemp(prefix='.' + os.path.basename(self.metricsFilename) + '.', dir=metricsDirectory)
+            with os.fdopen(fileDescriptor, 'w') as metricsFile:
+                metricsFile.write(snapshot.format())
+            os.chmod(temporaryFilename, 0o644)
+            os.rename(temporaryFilename, self.metricsFilename)
+        self.metrics = Metrics()
+
+tracer = Tracer(os.environ.get(traceFilenameVariable), os.environ.get(metricsFilenameVariable))
+
+# Decorates IpsecManager's operations, so each call is traced as an operation span
+def tracedOperation(function):
+    @functools.wraps(function)
+    def tracedFunction(*args, **kwargs):
+        if not tracer.enabled:
+            return function(*args, **kwargs)
+        return tracer.traceOperation(function.__name__, function, args, kwargs)
+    return tracedFunction
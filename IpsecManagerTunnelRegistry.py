@@ -0,0 +1,150 @@
+#!/usr/bin/python
+
+import os
+import json
+import threading
+
+from IpsecManagerPrefixTrie import TunnelOverlapIndex
+from IpsecManagerUtilityMethods import getCanonicalSubnet
+
+# Holds the tunnels of a tunnel store (see IpsecManagerTunnelStore), indexed by name and by sourceIp (in its canonical form, as tunnels that were
+# added before their subnets were canonicalized may still hold a host address with its /32)
+# Tunnels whose endpoints overlap are looked up in a prefix trie index, which is only built once it is first needed
+# The store is parsed at most once per modification: the parsed tunnels are persisted in a compact sidecar file, stamped with
+# the store's stamp (e.g. ipsec.conf's inode, size and mtime), and are re-parsed only when the stamp no longer matches.
+# Callers that modify the store report the modification with add/remove, which keeps the indexes and sidecar valid without re-parsing
+# They pass the store's stamp as it was just before their modification, so a modification by another process is never mistaken for theirs
+# The registry may be shared by several threads, as long as the store isn't modified while other threads look tunnels up
+class TunnelRegistry(object):
+    def __init__(self, loadTunnels, getStamp, registryFilename):
+        self.loadTunnels        = loadTunnels
+        self.getStamp           = getStamp
+        self.registryFilename   = registryFilename
+        self.stamp              = None
+        self.tunnelsByName      = {}
+        self.tunnelsBySourceIp  = {}
+        self.tunnelNames        = []
+        self.overlapIndex       = None
+        self.lock               = threading.RLock()
+
+    # Makes sure the indexes match the store's current content
+    def refresh(self):
+        with self.lock:
+            stamp = self.getStamp()
+            if stamp is not None and stamp == self.stamp:
+                return
+
+            tunnels = self.loadRegistryFile(stamp)
+            if tunnels is None:
+                tunnels = self.loadTunnels() if stamp is not None else []
+                self.stamp = stamp
+                self.index(tunnels)
+                self.saveRegistryFile()
+            else:
+                self.stamp = stamp
+                self.index(tunnels)
+
+    def loadRegistryFile(self, stamp):
+        try:
+            registry = json.load(open(self.registryFilename))
+        except (IOError, ValueError):
+            return None
+        if stamp is None or registry.get('stamp') != stamp:
+            return None
+        return [tuple(str(field) if field is not None else None for field in tunnel) for tunnel in registry['tunnels']]
+
+    def saveRegistryFile(self):
+        if self.stamp is None:
+            return
+        temporaryFilename = self.registryFilename + '.tmp'
+        try:
+            with open(temporaryFilename, 'w') as registryFile:
+                json.dump({'stamp' : self.stamp, 'tunnels' : [self.tunnelsByName[name] for name in self.tunnelNames]}, registryFile, separators=(',', ':'))
+            os.rename(temporaryFilename, self.registryFilename)
+        except (IOError, OSError):
+            # The sidecar is only an optimization, the registry is rebuilt from the store whenever it is missing
+            pass
+
+    def index(self, tunnels):
+        self.tunnelsByName      = {}
+        self.tunnelsBySourceIp  = {}
+        self.tunnelNames        = []
+        self.overlapIndex       = None
+        self.indexTunnels(tunnels)
+
+    def indexTunnels(self, tunnels):
+        for tunnel in tunnels:
+            name, sourceIp = tunnel[:2]
+            self.tunnelsByName[name] = tunnel
+            self.tunnelsBySourceIp.setdefault(getCanonicalSubnet(sourceIp), []).append(name)
+            self.tunnelNames.append(name)
+            if self.overlapIndex is not None:
+                self.overlapIndex.add(tunnel)
+
+    # Records tunnels that were just added to the store
+    def add(self, tunnels, stampBeforeModification):
+        with self.lock:
+            if self.restampAfterModification(stampBeforeModification):
+                self.indexTunnels([tuple(tunnel) for tunnel in tunnels])
+                self.saveRegistryFile()
+
+    # Records tunnels that were just removed from the store
+    def remove(self, names, stampBeforeModification):
+        with self.lock:
+            if not self.restampAfterModification(stampBeforeModification):
+                return
+            names = set(names)
+            for name in names:
+                tunnel = self.tunnelsByName.pop(name, None)
+                if tunnel is None:
+                    continue
+                self.tunnelsBySourceIp[getCanonicalSubnet(tunnel[1])].remove(name)
+                if not self.tunnelsBySourceIp[getCanonicalSubnet(tunnel[1])]:
+                    del self.tunnelsBySourceIp[getCanonicalSubnet(tunnel[1])]
+                if self.overlapIndex is not None:
+                    self.overlapIndex.remove(tunnel)
+            self.tunnelNames = [name for name in self.tunnelNames if name not in names]
+            self.saveRegistryFile()
+
+    # When the store's content prior to the caller's modification is the indexed content, the indexes will be valid for the new content
+    # once the modification is applied to them, so only the stamp is taken anew
+    # If nothing was indexed yet, or the store was modified by someone else since it was indexed, the store is parsed with the
+    # modification already in it, and False is returned
+    def restampAfterModification(self, stampBeforeModification):
+        if self.stamp is None or stampBeforeModification is None or stampBeforeModification != self.stamp:
+            self.stamp = None
+            self.refresh()
+            return False
+        self.stamp = self.getStamp()
+        return True
+
+    def getTunnels(self):
+        with self.lock:
+            self.refresh()
+            return [self.tunnelsByName[name] for name in self.tunnelNames]
+
+    def getTunnel(self, name):
+        with self.lock:
+            self.refresh()
+            return self.tunnelsByName.get(name)
+
+    def getTunnelsBySourceIp(self, sourceIp):
+        with self.lock:
+            self.refresh()
+            return [self.tunnelsByName[name] for name in self.tunnelsBySourceIp.get(getCanonicalSubnet(sourceIp), [])]
+
+    # Returns the tunnels whose source subnet overlaps the given source subnet, and whose destination subnet overlaps the given destination subnet
+    def getOverlappingTunnels(self, sourceIp, destIp):
+        with self.lock:
+            self.refresh()
+            if self.overlapIndex is None:
+                self.overlapIndex = TunnelOverlapIndex([self.tunnelsByName[name] for name in self.tunnelNames])
+            return list(self.overlapIndex.getOverlappingTunnels(sourceIp, destIp))
+
+    # Returns a tunnel per source subnet that is nested in the given source subnet, or that it is nested in
+    def getNestedSourceTunnels(self, sourceIp):
+        with self.lock:
+            self.refresh()
+            if self.overlapIndex is None:
+                self.overlapIndex = TunnelOverlapIndex([self.tunnelsByName[name] for name in self.tunnelNames])
+            return list(self.overlapIndex.getNestedSourceTunnels(sourceIp))
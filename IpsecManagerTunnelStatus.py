@@ -0,0 +1,95 @@
+#!/usr/bin/python
+
+import re
+from collections import OrderedDict
+
+# The fields of a tunnel's status record, in the order they are displayed
+tunnelStatusFields = ['name', 'sourceIp', 'destIp', 'state', 'ikeState', 'childState', 'spiIn', 'spiOut', 'bytesIn', 'bytesOut', 'packetsIn', 'packetsOut', 'lastRekey', 'nextRekey']
+
+# The fields whose changes are reported by --watch (the counters and the rekey times change all the time)
+watchedTunnelStatusFields = ['state', 'ikeState', 'childState', 'spiIn', 'spiOut']
+
+def createStatusRecord():
+    return OrderedDict([('loaded', False), ('ikeState', None), ('childState', None), ('spiIn', None), ('spiOut', None), ('bytesIn', 0), ('bytesOut', 0),
+                        ('packetsIn', 0), ('packetsOut', 0), ('lastRekey', None), ('nextRekey', None)])
+
+# Parses the output of 'strongswan statusall' in a single pass over its lines, into a record per connection
+# Connections that are loaded but have no SAs only appear in the 'Connections:' section. When a connection has several CHILD_SAs
+# (e.g. while rekeying), the record holds the most recently installed one
+def parseStatusAll(lines):
+    records = OrderedDict()
+    section = None
+    for line in lines:
+        if not line.startswith(' '):
+            section = 'connections' if line.startswith('Connections:') else 'sas' if line.startswith('Security Associations') else None
+            continue
+        dataMatches = re.search(r'^\s*(?P<name>[^\s\[\{:]+)(\[(?P<ikeId>\d+)\]|\{(?P<childId>\d+)\})?:\s+(?P<details>.*)$', line)
+        if not dataMatches or section is None:
+            continue
+        record = records.setdefault(dataMatches.group('name'), createStatusRecord())
+        details = dataMatches.group('details')
+        if section == 'connections':
+            record['loaded'] = True
+        elif dataMatches.group('ikeId'):
+            stateMatches = re.search(r'^(?P<state>[A-Z_]+)(\s+(?P<age>.+?) ago)?,', details)
+            if stateMatches:
+                record['ikeState'] = stateMatches.group('state')
+                record['lastRekey'] = stateMatches.group('age')
+        elif dataMatches.group('childId'):
+            stateMatches = re.search(r'^(?P<state>[A-Z_]+),.*ESP (in UDP )?SPIs: (?P<spiIn>[0-9a-f]+)_i(\s+\([^)]*\))? (?P<spiOut>[0-9a-f]+)_o', details)
+            if stateMatches:
+                # An installed CHILD_SA takes precedence over the rekeyed (or deleted) one it replaces
+                if record['childState'] == 'INSTALLED' and stateMatches.group('state') != 'INSTALLED':
+                    continue
+                record['childState'] = stateMatches.group('state')
+                record['spiIn'] = stateMatches.group('spiIn')
+                record['spiOut'] = stateMatches.group('spiOut')
+                record['childId'] = dataMatches.group('childId')
+                continue
+            if dataMatches.group('childId') != record.get('childId'):
+                continue
+            trafficMatches = re.search(r'(?P<bytesIn>\d+) bytes_i( \((?P<packetsIn>\d+) pkts?[^)]*\))?, (?P<bytesOut>\d+) bytes_o( \((?P<packetsOut>\d+) pkts?[^)]*\))?', details)
+            if trafficMatches:
+                for field in ['bytesIn', 'bytesOut', 'packetsIn', 'packetsOut']:
+                    record[field] = int(trafficMatches.group(field) or 0)
+            rekeyMatches = re.search(r'rekeying in (?P<nextRekey>[^,]+)', details)
+            if rekeyMatches:
+                record['nextRekey'] = rekeyMatches.group('nextRekey')
+    return records
+
+# Summarizes a connection's IKE_SA and CHILD_SA states as 'established', 'rekeying', 'connecting', 'down' or 'not loaded'
+def getTunnelState(record):
+    if record is None or not (record['loaded'] or record['ikeState']):
+        return 'not loaded'
+    if 'REKEYING' in [record['ikeState'], record['childState']]:
+        return 'rekeying'
+    if record['ikeState'] == 'ESTABLISHED' and record['childState'] == 'INSTALLED':
+        return 'established'
+    if record['ikeState'] in ['CREATED', 'CONNECTING'] or (record['ikeState'] == 'ESTABLISHED' and record['childState'] is None):
+        return 'connecting'
+    return 'down'
+
+# Joins the configured tunnels with the parsed status records, returning a dictionary of tunnelStatusFields per tunnel
+def getTunnelStatuses(tunnels, records):
+    tunnelStatuses = []
+    for tunnel in tunnels:
+        name, sourceIp, destIp = tunnel[:3]
+        record = records.get(name)
+        tunnelStatus = OrderedDict([('name', name), ('sourceIp', sourceIp), ('destIp', destIp), ('state', getTunnelState(record))])
+        for field in tunnelStatusFields[len(tunnelStatus):]:
+            tunnelStatus[field] = record[field] if record else createStatusRecord()[field]
+        tunnelStatuses.append(tunnelStatus)
+    return tunnelStatuses
+
+# Compares two tunnelStatus results by their watchedTunnelStatusFields, and returns a (name, previousTunnelStatus, tunnelStatus) tuple per change,
+# where a tunnel that was added or removed has None in place of its missing status
+def getTunnelStatusChanges(previousTunnelStatuses, tunnelStatuses):
+    previousTunnelStatusesByName = OrderedDict((tunnelStatus['name'], tunnelStatus) for tunnelStatus in previousTunnelStatuses)
+    tunnelStatusesByName = OrderedDict((tunnelStatus['name'], tunnelStatus) for tunnelStatus in tunnelStatuses)
+    changes = []
+    for name, tunnelStatus in tunnelStatusesByName.items():
+        previousTunnelStatus = previousTunnelStatusesByName.get(name)
+        if previousTunnelStatus is None or [previousTunnelStatus[field] for field in watchedTunnelStatusFields] != [tunnelStatus[field] for field in watchedTunnelStatusFields]:
+            changes.append((name, previousTunnelStatus, tunnelStatus))
+    changes += [(name, previousTunnelStatus, None) for name, previousTunnelStatus in previousTunnelStatusesByName.items() if name not in tunnelStatusesByName]
+    return changes
@@ -0,0 +1,216 @@
+#!/usr/bin/python
+
+import os
+import re
+import glob
+from collections import OrderedDict
+
+from IpsecManagerTunnelRegistry import TunnelRegistry
+from IpsecManagerUtilityMethods import writeEntriesToFileFromTemplate, fillTemplateLines, writeFileAtomically, fsyncDirectory, removeLinesFromFile, getFileStamp, tunnelNameIsValid
+
+# The ipsec.conf keywords that hold each tunnel field, in the order of addIpsecTunnel's parameters (after the tunnel's name)
+tunnelFieldKeywords = ['leftsubnet', 'rightsubnet', 'right', 'leftid', 'rightid']
+
+# Parses the tunnels of an ipsec.conf file (or fragment) in a single pass. When a title line is given, only the tunnels that follow it are parsed
+# Each tunnel is represented by a tuple with the tunnel's name, source ip, destination ip, remote gateway ip, local id and remote id
+def parseIpsecConfTunnels(ipsecConfFileLines, ipsecConfTitleLine = None):
+    tunnels = []
+    tunnelFields = None
+    ipsecConfTitleLineFound = ipsecConfTitleLine is None
+    for line in ipsecConfFileLines:
+        line = line.strip()
+        if not ipsecConfTitleLineFound:
+            ipsecConfTitleLineFound = line == ipsecConfTitleLine
+            continue
+        dataMatches = re.search(r'^conn (?P<tunnelName>\S+)$', line)
+        if dataMatches:
+            tunnelFields = [dataMatches.group('tunnelName')] + [None] * len(tunnelFieldKeywords)
+            tunnels.append(tunnelFields)
+            continue
+        dataMatches = re.search(r'^(?P<keyword>\w+)=(?P<value>\S+)$', line)
+        if tunnelFields and dataMatches and dataMatches.group('keyword') in tunnelFieldKeywords:
+            tunnelFields[tunnelFieldKeywords.index(dataMatches.group('keyword')) + 1] = dataMatches.group('value')
+
+    return [tuple(tunnelFields) for tunnelFields in tunnels]
+
+# Splits the lines of an ipsec.conf file into the lines that precede its tunnels (the title line included), and the lines of each tunnel
+def splitIpsecConfTunnelSections(ipsecConfFileLines, ipsecConfTitleLine):
+    headLines = []
+    tunnelSections = OrderedDict()
+    tunnelName = None
+    ipsecConfTitleLineFound = False
+    for line in ipsecConfFileLines:
+        if not ipsecConfTitleLineFound:
+            ipsecConfTitleLineFound = line.strip() == ipsecConfTitleLine
+            headLines.append(line)
+            continue
+        dataMatches = re.search(r'^conn (?P<tunnelName>\S+)$', line.strip())
+        if dataMatches:
+            tunnelName = dataMatches.group('tunnelName')
+            tunnelSections[tunnelName] = []
+        if tunnelName is None:
+            headLines.append(line)
+        else:
+            tunnelSections[tunnelName].append(line)
+    return headLines, tunnelSections
+
+def secretsLineMatchesTunnels(line, names):
+    dataMatches = re.search(r'# (?P<tunnelName>\S+)$', line.strip())
+    return bool(dataMatches) and dataMatches.group('tunnelName') in names
+
+# A tunnel store keeps the strongswan configuration of the tunnels, and a registry that indexes them
+# Tunnels are tuples holding addIpsecTunnel's parameters
+class TunnelStore(object):
+    def __init__(self, ipsecConfTemplate, ipsecSecretsTemplate):
+        self.ipsecConfTemplate    = ipsecConfTemplate
+        self.ipsecSecretsTemplate = ipsecSecretsTemplate
+
+    def getIpsecConfReplacements(self, tunnel, localGatewayIp):
+        name, sourceIp, destIp, remoteGateway, localId, remoteId = tunnel
+        return {'LOCAL_GATEWAY_IP'  : localGatewayIp,
+                'REMOTE_GATEWAY_IP' : remoteGateway,
+                'SOURCE_IP'         : sourceIp,
+                'DEST_IP'           : destIp,
+                'LOCAL_ID'          : localId,
+                'REMOTE_ID'         : remoteId,
+                'TUNNEL_NAME'       : name}
+
+    def getIpsecSecretsReplacements(self, tunnel):
+        name, _, _, _, localId, remoteId = tunnel
+        return {'LOCAL_ID'    : localId,
+                'REMOTE_ID'   : remoteId,
+                'TUNNEL_NAME' : name}
+
+# Keeps all the tunnels in the section of ipsec.conf that follows its title line, and their secrets in ipsec.secrets
+# Adding tunnels appends to both files, and removing tunnels rewrites both files
+class MonolithicTunnelStore(TunnelStore):
+    def __init__(self, ipsecConfFilename, ipsecSecretsFilename, ipsecConfTitleLine, ipsecConfTemplate, ipsecSecretsTemplate, registryFilename):
+        super(MonolithicTunnelStore, self).__init__(ipsecConfTemplate, ipsecSecretsTemplate)
+        self.ipsecConfFilename    = ipsecConfFilename
+        self.ipsecSecretsFilename = ipsecSecretsFilename
+        self.ipsecConfTitleLine   = ipsecConfTitleLine
+        self.registry             = TunnelRegistry(self.loadTunnels, lambda: getFileStamp(self.ipsecConfFilename), registryFilename)
+
+    def loadTunnels(self):
+        return parseIpsecConfTunnels(open(self.ipsecConfFilename).readlines(), self.ipsecConfTitleLine)
+
+    def writeTunnels(self, tunnels, localGatewayIp):
+        stampBeforeModification = self.registry.getStamp()
+        with open(self.ipsecConfFilename, 'a') as ipsecConfFile:
+            writeEntriesToFileFromTemplate(self.ipsecConfTemplate, ipsecConfFile, [self.getIpsecConfReplacements(tunnel, localGatewayIp) for tunnel in tunnels])
+        self.registry.add(tunnels, stampBeforeModification)
+        with open(self.ipsecSecretsFilename, 'a') as ipsecSecretsFile:
+            writeEntriesToFileFromTemplate(self.ipsecSecretsTemplate, ipsecSecretsFile, [self.getIpsecSecretsReplacements(tunnel) for tunnel in tunnels])
+
+    def removeTunnels(self, names):
+        def confLineStartsTunnels(line):
+            dataMatches = re.search(r'^conn (?P<tunnelName>\S+)$', line)
+            return bool(dataMatches) and dataMatches.group('tunnelName') in names
+
+        def confLineStartsNextTunnel(line):
+            return bool(re.search(r'^conn \S', line)) and not confLineStartsTunnels(line)
+
+        removeLinesFromFile(self.ipsecSecretsFilename, lambda line: secretsLineMatchesTunnels(line, names), lambda line: not secretsLineMatchesTunnels(line, names))
+        stampBeforeModification = self.registry.getStamp()
+        removeLinesFromFile(self.ipsecConfFilename, confLineStartsTunnels, confLineStartsNextTunnel)
+        self.registry.remove(names, stampBeforeModification)
+
+# Keeps each tunnel in its own ipsec.conf fragment, and its secrets in its own ipsec.secrets fragment, which strongswan pulls in with include directives
+# A tunnel is located by its fragments' filenames: adding a tunnel atomically writes its two fragments, and removing it unlinks them,
+# so neither operation touches the other tunnels, and a crash never leaves a partially written fragment behind
+class FragmentTunnelStore(TunnelStore):
+    def __init__(self, confFragmentDirectory, secretsFragmentDirectory, ipsecConfTemplate, ipsecSecretsTemplate, registryFilename):
+        super(FragmentTunnelStore, self).__init__(ipsecConfTemplate, ipsecSecretsTemplate)
+        self.confFragmentDirectory    = confFragmentDirectory
+        self.secretsFragmentDirectory = secretsFragmentDirectory
+        self.registry                 = TunnelRegistry(self.loadTunnels, lambda: getFileStamp(self.confFragmentDirectory), registryFilename)
+
+    def getConfFragmentFilename(self, name):
+        return os.path.join(self.confFragmentDirectory, name + '.conf')
+
+    def getSecretsFragmentFilename(self, name):
+        return os.path.join(self.secretsFragmentDirectory, name + '.secrets')
+
+    def getConfIncludeLine(self):
+        return 'include ' + os.path.join(self.confFragmentDirectory, '*.conf')
+
+    def getSecretsIncludeLine(self):
+        return 'include ' + os.path.join(self.secretsFragmentDirectory, '*.secrets')
+
+    def createFragmentDirectories(self):
+        for directory in [self.confFragmentDirectory, self.secretsFragmentDirectory]:
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+
+    def loadTunnels(self):
+        tunnels = []
+        for confFragmentFilename in sorted(glob.glob(self.getConfFragmentFilename('*'))):
+            tunnels += parseIpsecConfTunnels(open(confFragmentFilename).readlines())
+        return tunnels
+
+    # The secrets fragment is written first, so a tunnel never exists (has a conf fragment) without its secrets
+    def writeTunnels(self, tunnels, localGatewayIp):
+        for name in [tunnel[0] for tunnel in tunnels]:
+            if not tunnelNameIsValid(name):
+                raise RuntimeError('\'' + name + '\' can\'t be used as a tunnel fragment\'s filename')
+        ipsecConfTemplateLines = open(self.ipsecConfTemplate).readlines()
+        ipsecSecretsTemplateLines = open(self.ipsecSecretsTemplate).readlines()
+        self.createFragmentDirectories()
+        for tunnel in tunnels:
+            writeFileAtomically(self.getSecretsFragmentFilename(tunnel[0]), fillTemplateLines(ipsecSecretsTemplateLines, self.getIpsecSecretsReplacements(tunnel)), mode=0o600, syncDirectory=False)
+        fsyncDirectory(self.secretsFragmentDirectory)
+        stampBeforeModification = self.registry.getStamp()
+        for tunnel in tunnels:
+            writeFileAtomically(self.getConfFragmentFilename(tunnel[0]), fillTemplateLines(ipsecConfTemplateLines, self.getIpsecConfReplacements(tunnel, localGatewayIp)), syncDirectory=False)
+        fsyncDirectory(self.confFragmentDirectory)
+        self.registry.add(tunnels, stampBeforeModification)
+
+    # The conf fragment is removed first, so a tunnel never exists (has a conf fragment) without its secrets
+    def removeTunnels(self, names):
+        stampBeforeModification = self.registry.getStamp()
+        for name in names:
+            if os.path.exists(self.getConfFragmentFilename(name)):
+                os.remove(self.getConfFragmentFilename(name))
+        fsyncDirectory(self.confFragmentDirectory)
+        for name in names:
+            if os.path.exists(self.getSecretsFragmentFilename(name)):
+                os.remove(self.getSecretsFragmentFilename(name))
+        fsyncDirectory(self.secretsFragmentDirectory)
+        self.registry.remove(names, stampBeforeModification)
+
+def joinLinesWithIncludeLine(lines, includeLine):
+    content = ''.join(lines)
+    if includeLine in [line.strip() for line in lines]:
+        return content
+    if content and not content.endswith(os.linesep):
+        content += os.linesep
+    return content + includeLine + os.linesep
+
+# Moves the tunnels in ipsec.conf's monolithic section (and their secrets) into the fragment store's fragments, and replaces them with include directives
+# Each tunnel's fragments hold its exact lines. The fragments are written before ipsec.conf and ipsec.secrets are atomically rewritten,
+# so a crash never loses a tunnel, and the migration can simply be repeated. Returns the names of the migrated tunnels
+# Nothing is migrated if any tunnel's name can't be a fragment's filename, or if several tunnels share a name (and so a fragment)
+def migrateTunnelsToFragments(ipsecConfFilename, ipsecSecretsFilename, ipsecConfTitleLine, fragmentTunnelStore):
+    ipsecConfLines = open(ipsecConfFilename).readlines()
+    names = [tunnel[0] for tunnel in parseIpsecConfTunnels(ipsecConfLines, ipsecConfTitleLine)]
+    errors = ['\'' + name + '\' can\'t be used as a tunnel fragment\'s filename' for name in OrderedDict.fromkeys(names) if not tunnelNameIsValid(name)]
+    errors += ['Several tunnels are named \'' + name + '\'' for name in OrderedDict.fromkeys(names) if names.count(name) > 1]
+    if errors:
+        raise RuntimeError((os.linesep + '    ').join(['No tunnels were migrated:'] + errors))
+    headLines, tunnelSections = splitIpsecConfTunnelSections(ipsecConfLines, ipsecConfTitleLine)
+    ipsecSecretsLines = open(ipsecSecretsFilename).readlines()
+
+    fragmentTunnelStore.createFragmentDirectories()
+    for name in tunnelSections:
+        tunnelSecretsLines = [line for line in ipsecSecretsLines if secretsLineMatchesTunnels(line, [name])]
+        writeFileAtomically(fragmentTunnelStore.getSecretsFragmentFilename(name), ''.join(tunnelSecretsLines), mode=0o600, syncDirectory=False)
+    fsyncDirectory(fragmentTunnelStore.secretsFragmentDirectory)
+    for name, sectionLines in tunnelSections.items():
+        writeFileAtomically(fragmentTunnelStore.getConfFragmentFilename(name), ''.join(sectionLines), syncDirectory=False)
+    fsyncDirectory(fragmentTunnelStore.confFragmentDirectory)
+
+    writeFileAtomically(ipsecConfFilename, joinLinesWithIncludeLine(headLines, fragmentTunnelStore.getConfIncludeLine()))
+    keptSecretsLines = [line for line in ipsecSecretsLines if not secretsLineMatchesTunnels(line, tunnelSections)]
+    writeFileAtomically(ipsecSecretsFilename, joinLinesWithIncludeLine(keptSecretsLines, fragmentTunnelStore.getSecretsIncludeLine()))
+
+    return list(tunnelSections)
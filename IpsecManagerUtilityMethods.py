@@ -1,9 +1,14 @@
 #!/usr/bin/python
 #written by Gavi - gavi@mellanox.com
 
+import os
+import re
 import socket
 import fcntl
+import hashlib
 import struct
+import tempfile
+from collections import OrderedDict
 from BashCommand import BashCommand
 
 def writeToFileFromTemplate(templateFilename, destinationFile, replacementDictionary = {}):
@@ -13,9 +18,64 @@ def writeToFileFromTemplate(templateFilename, destinationFile, replacementDictio
                 line = line.replace(key, replacementDictionary[key])
             destinationFile.write(line)
 
+def writeEntriesToFileFromTemplate(templateFilename, destinationFile, replacementDictionaries):
+    templateLines = open(templateFilename, 'rt').readlines()
+    for replacementDictionary in replacementDictionaries:
+        destinationFile.write(fillTemplateLines(templateLines, replacementDictionary))
+
+def fillTemplateLines(templateLines, replacementDictionary):
+    filledLines = []
+    for line in templateLines:
+        for key in replacementDictionary:
+            line = line.replace(key, replacementDictionary[key])
+        filledLines.append(line)
+    return ''.join(filledLines)
+
+# Replaces the file's content without ever leaving it partially written: the content is written to a temporary file in the same
+# directory, flushed to disk, and renamed over the file. The file keeps its permissions, and new files are created with the given mode
+# Callers that write many files to the same directory may skip syncing the directory, and sync it once when they are done
+def writeFileAtomically(filename, content, mode = 0o644, syncDirectory = True):
+    directory = os.path.dirname(filename) or '.'
+    if os.path.exists(filename):
+        mode = os.stat(filename).st_mode & 0o7777
+    fileDescriptor, temporaryFilename = tempfile.mkstemp(prefix='.' + os.path.basename(filename) + '.', dir=directory)
+    try:
+        with os.fdopen(fileDescriptor, 'w') as temporaryFile:
+            temporaryFile.write(content)
+            temporaryFile.flush()
+            os.fsync(temporaryFile.fileno())
+        os.chmod(temporaryFilename, mode)
+        os.rename(temporaryFilename, filename)
+    except BaseException:
+        if os.path.exists(temporaryFilename):
+            os.remove(temporaryFilename)
+        raise
+    if syncDirectory:
+        fsyncDirectory(directory)
+
+# Makes the creation, renaming and removal of the directory's entries durable
+def fsyncDirectory(directory):
+    directoryDescriptor = os.open(directory, os.O_RDONLY)
+    try:
+        os.fsync(directoryDescriptor)
+    finally:
+        os.close(directoryDescriptor)
+
+def removeFileIfExists(filename):
+    if os.path.exists(filename):
+        os.remove(filename)
+
+# Returns a value that changes whenever the file is replaced or modified, or None if the file doesn't exist
+def getFileStamp(filename):
+    try:
+        fileStat = os.stat(filename)
+    except OSError:
+        return None
+    return [fileStat.st_ino, fileStat.st_size, repr(fileStat.st_mtime)]
+
 def removeLinesFromFile(filename, isFirstLineToOmit, isFirstLineToContinue):
     lines = open(filename, 'r').readlines()
-    outFile = open(filename, 'w+')
+    keptLines = []
     inLinesToOmit = False
     for line in lines:
         if inLinesToOmit:
@@ -23,7 +83,8 @@ def removeLinesFromFile(filename, isFirstLineToOmit, isFirstLineToContinue):
         else:
             inLinesToOmit = isFirstLineToOmit(line.strip())
         if not inLinesToOmit:
-            outFile.write(line)
+            keptLines.append(line)
+    writeFileAtomically(filename, ''.join(keptLines))
 
 def interfaceExists(interfaceName):
     try:
@@ -42,3 +103,50 @@ def getMacAddr(interfaceName):
 
 def convertIpToHex(ip):
     return ''.join([format(int(ipField), '02x') for ipField in ip.split('.')])
+
+# Parses an ip address, or a subnet in CIDR notation, into its network address (as an integer) and its prefix length
+def parseSubnet(subnet):
+    ip, _, prefixLen = subnet.partition('/')
+    return struct.unpack('!I', socket.inet_aton(ip))[0], int(prefixLen) if prefixLen else 32
+
+# Returns the subnet as '<ip>/<prefixLen>', as routes are given
+def getPrefix(subnet):
+    return subnet if '/' in subnet else subnet + '/32'
+
+# Returns the subnet as OVS displays it in its flows: host addresses without a prefix length
+def getCanonicalSubnet(subnet):
+    return subnet[:-len('/32')] if subnet.endswith('/32') else subnet
+
+# Returns the first host address of the subnet (the address itself, for host addresses and /31 subnets)
+def getFirstHostIp(subnet):
+    network, prefixLen = parseSubnet(subnet)
+    return socket.inet_ntoa(struct.pack('!I', network + 1 if prefixLen < 31 else network))
+
+# The destination that a source ip shared by several tunnels spoofs its ARP replies from: the lowest of the tunnels' destinations,
+# so adding, removing, reconciling and auditing tunnels all pick the same one, whatever order the tunnels are stored in
+def getArpSpoofedDestIp(destIps):
+    return min(destIps, key=parseSubnet)
+
+# Maps each source ip of the given tunnels (in its canonical form) to the destination it spoofs ARP replies from (see getArpSpoofedDestIp)
+def getArpSpoofedDestIps(tunnels):
+    destIpsBySourceIp = OrderedDict()
+    for tunnel in tunnels:
+        destIpsBySourceIp.setdefault(getCanonicalSubnet(tunnel[1]), []).append(tunnel[2])
+    return OrderedDict((sourceIp, getArpSpoofedDestIp(destIps)) for sourceIp, destIps in destIpsBySourceIp.items())
+
+ipForwardingFlowKind = 0
+arpSpoofingFlowKind  = 1
+
+# Returns the cookie of a flow that IpsecManager installs: the manager-wide cookiePrefix in the top 16 bits, the flow's kind in the next bit, and a 47-bit hash of
+# the subnets the flow is keyed by (a tunnel's source and destination subnets for its ip forwarding flow, the source subnet for the ARP spoofing flow its tunnels share)
+def getFlowCookie(cookiePrefix, kind, subnets):
+    digest = hashlib.md5('>'.join([getCanonicalSubnet(subnet) for subnet in subnets]).encode()).hexdigest()
+    return (cookiePrefix << 48) | (kind << 47) | (int(digest[:12], 16) & ((1 << 47) - 1))
+
+# Tunnel names are the filenames of their fragments (see FragmentTunnelStore), so they can't hold path separators, or start with a dot
+def tunnelNameIsValid(tunnelName):
+    return bool(re.search(r'^[\w.-]+$', tunnelName)) and not tunnelName.startswith('.')
+
+# Named gateways' interfaces (ovs_<name> and ipsec_<name>) must fit in the 15 characters of an interface name
+def gatewayNameIsValid(gatewayName):
+    return bool(re.search(r'^[A-Za-z0-9]{1,9}$', gatewayName))
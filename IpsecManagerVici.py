@@ -0,0 +1,228 @@
+#!/usr/bin/python
+
+import socket
+import struct
+from collections import OrderedDict
+
+from IpsecManagerTracing import tracer
+
+CMD_REQUEST      = 0
+CMD_RESPONSE     = 1
+CMD_UNKNOWN      = 2
+EVENT_REGISTER   = 3
+EVENT_UNREGISTER = 4
+EVENT_CONFIRM    = 5
+EVENT_UNKNOWN    = 6
+EVENT            = 7
+
+SECTION_START    = 1
+SECTION_END      = 2
+KEY_VALUE        = 3
+LIST_START       = 4
+LIST_ITEM        = 5
+LIST_END         = 6
+
+# Packet types that carry a command or event name before their message
+namedPacketTypes = [CMD_REQUEST, EVENT_REGISTER, EVENT_UNREGISTER, EVENT]
+
+defaultViciSocketFilename = '/var/run/charon.vici'
+
+# The amount of commands sent before waiting for their responses
+maxRequestsPerBatch = 256
+
+class ViciException(RuntimeError):
+    pass
+
+# Raised when charon answers a command with a failure, which leaves the session usable
+class ViciCommandException(ViciException):
+    def __init__(self, command, errorMessage):
+        super(ViciCommandException, self).__init__('VICI ' + command + ' failed: ' + errorMessage)
+        self.errorMessage = errorMessage
+
+def toBytes(value):
+    return value if isinstance(value, bytes) else str(value).encode('latin-1')
+
+def toString(data):
+    return data if isinstance(data, str) else data.decode('latin-1')
+
+def packName(name):
+    name = toBytes(name)
+    return struct.pack('!B', len(name)) + name
+
+def packValue(value):
+    value = toBytes(value)
+    return struct.pack('!H', len(value)) + value
+
+# Encodes a message, given as a dictionary whose values are strings (key-values), lists of strings (lists) or dictionaries (sections)
+def packMessage(message):
+    data = []
+    for key, value in message.items():
+        if isinstance(value, dict):
+            data += [struct.pack('!B', SECTION_START), packName(key), packMessage(value), struct.pack('!B', SECTION_END)]
+        elif isinstance(value, list):
+            data += [struct.pack('!B', LIST_START), packName(key)] + [struct.pack('!B', LIST_ITEM) + packValue(item) for item in value] + [struct.pack('!B', LIST_END)]
+        else:
+            data += [struct.pack('!B', KEY_VALUE), packName(key), packValue(value)]
+    return b''.join(data)
+
+# Decodes a message into nested OrderedDicts, the inverse of packMessage
+def unpackMessage(data):
+    message = OrderedDict()
+    sections = [message]
+    currentList = None
+    offset = 0
+    try:
+        while offset < len(data):
+            elementType = struct.unpack_from('!B', data, offset)[0]
+            offset += 1
+            if elementType in [SECTION_START, KEY_VALUE, LIST_START]:
+                nameLen = struct.unpack_from('!B', data, offset)[0]
+                name = toString(data[offset + 1:offset + 1 + nameLen])
+                offset += 1 + nameLen
+            if elementType in [KEY_VALUE, LIST_ITEM]:
+                valueLen = struct.unpack_from('!H', data, offset)[0]
+                value = toString(data[offset + 2:offset + 2 + valueLen])
+                offset += 2 + valueLen
+            if offset > len(data):
+                raise struct.error()
+
+            if elementType == SECTION_START:
+                sections[-1][name] = OrderedDict()
+                sections.append(sections[-1][name])
+            elif elementType == SECTION_END and len(sections) > 1:
+                sections.pop()
+            elif elementType == KEY_VALUE:
+                sections[-1][name] = value
+            elif elementType == LIST_START:
+                currentList = sections[-1][name] = []
+            elif elementType == LIST_ITEM and currentList is not None:
+                currentList.append(value)
+            elif elementType == LIST_END:
+                currentList = None
+            else:
+                raise ViciException('Malformed VICI message: unexpected element type ' + str(elementType))
+    except struct.error:
+        raise ViciException('Malformed VICI message: truncated element')
+    return message
+
+def packPacket(packetType, name = None, message = None):
+    packet = struct.pack('!B', packetType) + (packName(name) if packetType in namedPacketTypes else b'') + (packMessage(message) if message else b'')
+    return struct.pack('!I', len(packet)) + packet
+
+# Returns the type, name (None for unnamed packet types) and message of a packet, without its length header
+def unpackPacket(packet):
+    packetType = struct.unpack_from('!B', packet)[0]
+    offset = 1
+    name = None
+    if packetType in namedPacketTypes:
+        nameLen = struct.unpack_from('!B', packet, offset)[0]
+        name = toString(packet[offset + 1:offset + 1 + nameLen])
+        offset += 1 + nameLen
+    return packetType, name, unpackMessage(packet[offset:])
+
+# Raises the error of a command's response, if it reports one. Responses that don't report success at all (e.g. list-sas') are accepted
+def checkResponse(command, response):
+    if response.get('success') == 'no':
+        raise ViciCommandException(command, response.get('errmsg', 'unknown error'))
+    return response
+
+# A connection to charon's VICI socket, over which commands are answered in the order they were sent
+# A command that reports its progress with events (e.g. initiate's control-log) has its events delivered before its response
+class ViciSession(object):
+    def __init__(self, socketFilename = defaultViciSocketFilename, timeout = None):
+        self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.socket.settimeout(timeout)
+        try:
+            self.socket.connect(socketFilename)
+        except socket.error:
+            self.socket.close()
+            raise
+
+    def close(self):
+        self.socket.close()
+
+    def sendPackets(self, packets):
+        try:
+            self.socket.sendall(b''.join(packets))
+        except socket.timeout:
+            raise
+        except socket.error as e:
+            raise ViciException('The VICI connection to charon failed: ' + str(e))
+
+    def receiveExactly(self, length):
+        chunks = []
+        while length > 0:
+            try:
+                chunk = self.socket.recv(length)
+            except socket.timeout:
+                raise
+            except socket.error as e:
+                raise ViciException('The VICI connection to charon failed: ' + str(e))
+            if not chunk:
+                raise ViciException('charon closed the VICI connection')
+            chunks.append(chunk)
+            length -= len(chunk)
+        return b''.join(chunks)
+
+    def receivePacket(self):
+        packetLen = struct.unpack('!I', self.receiveExactly(4))[0]
+        return unpackPacket(self.receiveExactly(packetLen))
+
+    # Receives the response of the given command, passing the events that arrive before it to the eventHandler
+    def receiveResponse(self, command, eventHandler = None):
+        while True:
+            packetType, eventName, packetMessage = self.receivePacket()
+            if packetType == EVENT:
+                if eventHandler:
+                    eventHandler(eventName, packetMessage)
+                continue
+            if packetType == CMD_UNKNOWN:
+                raise ViciException('charon does not support the VICI command ' + command)
+            if packetType != CMD_RESPONSE:
+                raise ViciException('Unexpected VICI packet of type ' + str(packetType) + ' in response to ' + command)
+            return packetMessage
+
+    # Sends a command and returns its response message. Events that arrive in the meantime are passed to the eventHandler
+    def request(self, command, message = None, eventHandler = None):
+        return self.requestAll([(command, message)], eventHandler)[0]
+
+    # Sends many commands, given as (command, message) tuples, and returns their responses in order. charon answers a session's commands one
+    # at a time, so the commands are sent together (in batches that keep the responses within the socket's buffers) rather than a round trip each
+    def requestAll(self, requests, eventHandler = None):
+        span = tracer.startCommandSpan(' '.join(['vici'] + list(OrderedDict((command, None) for command, _ in requests)))) if tracer.enabled else None
+        responses = []
+        timedOut = False
+        try:
+            for batchStart in range(0, len(requests), maxRequestsPerBatch):
+                batch = requests[batchStart:batchStart + maxRequestsPerBatch]
+                self.sendPackets([packPacket(CMD_REQUEST, command, message) for command, message in batch])
+                for command, _ in batch:
+                    responses.append(self.receiveResponse(command, eventHandler))
+            return responses
+        except socket.timeout:
+            timedOut = True
+            raise
+        finally:
+            if span:
+                failedResponses = [response for response in responses if response.get('success') == 'no']
+                failed = len(responses) < len(requests) or failedResponses
+                tracer.finishCommandSpan(span, 1 if failed else 0, ''.join(response.get('errmsg', '') for response in failedResponses), timedOut)
+
+    # Sends a command whose progress is streamed as the given event, calling the eventHandler with each event's message, and returns its response
+    def streamedRequest(self, command, eventName, message, eventHandler):
+        self.registerEvent(EVENT_REGISTER, eventName)
+        try:
+            return self.request(command, message, lambda name, eventMessage: eventHandler(eventMessage) if name == eventName else None)
+        finally:
+            self.registerEvent(EVENT_UNREGISTER, eventName)
+
+    def registerEvent(self, packetType, eventName):
+        self.sendPackets([packPacket(packetType, eventName)])
+        while True:
+            replyType, _, _ = self.receivePacket()
+            if replyType == EVENT_CONFIRM:
+                return
+            if replyType == EVENT_UNKNOWN:
+                raise ViciException('charon does not support the VICI event ' + eventName)
+            if replyType != EVENT:
+                raise ViciException('Unexpected VICI packet of type ' + str(replyType) + ' in response to registering ' + eventName)
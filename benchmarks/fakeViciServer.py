@@ -0,0 +1,184 @@
+#!/usr/bin/python
+
+# A stand-in for charon's VICI socket, which keeps the loaded connections, pre-shared keys and SAs in memory
+# It answers load-conn, unload-conn, load-shared, unload-shared, initiate (streaming control-log events), terminate, list-conns and list-sas,
+# and is configured through the same environment as the stand-ins in benchmarks/stubs:
+#   IPSEC_BENCHMARK_LOG               - each request is appended to this file as a single 'vici <command> <name>' line
+#   IPSEC_BENCHMARK_LATENCY           - seconds that every request takes, 0 by default
+#   IPSEC_BENCHMARK_UP_RESULT         - the outcome of initiate: established (default), auth-failed, failed or timeout
+#   IPSEC_BENCHMARK_UP_RESULT_PATTERN - a shell pattern of the tunnel names that IPSEC_BENCHMARK_UP_RESULT applies to, * by default
+
+import os
+import sys
+import time
+import signal
+import struct
+import fnmatch
+import argparse
+import threading
+from collections import OrderedDict
+try:
+    import SocketServer as socketserver
+except ImportError:
+    import socketserver
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from IpsecManagerVici import packPacket, unpackPacket, CMD_REQUEST, CMD_RESPONSE, CMD_UNKNOWN, EVENT_REGISTER, EVENT_UNREGISTER, EVENT_CONFIRM, EVENT_UNKNOWN, EVENT
+
+knownEvents = set(['control-log', 'list-conn', 'list-sa'])
+
+class FakeCharon(object):
+    def __init__(self):
+        self.lock                 = threading.Lock()
+        self.connections          = OrderedDict()
+        self.sharedKeys           = {}
+        self.securityAssociations = OrderedDict()
+        self.nextUniqueId         = 1
+        self.invocationLog        = open(os.environ.get('IPSEC_BENCHMARK_LOG', os.devnull), 'a')
+
+    def recordRequest(self, command, message):
+        name = message.get('name') or message.get('id') or message.get('ike') or (list(message)[0] if command == 'load-conn' and message else '')
+        with self.lock:
+            self.invocationLog.write(' '.join(['vici', command] + ([name] if name else [])) + '\n')
+            self.invocationLog.flush()
+        latency = float(os.environ.get('IPSEC_BENCHMARK_LATENCY', '0'))
+        if latency:
+            time.sleep(latency)
+
+    # Answers a request, calling sendEvent(eventName, message) for each of its events, and returns its response (or None for an unknown command)
+    def handleRequest(self, command, message, sendEvent):
+        self.recordRequest(command, message)
+        if command == 'load-conn':
+            if len(message) != 1:
+                return {'success' : 'no', 'errmsg' : 'missing connection'}
+            with self.lock:
+                self.connections.update(message)
+            return {'success' : 'yes'}
+        if command == 'unload-conn':
+            with self.lock:
+                if self.connections.pop(message.get('name'), None) is None:
+                    return {'success' : 'no', 'errmsg' : 'unloading connection \'' + str(message.get('name')) + '\' failed'}
+            return {'success' : 'yes'}
+        if command == 'load-shared':
+            if message.get('type') != 'IKE' or not message.get('data'):
+                return {'success' : 'no', 'errmsg' : 'invalid shared key'}
+            with self.lock:
+                self.sharedKeys[message.get('id')] = message
+            return {'success' : 'yes'}
+        if command == 'unload-shared':
+            with self.lock:
+                if self.sharedKeys.pop(message.get('id'), None) is None:
+                    return {'success' : 'no', 'errmsg' : 'unloading shared key \'' + str(message.get('id')) + '\' failed'}
+            return {'success' : 'yes'}
+        if command == 'initiate':
+            return self.initiate(message, sendEvent)
+        if command == 'terminate':
+            with self.lock:
+                if self.securityAssociations.pop(message.get('ike'), None) is None:
+                    return {'success' : 'no', 'errmsg' : 'no matching SAs to terminate found'}
+            return {'success' : 'yes', 'matches' : '1', 'terminated' : '1'}
+        if command == 'list-conns':
+            with self.lock:
+                connections = list(self.connections.items())
+            for name, connection in connections:
+                sendEvent('list-conn', {name : connection})
+            return {}
+        if command == 'list-sas':
+            with self.lock:
+                securityAssociations = list(self.securityAssociations.items())
+            for name, ikeSa in securityAssociations:
+                sendEvent('list-sa', {name : ikeSa})
+            return {}
+        return None
+
+    def initiate(self, message, sendEvent):
+        name = message.get('child', '')
+        upResult = 'established'
+        if fnmatch.fnmatch(name, os.environ.get('IPSEC_BENCHMARK_UP_RESULT_PATTERN', '*')):
+            upResult = os.environ.get('IPSEC_BENCHMARK_UP_RESULT', 'established')
+        with self.lock:
+            connection = self.connections.get(name)
+            uniqueId = self.nextUniqueId
+            self.nextUniqueId += 1
+        if connection is None:
+            return {'success' : 'no', 'errmsg' : 'CHILD_SA config \'' + name + '\' not found'}
+
+        remoteAddress = connection.get('remote_addrs', ['%any'])[0]
+        sendEvent('control-log', {'group' : 'IKE', 'level' : '1', 'ikesa-name' : name, 'msg' : 'initiating IKE_SA ' + name + '[' + str(uniqueId) + '] to ' + remoteAddress})
+        if upResult == 'timeout':
+            time.sleep(int(message.get('timeout', '0')) / 1000.0)
+            return {'success' : 'no', 'errmsg' : 'CHILD_SA \'' + name + '\' not established after ' + message.get('timeout', '0') + 'ms'}
+        if upResult == 'auth-failed':
+            sendEvent('control-log', {'group' : 'IKE', 'level' : '1', 'ikesa-name' : name, 'msg' : 'received AUTHENTICATION_FAILED notify error'})
+        if upResult != 'established':
+            return {'success' : 'no', 'errmsg' : 'establishing CHILD_SA \'' + name + '\' failed'}
+
+        childSa = OrderedDict([('name', name), ('uniqueid', str(uniqueId)), ('state', 'INSTALLED'), ('spi-in', '%08x' % (0xc0000000 + uniqueId)), ('spi-out', '%08x' % (0xd0000000 + uniqueId)),
+                               ('bytes-in', '0'), ('bytes-out', '0'), ('packets-in', '0'), ('packets-out', '0'), ('rekey-time', '3600'),
+                               ('local-ts', connection.get('children', {}).get(name, {}).get('local_ts', [])),
+                               ('remote-ts', connection.get('children', {}).get(name, {}).get('remote_ts', []))])
+        with self.lock:
+            self.securityAssociations[name] = OrderedDict([('uniqueid', str(uniqueId)), ('state', 'ESTABLISHED'), ('established', '0'), ('remote-host', remoteAddress),
+                                                           ('child-sas', OrderedDict([(name + '-' + str(uniqueId), childSa)]))])
+        sendEvent('control-log', {'group' : 'CHD', 'level' : '1', 'ikesa-name' : name, 'msg' : 'CHILD_SA ' + name + '{' + str(uniqueId) + '} established'})
+        return {'success' : 'yes'}
+
+def serve(socketFilename):
+    fakeCharon = FakeCharon()
+
+    class RequestHandler(socketserver.BaseRequestHandler):
+        def receiveExactly(self, length):
+            data = b''
+            while len(data) < length:
+                chunk = self.request.recv(length - len(data))
+                if not chunk:
+                    return None
+                data += chunk
+            return data
+
+        def handle(self):
+            registeredEvents = set()
+            def sendEvent(eventName, message):
+                if eventName in registeredEvents:
+                    self.request.sendall(packPacket(EVENT, eventName, message))
+
+            while True:
+                header = self.receiveExactly(4)
+                packet = header and self.receiveExactly(struct.unpack('!I', header)[0])
+                if not packet:
+                    return
+                packetType, name, message = unpackPacket(packet)
+                if packetType == EVENT_REGISTER:
+                    registeredEvents.add(name)
+                    self.request.sendall(packPacket(EVENT_CONFIRM if name in knownEvents else EVENT_UNKNOWN))
+                elif packetType == EVENT_UNREGISTER:
+                    registeredEvents.discard(name)
+                    self.request.sendall(packPacket(EVENT_CONFIRM))
+                elif packetType == CMD_REQUEST:
+                    response = fakeCharon.handleRequest(name, message, sendEvent)
+                    self.request.sendall(packPacket(CMD_RESPONSE, message=response) if response is not None else packPacket(CMD_UNKNOWN))
+
+    class Server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+        daemon_threads = True
+
+    if os.path.exists(socketFilename):
+        os.remove(socketFilename)
+    server = Server(socketFilename, RequestHandler)
+
+    def stop(signalNumber, frame):
+        raise KeyboardInterrupt()
+    signal.signal(signal.SIGTERM, stop)
+
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        os.remove(socketFilename)
+
+if __name__ == '__main__':
+    argumentParser = argparse.ArgumentParser(description='A stand-in for charon\'s VICI socket')
+    argumentParser.add_argument('--socket', required=True, help='the unix socket to listen on')
+    serve(argumentParser.parse_args().socket)
@@ -0,0 +1,259 @@
+#!/usr/bin/python
+
+# Measures how IpsecManager's commands scale with the amount of tunnels, without OVS, strongswan or root privileges:
+# the stand-ins in benchmarks/stubs take the place of ip, ovs-ofctl, ovs-vsctl and strongswan, and IpsecManager's files are kept in a temporary directory
+# With --strongswan-backend vici, strongswan is controlled over the VICI socket of benchmarks/fakeViciServer.py instead, and each VICI request is counted as an executed command
+# Each tunnel count is measured in a fresh process, which creates a gateway, populates it with that many tunnels (with a single addIpsecTunnels call),
+# adds and removes a tunnel and lists the tunnels (--repeat times each), and destroys the gateway
+# For each command, the wall time, the amount of executed commands (ip, ovs-ofctl, ovs-vsctl and strongswan invocations), the amount of spawned tasks
+# (every process and thread that was forked, including the shells and the stand-ins' own children) and the bytes read and written by the process
+# (all of its read and write calls, files and pipes alike) are reported, along with the process' peak memory
+# The results are written as JSON, and can be compared with a previous run's results (--baseline) to spot regressions
+
+import io
+import os
+import sys
+import json
+import time
+import shutil
+import platform
+import resource
+import argparse
+import tempfile
+import subprocess
+
+benchmarkDirectory = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(benchmarkDirectory))
+
+from BashCommand import BashCommand
+from IpsecManager import IpsecManager
+from IpsecManagerLinkBackends import IpCommandLinkBackend
+from IpsecManagerStrongswanBackends import createStrongswanBackend
+
+stubsDirectory = os.path.join(benchmarkDirectory, 'stubs')
+fakeViciServerFilename = os.path.join(benchmarkDirectory, 'fakeViciServer.py')
+templateDirectory = os.path.join(os.path.dirname(benchmarkDirectory), 'templates')
+benchmarkedCommands = ['createIpsecGateway', 'addIpsecTunnels', 'addIpsecTunnel', 'removeIpsecTunnel', 'listIpsecTunnels', 'destroyIpsecGateway']
+defaultTunnelCounts = [10, 100, 1000, 10000]
+
+# The stand-in for ip has no kernel interfaces to query with an ioctl, so the gateway's mac address is taken from 'ip link show'
+class StubbedIpCommandLinkBackend(IpCommandLinkBackend):
+    def getMacAddress(self, interfaceName):
+        linkCommand = BashCommand('ip link show ' + interfaceName)
+        linkCommand.execute()
+        return linkCommand.output.split('link/ether ')[1].split()[0]
+
+def getTunnel(index):
+    return ('bench' + str(index),
+            '10.%d.%d.%d' % (index >> 16 & 255, index >> 8 & 255, index & 255),
+            '172.%d.%d.%d' % (16 + (index >> 16 & 15), index >> 8 & 255, index & 255),
+            '192.168.200.2',
+            'local' + str(index),
+            'remote' + str(index))
+
+# The last pid that the kernel handed out. Its growth counts the tasks spawned on the host meanwhile, so other activity on the host adds to it
+def getLastPid():
+    return int(open('/proc/loadavg').read().split()[-1])
+
+def getProcessIo():
+    processIo = dict(line.split(': ') for line in open('/proc/self/io').read().splitlines())
+    return int(processIo['rchar']), int(processIo['wchar'])
+
+# Starts benchmarks/fakeViciServer.py, and waits for it to listen on the given socket
+def startFakeViciServer(socketFilename):
+    fakeViciServer = subprocess.Popen([sys.executable, fakeViciServerFilename, '--socket', socketFilename])
+    for _ in range(100):
+        if os.path.exists(socketFilename):
+            return fakeViciServer
+        time.sleep(0.05)
+    fakeViciServer.kill()
+    raise RuntimeError('The fake VICI server didn\'t start')
+
+def getMedian(values):
+    values = sorted(values)
+    return (values[(len(values) - 1) // 2] + values[len(values) // 2]) / 2.0
+
+# Measures the commands of a single tunnel count, in the current process. The stand-ins' environment is set by runBenchmark
+def measureTunnelCount(tunnelCount, repeat, store, upTimeout, strongswanBackend):
+    workDirectory = tempfile.mkdtemp(prefix='ipsecManagerBenchmark.')
+    fakeViciServer = None
+    os.environ['IPSEC_BENCHMARK_STATE'] = os.path.join(workDirectory, 'state')
+    os.environ['IPSEC_BENCHMARK_LOG'] = os.path.join(workDirectory, 'invocations.log')
+    open(os.environ['IPSEC_BENCHMARK_LOG'], 'w').close()
+    try:
+        ipsecManager = IpsecManager(strongswanBackendName='cli')
+        ipsecManager.gatewayConfFilename  = os.path.join(workDirectory, 'gateway.conf')
+        ipsecManager.ipsecConfFilename    = os.path.join(workDirectory, 'ipsec.conf')
+        ipsecManager.ipsecSecretsFilename = os.path.join(workDirectory, 'ipsec.secrets')
+        ipsecManager.confFragmentDir      = os.path.join(workDirectory, 'ipsec.d')
+        ipsecManager.secretsFragmentDir   = os.path.join(workDirectory, 'secrets.d')
+        ipsecManager.registryFilename     = os.path.join(workDirectory, 'tunnels.registry')
+        ipsecManager.journalDirectory     = os.path.join(workDirectory, 'journal')
+        ipsecManager.ipForwardingFilename = os.path.join(workDirectory, 'ip_forward')
+        ipsecManager.gatewayTemplate      = os.path.join(templateDirectory, 'gateway.template')
+        ipsecManager.ipsecConfTemplate    = os.path.join(templateDirectory, 'ipsec.conf.template')
+        ipsecManager.ipsecSecretsTemplate = os.path.join(templateDirectory, 'ipsec.secrets.template')
+        ipsecManager.linkBackend          = StubbedIpCommandLinkBackend()
+        ipsecManager.tunnelUpTimeout      = upTimeout
+        if strongswanBackend == 'vici':
+            fakeViciServer = startFakeViciServer(os.path.join(workDirectory, 'charon.vici'))
+            ipsecManager.strongswanBackend = createStrongswanBackend('vici', os.path.join(workDirectory, 'charon.vici'), ipsecManager.ipsecSecretsTemplate)
+        for filename in [ipsecManager.ipsecConfFilename, ipsecManager.ipsecSecretsFilename]:
+            open(filename, 'w').close()
+        if store == 'fragments':
+            os.makedirs(ipsecManager.confFragmentDir)
+        ipsecManager.selectTunnelStore()
+
+        invocationLog = io.open(os.environ['IPSEC_BENCHMARK_LOG'], 'rb')
+        measurements = dict((command, []) for command in benchmarkedCommands)
+        pidMax = int(open('/proc/sys/kernel/pid_max').read())
+        def measure(command, *params):
+            bytesRead, bytesWritten = getProcessIo()
+            lastPid = getLastPid()
+            startTime = time.time()
+            error = None
+            try:
+                getattr(ipsecManager, command)(*params)
+            except RuntimeError as e:
+                error = str(e).splitlines()[0] if str(e) else 'RuntimeError'
+            wallTime = time.time() - startTime
+            spawnedTasks = (getLastPid() - lastPid) % pidMax
+            endBytesRead, endBytesWritten = getProcessIo()
+            measurements[command].append({'wallTime'          : wallTime,
+                                          'executedCommands'  : len(invocationLog.read().splitlines()),
+                                          'spawnedTasks'      : spawnedTasks,
+                                          'bytesRead'         : endBytesRead - bytesRead,
+                                          'bytesWritten'      : endBytesWritten - bytesWritten,
+                                          'error'             : error})
+
+        measure('createIpsecGateway', 'br-bench', '192.168.100.1/24')
+        measure('addIpsecTunnels', [getTunnel(index) for index in range(tunnelCount)])
+        for index in range(tunnelCount, tunnelCount + repeat):
+            measure('addIpsecTunnel', *getTunnel(index))
+            measure('removeIpsecTunnel', getTunnel(index)[0])
+        for _ in range(repeat):
+            measure('listIpsecTunnels')
+        measure('destroyIpsecGateway')
+        invocationLog.close()
+        ipsecManager.strongswanBackend.close()
+    finally:
+        if fakeViciServer:
+            fakeViciServer.terminate()
+            fakeViciServer.wait()
+        shutil.rmtree(workDirectory, ignore_errors=True)
+
+    commandResults = {}
+    for command in benchmarkedCommands:
+        wallTimes = [measurement['wallTime'] for measurement in measurements[command]]
+        errors = [measurement['error'] for measurement in measurements[command] if measurement['error']]
+        commandResults[command] = {'runs'              : len(wallTimes),
+                                   'medianWallTime'    : getMedian(wallTimes),
+                                   'minWallTime'       : min(wallTimes),
+                                   'maxWallTime'       : max(wallTimes),
+                                   'executedCommands'  : getMedian([measurement['executedCommands'] for measurement in measurements[command]]),
+                                   'spawnedTasks'      : getMedian([measurement['spawnedTasks'] for measurement in measurements[command]]),
+                                   'bytesRead'         : getMedian([measurement['bytesRead'] for measurement in measurements[command]]),
+                                   'bytesWritten'      : getMedian([measurement['bytesWritten'] for measurement in measurements[command]]),
+                                   'errors'            : sorted(set(errors))}
+    return {'tunnels'      : tunnelCount,
+            'peakMemoryKb' : resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+            'commands'     : commandResults}
+
+# Measures each tunnel count in its own process, so each one's peak memory is its own
+def runBenchmark(args):
+    environment = dict(os.environ)
+    environment['PATH'] = stubsDirectory + os.pathsep + environment.get('PATH', '')
+    environment['IPSEC_BENCHMARK_LATENCY'] = str(args.latency)
+    environment['IPSEC_BENCHMARK_UP_RESULT'] = args.up_result
+    environment['IPSEC_BENCHMARK_UP_RESULT_PATTERN'] = args.up_result_pattern
+    environment['IPSEC_BENCHMARK_ROUTE_EXISTS'] = '1' if args.route_exists else '0'
+
+    results = []
+    for tunnelCount in args.tunnels:
+        sys.stderr.write('Measuring ' + str(tunnelCount) + ' tunnels...' + os.linesep)
+        benchmarkProcess = subprocess.Popen([sys.executable, os.path.abspath(__file__), '--measure-tunnel-count', str(tunnelCount), '--repeat', str(args.repeat),
+                                             '--store', args.store, '--up-timeout', str(args.up_timeout), '--strongswan-backend', args.strongswan_backend], env=environment, stdout=subprocess.PIPE)
+        output, _ = benchmarkProcess.communicate()
+        if benchmarkProcess.returncode != 0:
+            raise RuntimeError('Measuring ' + str(tunnelCount) + ' tunnels failed')
+        results.append(json.loads(output.decode()))
+
+    return {'python'   : platform.python_version(),
+            'platform' : platform.platform(),
+            'time'     : time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'settings' : {'repeat'            : args.repeat,
+                          'store'             : args.store,
+                          'strongswanBackend' : args.strongswan_backend,
+                          'latency'           : args.latency,
+                          'upResult'          : args.up_result,
+                          'upResultPattern'   : args.up_result_pattern,
+                          'routeExists'       : args.route_exists},
+            'results'  : results}
+
+def formatReport(report):
+    lines = ['%8s  %-20s %12s %10s %8s %12s %14s' % ('tunnels', 'command', 'median ms', 'commands', 'tasks', 'KB read', 'KB written')]
+    for result in report['results']:
+        for command in benchmarkedCommands:
+            commandResult = result['commands'][command]
+            lines.append('%8d  %-20s %12.2f %10g %8g %12.1f %14.1f%s' % (result['tunnels'], command, commandResult['medianWallTime'] * 1000, commandResult['executedCommands'],
+                                                                       commandResult['spawnedTasks'], commandResult['bytesRead'] / 1024.0, commandResult['bytesWritten'] / 1024.0,
+                                                                       '  (' + '; '.join(commandResult['errors']) + ')' if commandResult['errors'] else ''))
+        lines.append('%8d  peak memory: %d KB' % (result['tunnels'], result['peakMemoryKb']))
+    return os.linesep.join(lines)
+
+# Returns a line per command whose median wall time grew by more than the threshold (and by more than noiseFloor seconds), or that executes more commands
+def findRegressions(report, baselineReport, threshold, noiseFloor):
+    baselineResults = dict((result['tunnels'], result) for result in baselineReport['results'])
+    regressions = []
+    for result in report['results']:
+        if result['tunnels'] not in baselineResults:
+            continue
+        for command in benchmarkedCommands:
+            commandResult = result['commands'][command]
+            baselineCommandResult = baselineResults[result['tunnels']]['commands'].get(command)
+            if not baselineCommandResult:
+                continue
+            if commandResult['medianWallTime'] > baselineCommandResult['medianWallTime'] * threshold and commandResult['medianWallTime'] - baselineCommandResult['medianWallTime'] > noiseFloor:
+                regressions.append('%s with %d tunnels: %.2f ms, was %.2f ms' % (command, result['tunnels'], commandResult['medianWallTime'] * 1000, baselineCommandResult['medianWallTime'] * 1000))
+            if commandResult['executedCommands'] > baselineCommandResult['executedCommands']:
+                regressions.append('%s with %d tunnels: %g executed commands, was %g' % (command, result['tunnels'], commandResult['executedCommands'], baselineCommandResult['executedCommands']))
+    return regressions
+
+def main():
+    argumentParser = argparse.ArgumentParser(description='Benchmarks IpsecManager\'s commands against stand-ins for ip, ovs-ofctl, ovs-vsctl and strongswan')
+    argumentParser.add_argument('--tunnels', type=int, nargs='+', default=defaultTunnelCounts, help='the tunnel counts to measure')
+    argumentParser.add_argument('--repeat', type=int, default=5, help='the amount of times addIpsecTunnel, removeIpsecTunnel and listIpsecTunnels are measured')
+    argumentParser.add_argument('--store', choices=['monolithic', 'fragments'], default='monolithic', help='where the tunnels\' configuration is kept')
+    argumentParser.add_argument('--strongswan-backend', choices=['cli', 'vici'], default='cli', help='how strongswan is controlled: with \'strongswan\' commands, or over a fake VICI socket')
+    argumentParser.add_argument('--latency', type=float, default=0, help='seconds that every stand-in invocation takes')
+    argumentParser.add_argument('--up-result', choices=['established', 'auth-failed', 'failed', 'timeout'], default='established', help='the outcome of \'strongswan up\'')
+    argumentParser.add_argument('--up-result-pattern', default='*', help='a shell pattern of the tunnel names that --up-result applies to')
+    argumentParser.add_argument('--up-timeout', type=float, default=5, help='seconds before \'strongswan up\' is considered unreachable')
+    argumentParser.add_argument('--route-exists', action='store_true', help='make every \'ip route add\' report \'RTNETLINK answers: File exists\'')
+    argumentParser.add_argument('--output', help='write the JSON results to this file rather than to stdout')
+    argumentParser.add_argument('--baseline', help='a previous run\'s JSON results to compare with')
+    argumentParser.add_argument('--threshold', type=float, default=1.25, help='the slowdown ratio (compared with the baseline) that is reported as a regression')
+    argumentParser.add_argument('--noise-floor', type=float, default=0.01, help='seconds of slowdown (compared with the baseline) that are never reported as a regression')
+    argumentParser.add_argument('--measure-tunnel-count', type=int, help=argparse.SUPPRESS)
+    args = argumentParser.parse_args()
+
+    if args.measure_tunnel_count is not None:
+        sys.stdout.write(json.dumps(measureTunnelCount(args.measure_tunnel_count, args.repeat, args.store, args.up_timeout, args.strongswan_backend)))
+        return
+
+    report = runBenchmark(args)
+    sys.stderr.write(formatReport(report) + os.linesep)
+    if args.output:
+        with open(args.output, 'w') as outputFile:
+            json.dump(report, outputFile, indent=4, sort_keys=True)
+    else:
+        sys.stdout.write(json.dumps(report, indent=4, sort_keys=True) + os.linesep)
+
+    if args.baseline:
+        regressions = findRegressions(report, json.load(open(args.baseline)), args.threshold, args.noise_floor)
+        if regressions:
+            sys.stderr.write((os.linesep + '    ').join(['Regressions compared with ' + args.baseline + ':'] + regressions) + os.linesep)
+            sys.exit(1)
+
+if __name__ == '__main__':
+    main()
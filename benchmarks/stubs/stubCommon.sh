@@ -0,0 +1,15 @@
+# Sourced by the stand-ins for ip, ovs-ofctl, ovs-vsctl and strongswan, which the benchmark puts first on PATH
+# They are configured through the environment:
+#   IPSEC_BENCHMARK_LOG                 - each invocation is appended to this file as a single line
+#   IPSEC_BENCHMARK_STATE               - a directory holding the links and routes that were added with 'ip'
+#   IPSEC_BENCHMARK_LATENCY             - seconds that every invocation takes (e.g. 0.002), 0 by default
+#   IPSEC_BENCHMARK_UP_RESULT           - the outcome of 'strongswan up': established (default), auth-failed, failed or timeout
+#   IPSEC_BENCHMARK_UP_RESULT_PATTERN   - a shell pattern of the tunnel names that IPSEC_BENCHMARK_UP_RESULT applies to, * by default
+#   IPSEC_BENCHMARK_ROUTE_EXISTS        - when 1, every 'ip route add' reports 'RTNETLINK answers: File exists', as if the route had already been added
+
+recordInvocation() {
+    echo "$*" >> "${IPSEC_BENCHMARK_LOG:-/dev/null}"
+    if [ "${IPSEC_BENCHMARK_LATENCY:-0}" != 0 ]; then
+        sleep "$IPSEC_BENCHMARK_LATENCY"
+    fi
+}
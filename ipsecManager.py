@@ -1,10 +1,53 @@
 #!/usr/bin/python
 #written by Gavi - gavi@mellanox.com
 
-from IpsecManagerCommandLineParser import IpsecManagerCommandLineParser, HelpRequestedException, InsufficientInputException
-from IpsecManager import IpsecManager
-from sys import argv, exit
+from IpsecManagerCommandLineParser import IpsecManagerCommandLineParser, HelpRequestedException, InsufficientInputException, getOptionName, getOptionValue
+from IpsecManagerGatewayPool import IpsecGatewayPool, defaultGatewayName
+from IpsecManager import defaultTunnelStatusTtl
+from IpsecManagerDaemon import IpsecManagerDaemon, IpsecManagerClient, readOnlyCommands
+from IpsecManagerTunnelStatus import tunnelStatusFields, getTunnelStatusChanges
+from sys import argv, exit, stdout, stderr
 from os import linesep
+from os.path import abspath
+from time import sleep, strftime
+from collections import OrderedDict
+import json
+
+def orderTunnelStatus(tunnelStatus):
+    return OrderedDict((field, tunnelStatus[field]) for field in tunnelStatusFields) if tunnelStatus is not None else None
+
+def formatTunnelStatuses(tunnelStatuses):
+    maxNameLen = max([len(tunnelStatus['name']) for tunnelStatus in tunnelStatuses])
+    return [tunnelStatus['name'] + ': ' + ' '*(maxNameLen - len(tunnelStatus['name'])) + formatTunnelStatus(tunnelStatus) for tunnelStatus in tunnelStatuses]
+
+def formatTunnelStatus(tunnelStatus):
+    statusLine = tunnelStatus['sourceIp'] + ' <===> ' + tunnelStatus['destIp'] + '  ' + tunnelStatus['state']
+    if tunnelStatus['spiIn']:
+        statusLine += ', SPIs ' + tunnelStatus['spiIn'] + '_i ' + tunnelStatus['spiOut'] + '_o'
+        statusLine += ', ' + str(tunnelStatus['bytesIn']) + ' bytes_i ' + str(tunnelStatus['bytesOut']) + ' bytes_o'
+    if tunnelStatus['nextRekey']:
+        statusLine += ', rekeying in ' + tunnelStatus['nextRekey']
+    return statusLine
+
+# Polls the tunnels' status every interval, and prints the tunnels whose state or SAs changed (all of them on the first poll) until interrupted
+def watchTunnelStatus(executeCommand, interval, printJson):
+    previousTunnelStatuses = []
+    try:
+        while True:
+            tunnelStatuses = executeCommand()
+            timestamp = strftime('%Y-%m-%d %H:%M:%S')
+            for tunnelName, previousTunnelStatus, tunnelStatus in getTunnelStatusChanges(previousTunnelStatuses, tunnelStatuses):
+                if printJson:
+                    print json.dumps(OrderedDict([('time', timestamp), ('name', tunnelName), ('previous', orderTunnelStatus(previousTunnelStatus)), ('current', orderTunnelStatus(tunnelStatus))]))
+                elif tunnelStatus is None:
+                    print timestamp + ' ' + tunnelName + ': removed'
+                else:
+                    print timestamp + ' ' + tunnelName + ': ' + formatTunnelStatus(tunnelStatus)
+            stdout.flush()
+            previousTunnelStatuses = tunnelStatuses
+            sleep(interval)
+    except KeyboardInterrupt:
+        pass
 
 if __name__ == "__main__":
     commandLineParser = IpsecManagerCommandLineParser()
@@ -17,16 +60,105 @@ if __name__ == "__main__":
     except ValueError as e:
         exit(str(e))
 
-    ipsecManager = IpsecManager()
+    # The strongswan backend is picked by whoever creates the gateways: this process, or the daemon when it's started (serve)
+    strongswanBackendName = getOptionValue(argv[2:], '--strongswan-backend=')
+    commandArgs = [arg for arg in argv[2:] if getOptionName(arg) not in commandLineParser.globalOptions]
+
+    if command == 'serve':
+        try:
+            IpsecManagerDaemon(ipsecManager=IpsecGatewayPool(strongswanBackendName=strongswanBackendName)).serve()
+        except RuntimeError as e:
+            exit(str(e))
+        exit()
+
+    # Commands are forwarded to the daemon when it is running, and executed by this process otherwise:
+    ipsecManagerClient = IpsecManagerClient()
+    ipsecManager = None if ipsecManagerClient.daemonIsRunning() else IpsecGatewayPool(strongswanBackendName=strongswanBackendName)
+    def executeCommand():
+        if ipsecManager is None:
+            return ipsecManagerClient.executeCommand([command] + [abspath(arg) if command in commandLineParser.manifestCommands and not arg.startswith('--') else arg for arg in commandArgs])
+        return getattr(ipsecManager, command)(*params)
+
+    printJson = '--json' in argv[2:]
     try:
-        returnVal = getattr(ipsecManager, command)(*params)
+        # Operations that a previous run left incomplete (e.g. by crashing) are recovered before the gateways are modified again:
+        if ipsecManager is not None and command not in readOnlyCommands:
+            for gatewayName, operationName, outcome in ipsecManager.recoverIncompleteOperations():
+                stderr.write('Recovered the interrupted ' + operationName + ' of gateway ' + gatewayName + ': ' + outcome + linesep)
+        if command == 'tunnelStatus' and '--watch' in argv[2:]:
+            watchTunnelStatus(executeCommand, ipsecManager.tunnelStatusTtl if ipsecManager is not None else defaultTunnelStatusTtl, printJson)
+            exit()
+        returnVal = executeCommand()
     except RuntimeError as e:
         exit(str(e))
 
-    if command == 'listIpsecTunnels':
+    if command == 'listIpsecTunnels' and printJson:
+        print json.dumps([OrderedDict([('name', tunnelName), ('sourceIp', sourceIp), ('destIp', destIp), ('gateway', gatewayName)]) for tunnelName, sourceIp, destIp, gatewayName in returnVal], indent=4)
+    elif command == 'listIpsecTunnels':
         ipsecTunnels = returnVal
         if len(ipsecTunnels) > 0:
-            maxNameLen = max([len(tunnelName) for tunnelName, _, _ in ipsecTunnels])
-            print (linesep + '    ').join(['Current ISPEC tunnels:'] + [tunnelName + ': ' + ' '*(maxNameLen - len(tunnelName)) + sourceIp + ' <===> ' + destIp for tunnelName, sourceIp, destIp in ipsecTunnels])
+            maxNameLen = max([len(tunnelName) for tunnelName, _, _, _ in ipsecTunnels])
+            # The gateways are only shown once tunnels are placed on named gateways:
+            showGateways = bool([gatewayName for _, _, _, gatewayName in ipsecTunnels if gatewayName != defaultGatewayName])
+            print (linesep + '    ').join(['Current ISPEC tunnels:'] + [tunnelName + ': ' + ' '*(maxNameLen - len(tunnelName)) + sourceIp + ' <===> ' + destIp + (' (gateway ' + gatewayName + ')' if showGateways else '') for tunnelName, sourceIp, destIp, gatewayName in ipsecTunnels])
         else:
             print 'No ISPEC tunnels are currently up'
+    elif command == 'listIpsecGateways' and printJson:
+        print json.dumps([OrderedDict([('name', gatewayName), ('ovsBridge', ovsBridge), ('gatewayIp', gatewayIp), ('tunnels', tunnelCount)]) for gatewayName, ovsBridge, gatewayIp, tunnelCount in returnVal], indent=4)
+    elif command == 'listIpsecGateways':
+        ipsecGateways = returnVal
+        if len(ipsecGateways) > 0:
+            maxNameLen = max([len(gatewayName) for gatewayName, _, _, _ in ipsecGateways])
+            print (linesep + '    ').join(['Current ISPEC gateways:'] + [gatewayName + ': ' + ' '*(maxNameLen - len(gatewayName)) + gatewayIp + ' on ' + ovsBridge + ', ' + str(tunnelCount) + ' tunnels' for gatewayName, ovsBridge, gatewayIp, tunnelCount in ipsecGateways])
+        else:
+            print 'No ISPEC gateways exist'
+    elif command == 'tunnelStatus' and printJson:
+        print json.dumps([orderTunnelStatus(tunnelStatus) for tunnelStatus in returnVal], indent=4)
+    elif command == 'tunnelStatus':
+        tunnelStatuses = returnVal
+        if len(tunnelStatuses) > 0:
+            print (linesep + '    ').join(['ISPEC tunnels status:'] + formatTunnelStatuses(tunnelStatuses))
+        else:
+            print 'No ISPEC tunnels are currently up'
+    elif command in ['upIpsecTunnels', 'upAllIpsecTunnels']:
+        tunnelUpResults = returnVal
+        if len(tunnelUpResults) > 0:
+            maxNameLen = max([len(tunnelName) for tunnelName, _ in tunnelUpResults])
+            print (linesep + '    ').join(['ISPEC tunnels raised:'] + [tunnelName + ': ' + ' '*(maxNameLen - len(tunnelName)) + upResult for tunnelName, upResult in tunnelUpResults])
+        else:
+            print 'No ISPEC tunnels to raise'
+        if [upResult for _, upResult in tunnelUpResults if upResult != 'established']:
+            exit(1)
+    elif command == 'reconcile':
+        reconcilePlan = returnVal
+        dryRun = params[-1]
+        planLines = [('remove tunnel ' + tunnelName) for tunnelName in reconcilePlan['tunnelsToRemove']]
+        planLines += [('modify tunnel ' + tunnelName + ': ' + sourceIp + ' <===> ' + destIp) for tunnelName, sourceIp, destIp, _, _, _ in reconcilePlan['tunnelsToModify']]
+        planLines += [('add tunnel ' + tunnelName + ': ' + sourceIp + ' <===> ' + destIp) for tunnelName, sourceIp, destIp, _, _, _ in reconcilePlan['tunnelsToAdd']]
+        planLines += [('delete flow ' + sourceIp + ' ===> ' + destIp) for sourceIp, destIp in reconcilePlan['ipFlowsToDelete']]
+        planLines += [('add flow ' + sourceIp + ' ===> ' + destIp) for sourceIp, destIp in reconcilePlan['ipFlowsToAdd']]
+        planLines += [('delete ARP spoofing of ' + sourceIp) for sourceIp in reconcilePlan['arpFlowsToDelete']]
+        planLines += [('spoof ARP replies to ' + sourceIp + ' from ' + destIp) for sourceIp, destIp in reconcilePlan['arpFlowsToSet']]
+        planLines += [('delete route ' + prefix) for prefix in reconcilePlan['routesToDelete']]
+        planLines += [('add route ' + prefix) for prefix in reconcilePlan['routesToAdd']]
+        if len(planLines) > 0:
+            print (linesep + '    ').join(['Reconcile plan:' if dryRun else 'Applied changes:'] + planLines)
+        else:
+            print 'Already converged, nothing to change'
+    elif command == 'auditFlows':
+        audit = returnVal
+        garbageCollect = params[-1]
+        auditLines = [('delete ' if garbageCollect else 'orphaned ') + flow for _, flow in audit['orphanedFlows']]
+        auditLines += [('add ' if garbageCollect else 'missing ') + flow for _, flow in audit['missingFlows']]
+        if len(auditLines) > 0:
+            print (linesep + '    ').join(['Garbage collected flows:' if garbageCollect else 'Flows that drifted from the tunnels:'] + auditLines)
+        else:
+            print 'All flows are in place'
+        if auditLines and not garbageCollect:
+            exit(1)
+    elif command == 'migrateTunnelsToFragments':
+        migratedTunnelNames = returnVal
+        if len(migratedTunnelNames) > 0:
+            print (linesep + '    ').join(['ISPEC tunnels moved to fragments:'] + migratedTunnelNames)
+        else:
+            print 'No ISPEC tunnels to move to fragments'